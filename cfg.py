@@ -66,6 +66,19 @@ class Config(object):
     self.download_attempts = 3
     self.num_workers = NUM_WORKERS
 
+    # Slave launch waves. Slaves are inserted a wave at a time; the wave grows
+    # while insert_instance is fast and error-free, and shrinks when the API
+    # slows down or starts refusing requests (usually quota).
+    self.launch_wave_min = 5
+    self.launch_wave_max = 200
+    self.launch_wave_initial = NUM_WORKERS
+    self.launch_target_latency_secs = 30.0
+    self.launch_max_error_rate = 0.1
+    self.launch_backoff_secs = 10.0
+    self.launch_insert_attempts = 3
+    # How many finished waves to describe in the status
+    self.launch_waves_shown = 5
+
     # Hadoop details
 
     self.hadoop_url = 'archive.apache.org/dist/hadoop/common'
@@ -76,8 +89,150 @@ class Config(object):
     # This is where ephemeral disk gets mounted. Note this location is hardcoded
     # in a few places (the hadoop config, mainly)
     self.edisk_location = EDISK_LOCATION
+    # setup_hadoop.py leaves this behind once Hadoop is installed, so a reset
+    # instance can skip straight to starting its daemons
+    self.install_marker = EDISK_LOCATION + '/hadoop_installed'
+    # Each instance lists the Hadoop daemons it started here, one per line
+    self.daemons_file = EDISK_LOCATION + '/hadoop_daemons'
+    # The JobTracker keeps submitted JARs here, keyed by their SHA-1
+    self.jar_cache_dir = EDISK_LOCATION + '/jar_cache'
+    self.jar_cache_bytes = 2 * 1024 ** 3
+    # Where the JobTracker logs each job driver's output, by job ID
+    self.job_log = '/home/hadoop/log_job_{0}'
+    # Most of a job log one /job/log call returns, and the longest it waits
+    # for more output
+    self.job_log_chunk_bytes = 64 * 1024
+    self.job_log_wait_secs = 20
+    # Local files go to HDFS in chunks of this size, this many at once, relayed
+    # by the coordinator to the NameNode, which streams them into hadoop fs
+    # -put in order. It holds at most upload_window_chunks that arrive early in
+    # memory; a chunk further ahead is sent again after a pause, for up to
+    # upload_stall_secs.
+    self.upload_chunk_bytes = 8 * 1024 ** 2
+    self.upload_streams = 4
+    self.upload_attempts = 3
+    self.upload_window_chunks = 16
+    self.upload_stall_secs = 300
+    # Instead, stage local files in a temporary GS object and copy that into
+    # HDFS. The data is written twice, but nothing is held on the NameNode.
+    self.upload_via_gs = False
+    # Downloads stream HDFS files through the coordinator a block at a time,
+    # this many files at once, retrying each file a few times
+    self.download_block_bytes = 1024 ** 2
+    self.download_streams = 4
+    self.download_file_attempts = 3
+    # Most sorted files merged in one pass
+    self.download_merge_fanin = 64
+    # How many HDFS paths the NameNode deletes at once
+    self.clean_parallel = 8
+    # Job drivers the coordinator lets run at once; the rest wait in a queue
+    self.max_concurrent_jobs = 4
+    # Longest a /job/wait call blocks before returning the job as it is
+    self.job_wait_max_secs = 60
+    # Times the JobTracker's snitch tries to report a finished job
+    self.job_report_attempts = 5
+    # How often the coordinator checks its RUNNING jobs against the snitch,
+    # and how long one may be unknown to it before it's failed
+    self.job_check_secs = 60
+    self.job_lost_secs = 300
+    # Request threads in the coordinator's webserver
+    self.server_threads = 50
+    # How often the coordinator checks instances for a reboot
+    self.reboot_check_secs = 30
     # Depends on hdfs replication value
     self.needed_slaves = 3
+    # The generated config never replicates to more slaves than exist
+    self.hdfs_replication = 1
+
+    # Number of extra slaves to keep installed but not started, so add_slaves
+    # doesn't have to wait for new instances. 0 disables the pool.
+    self.warm_pool_size = 0
+
+    # Removing slaves. DataNodes are decommissioned in batches of this size,
+    # with a few batches in flight at once
+    self.decommission_batch_size = 10
+    self.decommission_parallel_batches = 3
+    # Longest a batch's blocks may take to drain before the removal fails
+    self.decommission_max_secs = 6 * 3600
+    # How long to hold off excluding TaskTrackers while jobs are running
+    self.decommission_job_wait_secs = 1800
+
+    # Rebalancing HDFS after slaves are added. Once every new slave is up (or
+    # broken) and balance_settle_secs pass with no further additions, the
+    # balancer runs until each DataNode's usage is within balance_threshold
+    # percent of the cluster's. balance_wait_max_secs caps the wait for slow
+    # slaves. Balancing moves about balance_total_bytes_per_sec across the
+    # cluster, split between the slaves, within the per-DataNode bounds.
+    self.auto_balance = True
+    self.balance_settle_secs = 60
+    self.balance_wait_max_secs = 1800
+    self.balance_threshold = 10
+    self.balance_total_bytes_per_sec = 1024 ** 3
+    self.balance_min_bytes_per_sec = 1024 ** 2
+    self.balance_max_bytes_per_sec = 50 * 1024 ** 2
+
+    # Autoscaling, driven by the data HadoopMonitor sends. Off by default.
+    self.autoscale = False
+    self.autoscale_min_slaves = self.needed_slaves
+    self.autoscale_max_slaves = 100
+    # Grow when there are more running and pending tasks than this per node
+    self.autoscale_backlog_per_node = 4.0
+    # Most slaves to add or remove in one decision
+    self.autoscale_max_step = 20
+    # Remove slaves only after the cluster has been idle this long, and don't
+    # act again this soon after a previous action
+    self.autoscale_cooldown_secs = 600
+    self.autoscale_period_secs = 60
+    # Ignore Hadoop data older than this
+    self.autoscale_max_staleness_secs = 60
+    # How many past decisions to describe in the status
+    self.autoscale_decisions_shown = 10
+
+    # Most spans the coordinator keeps for the launch timeline
+    self.trace_max_spans = 100000
+    # The ID this instance reports its startup spans under, from metadata
+    self.trace_id = ''
+
+    # Every snitch sends a heartbeat with its CPU, memory, /mnt/hadoop and
+    # network use this often. An instance is flagged when its disk is
+    # heartbeat_disk_full_pct full, when for heartbeat_flag_beats heartbeats in
+    # a row its CPU was heartbeat_hot_margin_pct busier than the median
+    # instance's (hot) or it spent heartbeat_slow_wait_pct of its time waiting
+    # on I/O or for the host's CPU (slow), or when it's missed
+    # heartbeat_silent_beats heartbeats.
+    self.heartbeat_secs = 10
+    self.heartbeat_disk_full_pct = 90
+    self.heartbeat_hot_margin_pct = 30
+    self.heartbeat_slow_wait_pct = 30
+    self.heartbeat_flag_beats = 6
+    self.heartbeat_silent_beats = 3
+
+    # Versions of the dashboard /status/changes can send differences against
+    self.dashboard_versions = 50
+
+    # How often HadoopMonitor sends an update (SLEEP_TIME in
+    # HadoopMonitor.java)
+    self.hadoop_monitor_secs = 15
+    # History of HadoopMonitor data. Each metric keeps (resolution in seconds,
+    # points) per tier: the last hour as sent, then a day by the minute, then a
+    # week in 10-minute buckets. The first tier keeps one point per update.
+    self.history_tiers = [(1, 3600 / self.hadoop_monitor_secs), (60, 1440),
+                          (600, 1008)]
+    # Forget the history of all but the most recent jobs
+    self.history_max_jobs = 50
+
+    # Tearing down. The coordinator deletes instances in parallel, but no
+    # faster than this many per second on average, in bursts of up to
+    # teardown_burst, retrying each a few times
+    self.teardown_deletes_per_sec = 5.0
+    self.teardown_burst = NUM_WORKERS
+    self.teardown_attempts = 3
+
+    # Sampling profiles, from /debug/profile. Longest one allowed, time between
+    # samples, and how many of the most common stacks to return.
+    self.profile_max_secs = 60
+    self.profile_interval_secs = 0.01
+    self.profile_top_stacks = 20
 
     # Google Storage locations
 
@@ -87,6 +242,8 @@ class Config(object):
     self.gs_coordinators_tarball = None
     self.gs_snitch_tarball = None
     self.gs_tools_jar = None
+    # Where clients stage job JARs, named by their SHA-1
+    self.gs_jar_cache = None
 
   def update_from_metadata(self):
     """Update by querying the metadata server. Only works on instances."""
@@ -96,7 +253,11 @@ class Config(object):
     self.ip_via_api = False
 
     def get_md(key, base=METADATA + 'attributes/'):
-      return httplib2.Http().request(base + key, 'GET')[1]
+      resp, content = httplib2.Http().request(base + key, 'GET')
+      # Not every instance is given every key
+      if resp.status != 200:
+        return ''
+      return content
 
     self.project_id = get_md('project-id', base=METADATA)
     self.secret = get_md('secret')
@@ -105,16 +266,19 @@ class Config(object):
     self.image = get_md('image')
     self.disk = get_md('disk')
     self.rw_disk_instance = get_md('rw_disk_instance')
+    self.trace_id = get_md('trace_id')
     self.set_bucket(get_md('gs_bucket'))
 
   def set_bucket(self, bucket):
     """Set the GS bucket, and update config URLs involving GS."""
     self.gs_bucket = bucket
     url = 'gs://{0}/'.format(bucket)
-    self.gs_hadoop_conf = url + 'hadoop_conf.tgz'
+    # Formatted with the role: namenode, jobtracker or slave
+    self.gs_hadoop_conf = url + 'hadoop_conf_{0}.tgz'
     self.gs_hadoop_tarball = url + self.hadoop_fn + '.tar.gz'
     self.gs_coordinators_tarball = url + 'coordinator-tarball.tgz'
     self.gs_snitch_tarball = url + 'snitch-tarball.tgz'
     self.gs_tools_jar = url + 'hadoop-tools.jar'
+    self.gs_jar_cache = url + 'jar_cache/'
 
 cfg = Config()
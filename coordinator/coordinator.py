@@ -16,15 +16,18 @@
 
 
 
+import base64
 import copy
 import json
 import logging
 import time
+import zlib
 
 import bottle
 from cfg import cfg
 import cherrypy.wsgiserver
 import hadoop_cluster
+import util
 
 
 def reply(data):
@@ -39,13 +42,19 @@ def reply_ok(result):
 
 
 def authorize():
-  their_secret = None
-  if 'secret' in bottle.request.forms:
+  # Calls carrying raw data put the secret in a header, so their body is never
+  # parsed as a form
+  raw = 'X-Secret' in bottle.request.headers
+  if raw:
+    their_secret = bottle.request.headers.get('X-Secret')
+    data = bottle.request.query.items()
+  else:
     their_secret = bottle.request.forms.get('secret')
+    data = bottle.request.forms.items()
   if their_secret != cfg.secret:
     logging.info('%s requested %s with data %s',
                  bottle.request.headers.get('Host'), bottle.request.fullpath,
-                 bottle.request.forms.items())
+                 data)
     bottle.abort(401, 'Your request does not include the right authorization.')
 
 
@@ -72,8 +81,10 @@ def main():
   def launch_hadoop():
     authorize()
     num_slaves = int(bottle.request.forms.get('num_slaves'))
-    logging.info('launch with %s requested', num_slaves)
-    return reply_ok(cluster.launch(num_slaves))
+    conf = json.loads(bottle.request.forms.get('conf') or '{}')
+    logging.info('launch with %s requested, config overrides %s', num_slaves,
+                 conf)
+    return reply_ok(cluster.launch(num_slaves, conf))
 
   @app.post('/hadoop/add_slaves')
   def add_hadoop_slaves():
@@ -82,6 +93,50 @@ def main():
     logging.info('add_slaves with %s requested', num_slaves)
     return reply_ok(cluster.add_slaves(num_slaves))
 
+  @app.post('/hadoop/warm_pool')
+  def set_warm_pool():
+    authorize()
+    size = int(bottle.request.forms.get('size'))
+    logging.info('warm pool of %s requested', size)
+    return reply_ok(cluster.set_pool_size(size))
+
+  @app.post('/hadoop/remove_slaves')
+  def remove_hadoop_slaves():
+    authorize()
+    num_slaves = bottle.request.forms.get('num_slaves')
+    names = bottle.request.forms.get('names')
+    logging.info('remove_slaves with %s %s requested', num_slaves, names)
+    if names:
+      op = cluster.remove_slaves(names=json.loads(names))
+    else:
+      op = cluster.remove_slaves(num_slaves=int(num_slaves))
+    if op:
+      op = copy.copy(op)
+      op['result'] = 'ok'
+      return reply(op)
+    else:
+      return reply({'result': 'failed'})
+
+  @app.post('/hadoop/balance')
+  def balance_hdfs():
+    authorize()
+    logging.info('HDFS balance requested')
+    op = cluster.balance()
+    if op:
+      op = copy.copy(op)
+      op['result'] = 'ok'
+      return reply(op)
+    else:
+      return reply({'result': 'failed'})
+
+  @app.post('/hadoop/teardown')
+  def teardown_hadoop():
+    authorize()
+    logging.info('teardown requested')
+    op = copy.copy(cluster.teardown())
+    op['result'] = 'ok'
+    return reply(op)
+
   @app.post('/transfer')
   def transfer():
     authorize()
@@ -95,20 +150,124 @@ def main():
     else:
       return reply({'result': 'failed'})
 
+  @app.post('/download/list')
+  def list_download():
+    authorize()
+    files = cluster.list_hdfs(bottle.request.forms.get('path'))
+    if files is None:
+      return reply({'result': 'failed'})
+    return reply({'result': 'ok', 'files': files})
+
+  @app.post('/download/read')
+  def read_download():
+    authorize()
+    path = bottle.request.forms.get('path')
+    blocks = cluster.read_hdfs(path)
+    if blocks is None:
+      bottle.abort(503, 'Could not read {0}'.format(path))
+    bottle.response.content_type = 'application/octet-stream'
+    return blocks
+
   @app.post('/job/clean')
   def clean_job():
     authorize()
-    path = bottle.request.forms.get('path')
-    logging.info('clean hdfs %s requested', path)
-    return reply_ok(cluster.clean_hdfs(path))
+    paths = bottle.request.forms.get('paths')
+    if paths:
+      paths = json.loads(paths)
+    else:
+      paths = filter(None, [bottle.request.forms.get('path')])
+    skip_trash = bottle.request.forms.get('skip_trash') == 'true'
+    logging.info('clean hdfs %s requested', paths)
+    op = copy.copy(cluster.clean_hdfs(paths, skip_trash))
+    if op:
+      op['result'] = 'ok'
+      return reply(op)
+    else:
+      return reply({'result': 'failed'})
+
+  @app.post('/upload/start')
+  def start_upload():
+    authorize()
+    upload_id = bottle.request.forms.get('upload_id')
+    dst = bottle.request.forms.get('dst')
+    size = int(bottle.request.forms.get('size'))
+    chunk_bytes = int(bottle.request.forms.get('chunk_bytes'))
+    logging.info('upload %s of %s bytes to %s requested', upload_id, size, dst)
+    result = cluster.start_upload(upload_id, dst, size, chunk_bytes)
+    if result is None:
+      return reply({'result': 'failed'})
+    return reply(result)
+
+  @app.post('/upload/chunk')
+  def upload_chunk():
+    # The chunk is the raw body; its arguments are in the query string
+    authorize()
+    result = cluster.upload_chunk(dict(bottle.request.query.items()),
+                                  bottle.request.body.read())
+    return reply(result or {'result': 'failed'})
+
+  @app.post('/upload/finish')
+  def finish_upload():
+    authorize()
+    upload_id = bottle.request.forms.get('upload_id')
+    logging.info('upload %s finished sending', upload_id)
+    op = copy.copy(cluster.finish_upload(upload_id))
+    if op:
+      op['result'] = 'ok'
+      return reply(op)
+    else:
+      return reply({'result': 'failed'})
 
   @app.post('/job/submit')
   def submit_job():
     authorize()
-    jar = bottle.request.forms.get('jar')
+    jar = bottle.request.forms.get('jar', '')
+    jar_hash = bottle.request.forms.get('jar_hash')
     job_args = map(str, json.loads(bottle.request.forms.get('job_args')))
-    logging.info('job submission requested: %s %s', jar, job_args)
-    return reply_ok(cluster.submit_job(jar, job_args))
+    logging.info('job submission requested: %s (%s) %s', jar, jar_hash,
+                 job_args)
+    job = cluster.submit_job(jar, job_args, jar_hash)
+    if job:
+      job = copy.copy(job)
+      job['result'] = 'ok'
+      return reply(job)
+    else:
+      return reply({'result': 'failed'})
+
+  @app.post('/job/wait/<job_id>')
+  def wait_for_job(job_id):
+    authorize()
+    timeout = float(bottle.request.forms.get('timeout') or 0)
+    job = cluster.wait_for_job(job_id, timeout)
+    if job is None:
+      return reply({'result': 'failed'})
+    job = copy.copy(job)
+    job['result'] = 'ok'
+    return reply(job)
+
+  @app.post('/job/log/<job_id>')
+  def job_log(job_id):
+    authorize()
+    offset = int(bottle.request.forms.get('offset') or 0)
+    max_bytes = int(bottle.request.forms.get('max_bytes') or
+                    cfg.job_log_chunk_bytes)
+    timeout = float(bottle.request.forms.get('timeout') or 0)
+    result = cluster.job_log(job_id, offset, max_bytes, timeout)
+    if result is None:
+      return reply({'result': 'failed'})
+    result['result'] = 'ok'
+    return reply(result)
+
+  @app.post('/status/jobs')
+  def list_jobs():
+    authorize()
+    return reply({'result': 'ok', 'jobs': cluster.jobs})
+
+  @app.post('/job/has_jar')
+  def has_jar():
+    authorize()
+    jar_hash = bottle.request.forms.get('jar_hash')
+    return reply({'result': 'ok', 'cached': cluster.has_jar(jar_hash)})
 
   @app.post('/status/cluster')
   def cluster_status():
@@ -119,20 +278,99 @@ def main():
     response['operations'] = cluster.operations
     return reply(response)
 
+  @app.post('/status/changes')
+  def status_changes():
+    authorize()
+    since = int(bottle.request.forms.get('since') or 0)
+    timeout = float(bottle.request.forms.get('timeout') or 0)
+    result = cluster.changes(since, timeout)
+    result['result'] = 'ok'
+    return reply(result)
+
+  @app.post('/status/history')
+  def history():
+    authorize()
+    metrics = bottle.request.forms.get('metrics')
+    if not metrics:
+      return reply({'result': 'ok', 'metrics': cluster.history.metrics()})
+    end = float(bottle.request.forms.get('end') or time.time())
+    start = float(bottle.request.forms.get('start') or end - 3600)
+    return reply({'result': 'ok', 'start': start, 'end': end,
+                  'series': cluster.history.query(json.loads(metrics), start,
+                                                  end)})
+
+  @app.post('/status/resources')
+  def resource_status():
+    authorize()
+    return reply({'result': 'ok', 'cluster': cluster.resources.summary(),
+                  'instances': cluster.resources.instances()})
+
   @app.post('/status/op/<name>')
   def get_op_status(name):
     authorize()
     return reply(cluster.operations[name])
 
+  @app.post('/status/op/<name>/wait')
+  def wait_for_op(name):
+    authorize()
+    last_state = bottle.request.forms.get('last_state')
+    timeout = float(bottle.request.forms.get('timeout') or 0)
+    return reply(cluster.wait_for_op(name, last_state, timeout))
+
+  @app.post('/status/trace')
+  def launch_trace():
+    authorize()
+    return reply(cluster.tracer.chrome_trace())
+
+  @app.post('/debug/threads')
+  def debug_threads():
+    authorize()
+    instance = bottle.request.forms.get('instance')
+    if instance:
+      return reply(util.checked_do(instance, '/debug/threads'))
+    return reply({'result': 'ok', 'threads': util.thread_stacks()})
+
+  @app.post('/debug/profile')
+  def debug_profile():
+    authorize()
+    seconds = min(float(bottle.request.forms.get('seconds') or 10),
+                  cfg.profile_max_secs)
+    instance = bottle.request.forms.get('instance')
+    logging.info('%ss profile of %s requested', seconds,
+                 instance or 'the coordinator')
+    if instance:
+      return reply(util.checked_do(instance, '/debug/profile',
+                                   {'seconds': seconds},
+                                   timeout=seconds + 30))
+    profile = util.sample_stacks(seconds)
+    if profile is None:
+      return reply({'result': 'failed', 'reason': 'already profiling'})
+    profile['result'] = 'ok'
+    return reply(profile)
+
   # Internal calls below
 
   # This is for the java piece to tell us about Hadoop
   @app.post('/hadoop/status_update')
   def hadoop_status_update():
     authorize_internal()
-    cluster.latest_data = json.loads(bottle.request.forms.get('data'))
-    cluster.last_update = time.time()
-    return '\n'
+    compressed = bottle.request.forms.get('zdata')
+    if compressed:
+      # Gzipped; the extra window bits make zlib expect the gzip header
+      data = zlib.decompress(base64.b64decode(compressed), 16 + zlib.MAX_WBITS)
+    else:
+      data = bottle.request.forms.get('data')
+    return reply(cluster.hadoop_update(json.loads(data)))
+
+  @app.post('/job/report')
+  def report_job():
+    authorize_internal()
+    job_id = bottle.request.forms.get('job_id')
+    exit_code = json.loads(bottle.request.forms.get('exit_code'))
+    hadoop_jobs = json.loads(bottle.request.forms.get('hadoop_jobs'))
+    reason = bottle.request.forms.get('reason')
+    cluster.job_done(job_id, exit_code, hadoop_jobs, reason)
+    return cfg.ok_reply
 
   @app.post('/instance/report_fail')
   def report_instance_fail():
@@ -142,6 +380,24 @@ def main():
     cluster.instance_fail(name, msg)
     return '\n'
 
+  @app.post('/trace/report')
+  def report_trace():
+    authorize_internal()
+    trace_id = bottle.request.forms.get('trace_id')
+    instance = bottle.request.forms.get('instance')
+    spans = json.loads(bottle.request.forms.get('spans'))
+    if not cluster.tracer.report(trace_id, instance, spans):
+      logging.info('Dropped stale trace %s from %s', trace_id, instance)
+    return '\n'
+
+  @app.post('/instance/heartbeat')
+  def report_heartbeat():
+    authorize_internal()
+    name = bottle.request.forms.get('name')
+    beat = json.loads(bottle.request.forms.get('beat'))
+    cluster.resources.heartbeat(name, beat)
+    return '\n'
+
   @app.post('/instance/op_status')
   def report_op_status():
     authorize_internal()
@@ -153,7 +409,9 @@ def main():
   print 'Starting coordinator server...'
   # Bottle's wrapper around cherrypy doesn't let us setup SSL, so do this
   # ourselves
-  server = cherrypy.wsgiserver.CherryPyWSGIServer(('0.0.0.0', cfg.port), app)
+  # Extra threads, since /job/wait calls hold theirs for a while
+  server = cherrypy.wsgiserver.CherryPyWSGIServer(('0.0.0.0', cfg.port), app,
+                                                  numthreads=cfg.server_threads)
   server.quiet = True
   server.ssl_certificate = '/etc/ssl/certs/ssl-cert-snakeoil.pem'
   server.ssl_private_key = '/etc/ssl/private/ssl-cert-snakeoil.key'
@@ -16,8 +16,11 @@
 
 
 
+import collections
 import json
 import logging
+import math
+import re
 import subprocess
 import threading
 import time
@@ -25,6 +28,10 @@ import time
 from cfg import cfg
 from gcelib import gce
 import gcelib.shortcuts as gce_shortcuts
+import hadoop_conf
+import resources
+import timeseries
+import tracing
 import util
 from util import InstanceState
 
@@ -46,6 +53,447 @@ class CluserState(object):
   READY = (5, 'READY')
 
 
+# States a new slave is done with: running Hadoop, broken or gone
+SETTLED_STATES = (InstanceState.HADOOP_READY, InstanceState.BROKEN,
+                  InstanceState.DOOMED, None)
+
+# How GsHdfs reports the progress of a transfer
+XFER_PROGRESS_RE = re.compile(r': (\d+) MB \((\d+) MB/s\)$')
+
+
+def set_elapsed(job, now):
+  """Fill in the elapsed times HadoopMonitor leaves out of a job.
+
+  They change with every poll, so HadoopMonitor sends start times instead and
+  a running job only shows up in its updates when something else changes.
+  """
+  job['elapsedSeconds'] = int((job.get('finishTime') or now) -
+                              job.get('startTime', now))
+  for kind in ('mapTimes', 'reduceTimes'):
+    for task in (job.get(kind) or {}).get('stragglers', []):
+      task['elapsedSeconds'] = int(now - task['startTime'])
+
+
+def op_finished(op):
+  return op['state'] == 'Done' or op['state'].startswith('Error')
+
+
+def diff(old, new):
+  """The entries of new that differ from old, for /status/changes.
+
+  Dictionary values are compared an entry deeper, and only their changed
+  entries kept, with None marking ones that are gone.
+  """
+  changes = {}
+  for key, value in new.items():
+    before = old.get(key)
+    if before == value:
+      continue
+    if isinstance(value, dict) and isinstance(before, dict):
+      changes[key] = dict((sub, value.get(sub))
+                          for sub in set(before) | set(value)
+                          if before.get(sub) != value.get(sub))
+    else:
+      changes[key] = value
+  return changes
+
+
+def balance_bandwidth(num_slaves):
+  """Bytes per second each DataNode may spend on balancing.
+
+  The cluster as a whole moves about cfg.balance_total_bytes_per_sec, so a big
+  cluster doesn't flood the network and a small one still finishes quickly.
+  """
+  per_node = cfg.balance_total_bytes_per_sec / max(num_slaves, 1)
+  return int(min(cfg.balance_max_bytes_per_sec,
+                 max(cfg.balance_min_bytes_per_sec, per_node)))
+
+
+class Counter(object):
+  """An integer that many threads can change at once.
+
+  on_change, if given, is called after every change, say to wake the waiters of
+  a StateStore whose predicates look at the counter.
+  """
+
+  def __init__(self, value=0, on_change=None):
+    self.value = value
+    self.on_change = on_change
+    self.lock = threading.Lock()
+
+  def add(self, delta):
+    """Returns the value after adding delta."""
+    with self.lock:
+      self.value += delta
+      value = self.value
+    if self.on_change:
+      self.on_change()
+    return value
+
+
+class StateStore(object):
+  """The state of the cluster and of each instance.
+
+  Each instance has its own lock, so transitions of different instances don't
+  wait on each other. The store's lock is only taken to change the cluster
+  state or which instances exist; it's always taken after an instance's lock,
+  never before. Reads don't lock: they see a recent state, as they would from
+  any snapshot.
+
+  Rather than waking every waiter on every change, wait_for() registers a
+  predicate, and only its waiter is woken, once the predicate holds. version
+  counts the changes, for waiters interested in any of them.
+  """
+
+  def __init__(self):
+    self.cluster = CluserState.DOWN
+    self.instances = {}
+    self.locks = {}
+    self.lock = threading.Lock()
+    # (predicate, threading.Event) for each blocked wait_for()
+    self.waiters = []
+    self.waiters_lock = threading.Lock()
+    self.version = 0
+
+  def instance_lock(self, name):
+    lock = self.locks.get(name)
+    if lock is None:
+      with self.lock:
+        lock = self.locks.setdefault(name, threading.Lock())
+    return lock
+
+  def get(self, name):
+    return self.instances.get(name)
+
+  def names(self, state=None):
+    """The instances, or only those in state."""
+    return [name for name, current in self.instances.items()
+            if state is None or current == state]
+
+  def set_cluster(self, state):
+    """Returns the old cluster state, or None if the change isn't allowed."""
+    with self.lock:
+      old = self.cluster
+      # Once doomed, a launch still in progress can't revive the cluster
+      if old == CluserState.DOOMED and state != CluserState.DOWN:
+        return None
+      self.cluster = state
+    if state != old:
+      self.notify()
+    return old
+
+  def set_instance(self, name, state, expected=None):
+    """Move an instance to state, if it's in expected (when given).
+
+    Returns:
+      (whether the change was allowed, the instance's old state)
+    """
+    with self.instance_lock(name):
+      old = self.instances.get(name)
+      if expected is not None and old != expected:
+        return (False, old)
+      # Threads still watching a doomed or deleted instance don't get a say.
+      # Only a caller expecting DOOMED can bring one back, and not once the
+      # whole cluster is going away.
+      if old == InstanceState.DOOMED and state != old:
+        if expected != old or self.cluster in (CluserState.DOOMED,
+                                               CluserState.DOWN):
+          return (False, old)
+      if old is None:
+        # Nothing new is added once the cluster is going away
+        with self.lock:
+          if self.cluster in (CluserState.DOOMED, CluserState.DOWN):
+            return (False, old)
+          self.instances[name] = state
+      else:
+        self.instances[name] = state
+    if state != old:
+      self.notify()
+    return (True, old)
+
+  def doom(self, name):
+    """Mark an instance DOOMED, whatever its state, even if it's unknown."""
+    with self.instance_lock(name):
+      with self.lock:
+        self.instances[name] = InstanceState.DOOMED
+    self.notify()
+
+  def remove(self, name):
+    with self.instance_lock(name):
+      with self.lock:
+        self.instances.pop(name, None)
+    self.notify()
+
+  def wait_for(self, predicate, timeout=None):
+    """Block until predicate() is true or timeout passes.
+
+    Returns:
+      Whether predicate() became true.
+    """
+    waiter = (predicate, threading.Event())
+    with self.waiters_lock:
+      if predicate():
+        return True
+      self.waiters.append(waiter)
+    # Event.wait with no timeout can't be interrupted, so wake up now and then
+    deadline = None if timeout is None else time.time() + timeout
+    while not waiter[1].is_set():
+      left = cfg.poll_delay_secs
+      if deadline is not None:
+        left = min(left, deadline - time.time())
+        if left <= 0:
+          break
+      waiter[1].wait(left)
+    with self.waiters_lock:
+      if waiter in self.waiters:
+        self.waiters.remove(waiter)
+    return waiter[1].is_set()
+
+  def notify(self):
+    """Wake the waiters whose predicates now hold."""
+    with self.waiters_lock:
+      self.version += 1
+      if not self.waiters:
+        return
+      still_waiting = []
+      for waiter in self.waiters:
+        if waiter[0]():
+          waiter[1].set()
+        else:
+          still_waiting.append(waiter)
+      self.waiters = still_waiting
+
+
+class LaunchPlanner(object):
+  """Inserts slave instances in waves sized by how the Compute API behaves.
+
+  Queueing every slave on the spawn_scheduler at once hits quota limits on big
+  clusters, and the failed inserts are never retried. Instead, a wave of slaves
+  is inserted, then the next wave's size is picked from the observed insert
+  latency and error rate: grow while the API keeps up, halve and back off on
+  errors, shrink gently when it gets slow. Slaves whose insert failed go back
+  to the front of the queue.
+  """
+
+  def __init__(self, cluster):
+    self.cluster = cluster
+    self.wave_size = cfg.launch_wave_initial
+    self.pending = collections.deque()
+    self.attempts = collections.defaultdict(int)
+    self.waves = []
+    self.current = None
+    # Protects everything above
+    self.cv = threading.Condition()
+    thread = threading.Thread(target=self.run)
+    thread.daemon = True
+    thread.start()
+
+  def enqueue(self, names):
+    with self.cv:
+      self.pending.extend(names)
+      self.cv.notifyAll()
+
+  def cancel(self):
+    """Drop every slave not inserted yet. Returns their names."""
+    with self.cv:
+      names = list(self.pending)
+      self.pending.clear()
+    return names
+
+  def run(self):
+    while True:
+      with self.cv:
+        while not self.pending:
+          self.cv.wait()
+        size = min(self.wave_size, len(self.pending))
+        names = [self.pending.popleft() for _ in range(size)]
+        wave = {'wave': len(self.waves), 'size': size, 'inserted': 0,
+                'failed': 0, 'latency_secs': 0.0, 'started': time.time()}
+        self.current = wave
+      logging.info('Launch wave %s: inserting %s slaves', wave['wave'], size)
+      for name in names:
+        self.cluster.spawn_scheduler.schedule(self.insert, (name, wave))
+      with self.cv:
+        while wave['inserted'] + wave['failed'] < size:
+          self.cv.wait()
+        wave['duration_secs'] = time.time() - wave['started']
+        self.waves.append(wave)
+        self.current = None
+        backoff = self.adapt(wave)
+      if backoff:
+        time.sleep(cfg.launch_backoff_secs)
+
+  def insert(self, name, wave):
+    start = time.time()
+    ok = self.cluster.launch_slave1(name)
+    latency = time.time() - start
+    give_up = False
+    with self.cv:
+      wave['latency_secs'] += latency
+      if ok:
+        wave['inserted'] += 1
+      else:
+        wave['failed'] += 1
+        self.attempts[name] += 1
+        if self.attempts[name] >= cfg.launch_insert_attempts:
+          give_up = True
+        else:
+          # Retry it first in the next wave
+          self.pending.appendleft(name)
+      self.cv.notifyAll()
+    if give_up:
+      self.cluster.update_state(name, InstanceState.BROKEN)
+      self.cluster.instance_fail(name, 'insert failed {0} times'.format(
+          cfg.launch_insert_attempts))
+      # A broken slave won't fill the warm pool, so launch another
+      with self.cluster.cv:
+        filling = name in self.cluster.pool_filling
+        self.cluster.pool_filling.discard(name)
+      if filling:
+        self.cluster.other_scheduler.schedule(self.cluster.refill_pool, ())
+
+  def adapt(self, wave):
+    """Pick the next wave size. Returns True if we should back off first."""
+    error_rate = float(wave['failed']) / wave['size']
+    latency = wave['latency_secs'] / wave['size']
+    old = self.wave_size
+    backoff = False
+    if error_rate > cfg.launch_max_error_rate:
+      self.wave_size = max(cfg.launch_wave_min, old / 2)
+      backoff = True
+    elif latency > cfg.launch_target_latency_secs:
+      self.wave_size = max(cfg.launch_wave_min, old * 3 / 4)
+    else:
+      self.wave_size = min(cfg.launch_wave_max, old * 2)
+    logging.info('Launch wave %s: %s/%s failed, %.1fs average insert; next '
+                 'wave %s -> %s', wave['wave'], wave['failed'], wave['size'],
+                 latency, old, self.wave_size)
+    return backoff
+
+  def insert_rate(self):
+    """Slaves inserted per minute over the last few waves, or None."""
+    with self.cv:
+      waves = self.waves[-cfg.launch_waves_shown:]
+      secs = sum(wave['duration_secs'] for wave in waves)
+      if not secs:
+        return None
+      return 60.0 * sum(wave['inserted'] for wave in waves) / secs
+
+  def status(self):
+    with self.cv:
+      return {'pending': len(self.pending),
+              'wave_size': self.wave_size,
+              'current_wave': dict(self.current) if self.current else None,
+              'waves': self.waves[-cfg.launch_waves_shown:]}
+
+
+class Autoscaler(object):
+  """Grows or shrinks the cluster based on the work HadoopMonitor reports.
+
+  Every cfg.autoscale_period_secs, the backlog (running tasks plus tasks of
+  running jobs that haven't been scheduled) is compared against the number of
+  nodes. A high backlog per node adds slaves; a cluster that has been idle for
+  cfg.autoscale_cooldown_secs has slaves removed through scale_down, if given.
+  The slave count stays within cfg.autoscale_min_slaves and
+  cfg.autoscale_max_slaves.
+  """
+
+  def __init__(self, cluster, scale_down=None):
+    self.cluster = cluster
+    # Called with a number of slaves to remove them gracefully. Without it,
+    # the cluster only grows.
+    self.scale_down = scale_down
+    self.idle_since = None
+    self.last_action = 0
+    self.decisions = []
+    thread = threading.Thread(target=self.run)
+    thread.daemon = True
+    thread.start()
+
+  def run(self):
+    while True:
+      time.sleep(cfg.autoscale_period_secs)
+      try:
+        self.evaluate()
+      except Exception as e:
+        logging.warn('Autoscaler failed: %s', e)
+
+  def decide(self, action, count, reason, numbers):
+    decision = {'time': time.time(), 'action': action, 'count': count,
+                'reason': reason}
+    decision.update(numbers)
+    logging.info('Autoscaler: %s %s (%s) %s', action, count, reason,
+                 json.dumps(numbers, sort_keys=True))
+    self.decisions.append(decision)
+    del self.decisions[:-cfg.autoscale_decisions_shown]
+
+  def evaluate(self):
+    cluster = self.cluster
+    if cluster.state != CluserState.READY:
+      return
+    data = cluster.latest_data
+    staleness = time.time() - cluster.last_update
+    if not data or staleness > cfg.autoscale_max_staleness_secs:
+      return
+
+    now = time.time()
+    nodes = data.get('mapreduceNodes', 0)
+    running = data.get('mapTasks', 0) + data.get('reduceTasks', 0)
+    pending = sum(job.get('pendingMaps', 0) + job.get('pendingReduces', 0)
+                  for job in data.get('jobs', []) if job['status'] == 'RUNNING')
+    backlog = running + pending
+    live, starting = cluster.slave_counts()
+    numbers = {'nodes': nodes, 'running_tasks': running,
+               'pending_tasks': pending, 'live_slaves': live,
+               'starting_slaves': starting}
+    per_node = float(backlog) / max(nodes, 1)
+    numbers['backlog_per_node'] = round(per_node, 2)
+
+    if backlog:
+      self.idle_since = None
+    elif self.idle_since is None:
+      self.idle_since = now
+    cooling = now - self.last_action < cfg.autoscale_cooldown_secs
+
+    if per_node > cfg.autoscale_backlog_per_node:
+      if starting:
+        self.decide('hold', 0, 'waiting for starting slaves', numbers)
+        return
+      want = int(math.ceil(backlog / cfg.autoscale_backlog_per_node)) - live
+      count = min(want, cfg.autoscale_max_step,
+                  cfg.autoscale_max_slaves - live)
+      if count <= 0:
+        self.decide('hold', 0, 'at autoscale_max_slaves', numbers)
+        return
+      self.decide('add', count, 'backlog per node above {0}'.format(
+          cfg.autoscale_backlog_per_node), numbers)
+      cluster.add_slaves(count)
+      self.last_action = now
+    elif self.idle_since is not None:
+      idle = now - self.idle_since
+      numbers['idle_secs'] = int(idle)
+      count = min(live - cfg.autoscale_min_slaves, cfg.autoscale_max_step)
+      if idle < cfg.autoscale_cooldown_secs or cooling:
+        self.decide('hold', 0, 'idle, cooling down', numbers)
+      elif count <= 0 or starting:
+        self.decide('hold', 0, 'idle, at autoscale_min_slaves', numbers)
+      elif self.scale_down is None:
+        self.decide('hold', 0, 'idle, but slaves can\'t be removed', numbers)
+      else:
+        self.decide('remove', count, 'idle for {0}s'.format(int(idle)),
+                    numbers)
+        self.scale_down(count)
+        self.last_action = now
+        self.idle_since = None
+    else:
+      self.decide('hold', 0, 'backlog within bounds', numbers)
+
+  def status(self):
+    return {'decisions': self.decisions,
+            'min_slaves': cfg.autoscale_min_slaves,
+            'max_slaves': cfg.autoscale_max_slaves}
+
+
 class HadoopCluster(object):
   """Singleton managing creation and monitoring of a cluster of instances."""
 
@@ -55,70 +503,162 @@ class HadoopCluster(object):
     util.setup_api(service_account=True)
 
     # Just for addinstance
-    self.spawn_scheduler = util.Scheduler(cfg.num_workers)
+    self.spawn_scheduler = util.Scheduler(cfg.num_workers, name='spawn')
     # For monitoring, deletion, anything else. We can be doing more of these at
     # a time without threatening API quota limits
-    self.other_scheduler = util.Scheduler(cfg.num_workers * 2)
-    self.state = CluserState.DOWN
-    self.instances = {}
+    self.other_scheduler = util.Scheduler(cfg.num_workers * 2, name='other')
+    # Feeds slaves to the spawn_scheduler a wave at a time
+    self.planner = LaunchPlanner(self)
+    self.autoscaler = None
+    if cfg.autoscale:
+      self.autoscaler = Autoscaler(self, scale_down=self.remove_slaves)
+    # The state of the cluster and each instance, and who's waiting on it
+    self.store = StateStore()
     self.errors = []
-    self.first_free_slave = 0
-    self.live_slaves = 0
+    self.first_free_slave = Counter()
+    self.live_slaves = Counter(on_change=self.store.notify)
+    # Slaves held at SNITCH_READY, ready for add_slaves to start instantly
+    self.pool_size = cfg.warm_pool_size
+    self.warm_pool = set()
+    # Slaves being launched into the warm pool
+    self.pool_filling = set()
+    self.pool_hits = 0
+    self.pool_misses = 0
+    # Each add_slaves bumps this; only the latest one rebalances HDFS, for the
+    # slaves added since the last balance
+    self.scale_ups = Counter()
+    self.unbalanced = set()
+    # The latest balance operation
+    self.balancing = None
     # For long-running remote tasks, such as transfers. Each operation is a
     # dictionary with state and original parameters.
     self.operations = {}
     self.op_counter = 0
-    # This protects writing: self.state, state of each self.instances,
-    # self.live_slaves
+    # Timeline of the launch
+    self.tracer = tracing.Tracer()
+    # The load on each instance, from their heartbeats
+    self.resources = resources.ResourceMonitor()
+    # Spreads HDFS reads across instances
+    self.reads = Counter()
+    # This protects the warm pool, operations, jobs and HadoopMonitor data.
+    # self.store looks after its own state.
     self.cv = threading.Condition()
     # This is data forwarded to us about the status of the JobTracker
     self.latest_data = {}
     self.last_update = 0
+    # The jobs HadoopMonitor told us about, by Hadoop job ID, and the number of
+    # the last update merged into them
+    self.hadoop_jobs = {}
+    self.hadoop_seq = 0
+    # Recent history of that data, for /status/history
+    self.history = timeseries.History()
+    # Recent versions of dashboard(), for /status/changes
+    self.dashboards = collections.deque(maxlen=cfg.dashboard_versions)
+    self.dashboard_version = 0
+    # Jobs submitted through the coordinator, by our own job ID. Only
+    # cfg.max_concurrent_jobs drivers run at once; the rest wait in job_queue.
+    self.jobs = {}
+    self.job_queue = collections.deque()
+    self.job_counter = 0
+    self.running_jobs = 0
+    # When each RUNNING job was first missing from the JobTracker's snitch
+    self.jobs_missing = {}
+    # The Hadoop settings generated at launch
+    self.hadoop_conf = None
+    # The boot ID each instance had when it reached HADOOP_READY. A new one
+    # means the instance was reset and its daemons are gone.
+    self.boot_ids = {}
+    thread = threading.Thread(target=self.watch_reboots)
+    thread.daemon = True
+    thread.start()
+    thread = threading.Thread(target=self.watch_jobs)
+    thread.daemon = True
+    thread.start()
+
+  @property
+  def state(self):
+    return self.store.cluster
+
+  @property
+  def instances(self):
+    return self.store.instances
 
   # Simple communication with instances
 
-  def update_state(self, instance, state):
-    with self.cv:
-      if instance == 'cluster':
-        old = self.state
-        self.state = state
-        if old != state:
-          logging.info('Cluster now %s', state[1])
-      else:
-        old = None
-        if instance in self.instances:
-          old = self.instances[instance]
-        self.instances[instance] = state
-        if state != old:
-          logging.info('%s now %s', instance, state[1])
+  def update_state(self, instance, state, expected=None):
+    """Move the cluster or an instance to state.
+
+    Args:
+      instance: an instance name, or 'cluster'
+      state: the new state
+      expected: only change an instance that's in this state
+
+    Returns:
+      Whether the change was allowed.
+    """
+    if instance == 'cluster':
+      old = self.store.set_cluster(state)
+      if old is None:
+        return False
+      if old != state:
+        logging.info('Cluster now %s', state[1])
+        self.tracer.state(tracing.CLUSTER, state[1],
+                          final=state in (CluserState.READY,
+                                          CluserState.BROKEN,
+                                          CluserState.DOWN))
+      return True
+    ok, old = self.store.set_instance(instance, state, expected)
+    if ok and state != old:
+      logging.info('%s now %s', instance, state[1])
+      self.tracer.state(instance, state[1],
+                        final=state in (InstanceState.HADOOP_READY,
+                                        InstanceState.BROKEN))
+    return ok
+
+  def instance_ready(self, name):
+    """A predicate for StateStore.wait_for()."""
+    return lambda: self.store.get(name) == InstanceState.HADOOP_READY
 
   # All about launching
 
-  def launch(self, num_slaves):
-    """Schedules the launch sequence in the background."""
+  def launch(self, num_slaves, conf_overrides=None):
+    """Schedules the launch sequence in the background.
+
+    Args:
+      num_slaves: how many slaves to start with
+      conf_overrides: a dictionary of Hadoop properties that take precedence
+        over the ones generated for the machine type
+    """
     if self.state == CluserState.DOWN:
-      self.other_scheduler.schedule(self.launch_sequence, (num_slaves,))
       # Don't race and let two launch requests come in
       self.update_state('cluster', CluserState.DOWNLOADING)
+      self.other_scheduler.schedule(self.launch_sequence,
+                                    (num_slaves, conf_overrides))
       return True
     else:
       return False
 
-  def launch_sequence(self, num_slaves):
+  def launch_sequence(self, num_slaves, conf_overrides):
     """Mirror the Hadoop binary, then launch instances."""
     # Push Hadoop binary
-    subprocess.call(['wget', 'http://{0}/{1}/{1}.tar.gz'.format(cfg.hadoop_url,
-                                                                cfg.hadoop_fn)])
-    subprocess.call(['gsutil', 'cp', cfg.hadoop_fn + '.tar.gz',
-                     cfg.gs_hadoop_tarball])
+    with self.tracer.span(tracing.CLUSTER, 'mirror_hadoop'):
+      subprocess.call(['wget', 'http://{0}/{1}/{1}.tar.gz'.format(
+          cfg.hadoop_url, cfg.hadoop_fn)])
+      subprocess.call(['gsutil', 'cp', cfg.hadoop_fn + '.tar.gz',
+                       cfg.gs_hadoop_tarball])
 
-    # Push Hadoop config
-    subprocess.call('tar czf hadoop-conf.tgz hadoop/conf/*', shell=True)
-    subprocess.call(['gsutil', 'cp', 'hadoop-conf.tgz', cfg.gs_hadoop_conf])
-    subprocess.call(['rm', '-f', 'hadoop-conf.tgz'])
+    # Push Hadoop config tuned for our machine type
+    with self.tracer.span(tracing.CLUSTER, 'push_conf'):
+      try:
+        self.hadoop_conf = hadoop_conf.push(num_slaves, conf_overrides)
+      except subprocess.CalledProcessError as e:
+        logging.error('Could not push the Hadoop config: %s', e)
+        self.update_state('cluster', CluserState.BROKEN)
+        return
 
     # Push jar with tools that the NameNode needs
-    subprocess.call(['gsutil', 'cp', 'hadoop-tools.jar', cfg.gs_tools_jar])
+    with self.tracer.span(tracing.CLUSTER, 'push_tools'):
+      subprocess.call(['gsutil', 'cp', 'hadoop-tools.jar', cfg.gs_tools_jar])
 
     # Launch instances
     self.update_state('cluster', CluserState.LAUNCHING)
@@ -127,10 +667,15 @@ class HadoopCluster(object):
     self.update_state(cfg.hadoop_jobtracker, InstanceState.NON_EXISTENT)
     self.spawn_scheduler.schedule(self.launch_nn, ())
     self.spawn_scheduler.schedule(self.launch_jt, ())
-    self.add_slaves(num_slaves)
+    self.queue_slaves(num_slaves)
+    self.refill_pool()
 
   def spawn_instance(self, name, snitch):
-    """Create an instance with the specified snitch."""
+    """Create an instance with the specified snitch.
+
+    Returns:
+      True if the insert went through, False if the API refused it.
+    """
     disks = []
     if cfg.disk:
       # Can't mount rw if others have already mounted it ro... so just only
@@ -153,51 +698,56 @@ class HadoopCluster(object):
       scope = cfg.rw_storage_scope
     else:
       scope = cfg.ro_storage_scope
+    # The instance reports the steps of its startup under this ID
+    trace_id = self.tracer.new_trace(name)
     try:
-      resp = util.api.insert_instance(
-          name=name, zone=cfg.zone,
-          machineType=cfg.machine_type, image=cfg.image,
-          serviceAccounts=gce_shortcuts.service_accounts([scope]),
-          disks=disks,
-          metadata=gce_shortcuts.metadata({
-              # Key modified to avoid dots, which are disallowed in v1beta13.
-              'gs_bucket': cfg.gs_bucket,
-              'snitch-tarball_tgz': cfg.gs_snitch_tarball,
-              'startup-script': open('start_setup.sh').read(),
-              'bootstrap_sh': open('hadoop/bootstrap.sh').read(),
-              'snitch_py': open(snitch).read()
-          }),
-          networkInterfaces=network,
-          blocking=True
-      )
+      with self.tracer.span(name, 'insert_instance'):
+        resp = util.api.insert_instance(
+            name=name, zone=cfg.zone,
+            machineType=cfg.machine_type, image=cfg.image,
+            serviceAccounts=gce_shortcuts.service_accounts([scope]),
+            disks=disks,
+            metadata=gce_shortcuts.metadata({
+                # Key modified to avoid dots, which are disallowed in v1beta13.
+                'gs_bucket': cfg.gs_bucket,
+                'snitch-tarball_tgz': cfg.gs_snitch_tarball,
+                'startup-script': open('start_setup.sh').read(),
+                'bootstrap_sh': open('hadoop/bootstrap.sh').read(),
+                'snitch_py': open(snitch).read(),
+                'trace_id': trace_id
+            }),
+            networkInterfaces=network,
+            blocking=True
+        )
     except gce.GceError as e:
       logging.info('GCE exception inserting instance ' + name + ': ' + str(e))
+      return False
     except Exception as e:
       logging.info('exception inserting instance ' + name + ': ' + str(e))
+      return False
+    if getattr(resp, 'error', None):
+      logging.info('error inserting instance %s: %s', name, resp.error)
+      return False
     return True
 
   def new_slave_names(self, num):
     # Callers should assume these slaves will be created
-    start = self.first_free_slave
-    self.first_free_slave = start + num
+    start = self.first_free_slave.add(num) - num
     return ['hadoop-slave-{0:03d}'.format(x) for x in range(start, start + num)]
 
   def masters_up(self):
-    result = False
-    with self.cv:
-      nn = self.instances[cfg.hadoop_namenode] == InstanceState.HADOOP_READY
-      jt = self.instances[cfg.hadoop_jobtracker] == InstanceState.HADOOP_READY
-      result = nn and jt
-    return result
+    return (self.instance_ready(cfg.hadoop_namenode)() and
+            self.instance_ready(cfg.hadoop_jobtracker)())
 
   def start_slave(self, name):
     assert self.masters_up()
-    util.checked_do(name, '/start', {})
-    with self.cv:
-      self.update_state(name, InstanceState.HADOOP_READY)
-      self.live_slaves += 1
-      if self.live_slaves >= cfg.needed_slaves:
-        self.update_state('cluster', CluserState.READY)
+    with self.tracer.span(name, 'start_daemons'):
+      util.checked_do(name, '/start', {})
+    self.boot_ids[name] = util.get_boot_id(name)
+    if not self.update_state(name, InstanceState.HADOOP_READY):
+      return
+    if self.live_slaves.add(1) >= cfg.needed_slaves:
+      self.update_state('cluster', CluserState.READY)
 
   def launch_nn(self):
     """Create and monitor the instance running the NameNode."""
@@ -212,10 +762,9 @@ class HadoopCluster(object):
       self.update_state('cluster', CluserState.BROKEN)
       return
 
-    with self.cv:
-      # As part of the namenode's startup, it actually gets Hadoop running
-      self.update_state(cfg.hadoop_namenode, InstanceState.HADOOP_READY)
-      self.cv.notifyAll()
+    self.boot_ids[cfg.hadoop_namenode] = util.get_boot_id(cfg.hadoop_namenode)
+    # As part of the namenode's startup, it actually gets Hadoop running
+    self.update_state(cfg.hadoop_namenode, InstanceState.HADOOP_READY)
 
   def launch_jt(self):
     """Create and monitor the instance running the Jobtracker.
@@ -233,27 +782,32 @@ class HadoopCluster(object):
                                  InstanceState.SNITCH_READY):
       self.update_state('cluster', CluserState.BROKEN)
       return
-    with self.cv:
-      while self.instances[cfg.hadoop_namenode] != InstanceState.HADOOP_READY:
-        self.cv.wait()
-    util.checked_do(cfg.hadoop_jobtracker, '/start', {})
+    self.store.wait_for(self.instance_ready(cfg.hadoop_namenode))
+    with self.tracer.span(cfg.hadoop_jobtracker, 'start_daemons'):
+      util.checked_do(cfg.hadoop_jobtracker, '/start', {})
+    self.boot_ids[cfg.hadoop_jobtracker] = util.get_boot_id(
+        cfg.hadoop_jobtracker)
     self.update_state(cfg.hadoop_jobtracker, InstanceState.HADOOP_READY)
     # Fork off and start our Java Hadoop monitor
     util.bg_exec(
         ['java', '-cp', 'hadoop-tools.jar', 'com.google.HadoopMonitor'],
         '/home/hadoop/monitor_log'
     )
-    with self.cv:
-      self.cv.notifyAll()
 
   def launch_slave1(self, name):
-    """Create the slave, then move to a different queue to finish."""
+    """Create the slave, then move to a different queue to finish.
+
+    Returns:
+      False if the instance couldn't be inserted.
+    """
     if self.spawn_instance(name, 'hadoop/slave_snitch.py'):
       # Assume they're at least in this state. If we shove them on the
       # other_scheduler's queue and we don't get to them for a while, it appears
       # as if we haven't even started the instance yet
       self.update_state(name, InstanceState.PROVISIONING)
       self.other_scheduler.schedule(self.launch_slave2, (name,))
+      return True
+    return False
 
   def launch_slave2(self, name):
     """Check to see if the slave's Hadoop daemons can be started yet."""
@@ -268,8 +822,22 @@ class HadoopCluster(object):
       self.update_state(name, status)
       if status == InstanceState.BROKEN:
         self.instance_fail(name, err)
+        with self.cv:
+          filling = name in self.pool_filling
+          self.pool_filling.discard(name)
+        if filling:
+          self.other_scheduler.schedule(self.refill_pool, ())
         return
 
+    # Warm pool slaves wait at SNITCH_READY until add_slaves takes them
+    if self.instances[name] == InstanceState.SNITCH_READY:
+      with self.cv:
+        if name in self.pool_filling:
+          self.pool_filling.discard(name)
+          self.warm_pool.add(name)
+          logging.info('%s is warm', name)
+          return
+
     # Are masters up?
     if self.instances[name] == InstanceState.SNITCH_READY:
       if self.masters_up():
@@ -280,6 +848,44 @@ class HadoopCluster(object):
     # If we fall-through, schedule it for later
     self.other_scheduler.schedule(self.launch_slave2, (name,))
 
+  # Noticing instances that were reset
+
+  def watch_reboots(self):
+    """Periodically check HADOOP_READY instances for a new boot ID."""
+    while True:
+      time.sleep(cfg.reboot_check_secs)
+      for name in self.store.names(InstanceState.HADOOP_READY):
+        self.other_scheduler.schedule(self.check_reboot, (name,))
+
+  def check_reboot(self, name):
+    boot_id = util.get_boot_id(name)
+    # The snitch may just be unreachable for a moment; only a different ID
+    # proves a reboot
+    if boot_id is None or boot_id == self.boot_ids.get(name):
+      return
+    if not self.update_state(name, InstanceState.RUNNING,
+                             expected=InstanceState.HADOOP_READY):
+      return
+    if name.startswith('hadoop-slave-'):
+      self.live_slaves.add(-1)
+    self.instance_fail(name, 'rebooted, rejoining the cluster')
+    if name.startswith('hadoop-slave-'):
+      # The same flow as a new slave: wait for the snitch, then /start
+      self.other_scheduler.schedule(self.launch_slave2, (name,))
+    else:
+      self.other_scheduler.schedule(self.rejoin_master, (name,))
+
+  def rejoin_master(self, name):
+    """Bring a rebooted NameNode or JobTracker back to HADOOP_READY."""
+    if not self.monitor_instance(name, InstanceState.SNITCH_READY):
+      self.update_state('cluster', CluserState.BROKEN)
+      return
+    # The NameNode restarts itself on boot
+    if name == cfg.hadoop_jobtracker:
+      util.checked_do(name, '/start', {})
+    self.boot_ids[name] = util.get_boot_id(name)
+    self.update_state(name, InstanceState.HADOOP_READY)
+
   # Returns True on success, False if BROKEN
   def monitor_instance(self, name, wait_for_state=InstanceState.RUNNING):
     """Blockingly poll an instance until it reaches the requested state."""
@@ -298,16 +904,72 @@ class HadoopCluster(object):
 
   # Other interactions with the cluster
 
-  def new_op(self):
-    name = 'xfer_{0}'.format(self.op_counter)
+  def hadoop_update(self, update):
+    """Merge an update about the JobTracker from HadoopMonitor.
+
+    Updates carry only the jobs that changed since the update in 'base', which
+    the coordinator acknowledged earlier. A base of 0 means a full update.
+
+    Returns:
+      The reply for HadoopMonitor: {'ack': seq} once merged, or {'resync':
+      True} if we don't have the base (say, after the coordinator restarted).
+    """
+    with self.cv:
+      seq = update.pop('seq', None)
+      base = update.pop('base', 0)
+      if seq is None or base == 0:
+        jobs = {}
+      elif base <= self.hadoop_seq:
+        jobs = self.hadoop_jobs
+      else:
+        logging.info('HadoopMonitor update %s needs %s, only have %s', seq,
+                     base, self.hadoop_seq)
+        return {'resync': True}
+      for job in update.pop('jobs', None) or []:
+        jobs[job['id']] = job
+      for job_id in update.pop('removed', None) or []:
+        jobs.pop(job_id, None)
+      self.hadoop_jobs = jobs
+      self.hadoop_seq = seq or 0
+
+      now = time.time()
+      for job in jobs.values():
+        set_elapsed(job, now)
+      update['jobs'] = [jobs[job_id] for job_id in sorted(jobs)]
+      self.latest_data = update
+      self.last_update = now
+      self.cv.notifyAll()
+    self.history.record(now, update)
+    return {'ack': seq}
+
+  def new_op(self, kind='xfer'):
+    name = '{0}_{1}'.format(kind, self.op_counter)
     self.op_counter += 1
     self.operations[name] = {'operation': name, 'state': 'Requested'}
     return name
 
   def op_status(self, name, msg):
-    self.operations[name]['state'] = msg
+    with self.cv:
+      self.operations[name]['state'] = msg
+      self.cv.notifyAll()
     logging.info('%s: %s', name, msg)
 
+  def wait_for_op(self, name, last_state, timeout):
+    """Block until the operation's state differs from last_state.
+
+    Returns:
+      The operation, once its state changed or timeout passed.
+    """
+    deadline = time.time() + min(timeout, cfg.job_wait_max_secs)
+    with self.cv:
+      op = self.operations.get(name)
+      while op and op['state'] == last_state and not op_finished(op):
+        left = deadline - time.time()
+        if left <= 0:
+          break
+        self.cv.wait(left)
+    return op
+
   def transfer(self, src, dst):
     # returns None if there's a problem, otherwise the operation name to poll
     if self.state != CluserState.READY:
@@ -319,37 +981,656 @@ class HadoopCluster(object):
                                                        'operation': op})
     return self.operations[op]
 
-  def submit_job(self, jar, job_args):
-    if self.state == CluserState.READY:
-      util.checked_do(cfg.hadoop_jobtracker, '/job/start',
-                      {'jar': jar, 'args': json.dumps(job_args)})
-      return True
-    else:
-      return False
+  # The job queue
 
-  def clean_hdfs(self, path):
-    """Recursively deletes files from a HDFS path."""
-    util.checked_do(cfg.hadoop_namenode, '/clean', {'path': path})
-    return True
+  def submit_job(self, jar, job_args, jar_hash=None):
+    """Queue a job. jar may be empty if jar_hash is in the JAR cache.
+
+    Returns:
+      None if the job can't be accepted, otherwise the job's record.
+    """
+    if self.state != CluserState.READY:
+      return None
+    if not jar and not (jar_hash and self.has_jar(jar_hash)):
+      return None
+    with self.cv:
+      job_id = 'job_{0}'.format(self.job_counter)
+      self.job_counter += 1
+      self.jobs[job_id] = {'job_id': job_id, 'jar': jar, 'jar_hash': jar_hash,
+                           'args': job_args, 'state': 'QUEUED',
+                           'exit_code': None, 'hadoop_jobs': [],
+                           'submitted': time.time(), 'started': None,
+                           'finished': None}
+      self.job_queue.append(job_id)
+    logging.info('%s queued: %s %s', job_id, jar or jar_hash, job_args)
+    self.dispatch_jobs()
+    return self.jobs[job_id]
+
+  def dispatch_jobs(self):
+    """Start queued jobs while fewer than cfg.max_concurrent_jobs run."""
+    with self.cv:
+      starting = []
+      while self.job_queue and self.running_jobs < cfg.max_concurrent_jobs:
+        job = self.jobs[self.job_queue.popleft()]
+        job['state'] = 'STARTING'
+        job['started'] = time.time()
+        self.running_jobs += 1
+        starting.append(job)
+      if starting:
+        self.cv.notifyAll()
+    for job in starting:
+      self.other_scheduler.schedule(self.start_job, (job,))
+
+  def start_job(self, job):
+    data = {'job_id': job['job_id'], 'jar': job['jar'],
+            'args': json.dumps(job['args'])}
+    if job['jar_hash']:
+      data['jar_hash'] = job['jar_hash']
+    try:
+      util.checked_do(cfg.hadoop_jobtracker, '/job/start', data)
+    except Exception as e:
+      self.job_done(job['job_id'], None, [], str(e))
+      return
+    with self.cv:
+      # Short jobs could have been reported done already
+      if job['state'] == 'STARTING':
+        job['state'] = 'RUNNING'
+    logging.info('%s running', job['job_id'])
+
+  def job_done(self, job_id, exit_code, hadoop_jobs, reason=None):
+    """The JobTracker's snitch reports a job driver exited."""
+    with self.cv:
+      job = self.jobs.get(job_id)
+      if job is None:
+        logging.warn('Report for unknown job %s', job_id)
+        return
+      if job['finished'] is not None:
+        return
+      job['state'] = 'SUCCEEDED' if exit_code == 0 else 'FAILED'
+      job['exit_code'] = exit_code
+      job['hadoop_jobs'] = hadoop_jobs
+      job['finished'] = time.time()
+      if reason:
+        job['reason'] = reason
+      self.running_jobs -= 1
+      self.cv.notifyAll()
+      # The JAR the client staged in GS for this job, unless a job still to
+      # finish needs it too
+      staged = None
+      if cfg.gs_jar_cache and job['jar'].startswith(cfg.gs_jar_cache):
+        staged = job['jar']
+        for other in self.jobs.values():
+          if other['jar'] == staged and other['finished'] is None:
+            staged = None
+            break
+    logging.info('%s %s (exit code %s, Hadoop jobs %s) %s', job_id,
+                 job['state'], exit_code, hadoop_jobs, reason or '')
+    if staged:
+      self.other_scheduler.schedule(subprocess.call,
+                                    (['gsutil', 'rm', staged],))
+    self.dispatch_jobs()
+
+  def watch_jobs(self):
+    """Periodically check the RUNNING jobs against the JobTracker's snitch.
+
+    Picks up the reports the snitch couldn't deliver, and fails the jobs it
+    hasn't known about for cfg.job_lost_secs, such as after a reboot.
+    """
+    while True:
+      time.sleep(cfg.job_check_secs)
+      with self.cv:
+        running = [job_id for job_id, job in self.jobs.items()
+                   if job['state'] == 'RUNNING']
+      if not running:
+        self.jobs_missing.clear()
+        continue
+      try:
+        result = util.checked_do(cfg.hadoop_jobtracker, '/job/running', {})
+      except Exception as e:
+        logging.warn('Could not check the running jobs: %s', e)
+        continue
+      for job_id, report in result['finished'].items():
+        self.job_done(job_id, report['exit_code'], report['hadoop_jobs'],
+                      report['reason'])
+      now = time.time()
+      known = set(result['running']) | set(result['finished'])
+      for job_id in list(self.jobs_missing):
+        if job_id not in running or job_id in known:
+          del self.jobs_missing[job_id]
+      for job_id in running:
+        if job_id in known:
+          continue
+        missing = self.jobs_missing.setdefault(job_id, now)
+        if now - missing >= cfg.job_lost_secs:
+          del self.jobs_missing[job_id]
+          self.job_done(job_id, None, [], 'lost by the JobTracker')
+
+  def wait_for_job(self, job_id, timeout):
+    """Block until the job finishes or timeout passes. Returns its record."""
+    deadline = time.time() + min(timeout, cfg.job_wait_max_secs)
+    with self.cv:
+      job = self.jobs.get(job_id)
+      while job and job['finished'] is None:
+        left = deadline - time.time()
+        if left <= 0:
+          break
+        self.cv.wait(left)
+    return job
+
+  def job_log(self, job_id, offset, max_bytes, timeout):
+    """Read a job driver's output from offset, through the JobTracker.
+
+    Waits up to timeout seconds for the job to leave the queue and say
+    something.
+
+    Returns:
+      None for an unknown job, otherwise {'data', 'offset' after data, 'size'
+      of the log so far, 'state' of the job}
+    """
+    timeout = min(timeout, cfg.job_log_wait_secs)
+    deadline = time.time() + timeout
+    with self.cv:
+      job = self.jobs.get(job_id)
+      if job is None:
+        return None
+      while job['state'] == 'QUEUED' and time.time() < deadline:
+        self.cv.wait(deadline - time.time())
+      state = job['state']
+    result = {'data': '', 'offset': offset, 'size': 0}
+    left = max(0, deadline - time.time())
+    if state != 'QUEUED':
+      # Leave the request to the snitch time to wait out left
+      result = util.checked_do(cfg.hadoop_jobtracker, '/job/log',
+                               {'job_id': job_id, 'offset': offset,
+                                'max_bytes': max_bytes, 'timeout': left},
+                               timeout=left + 10)
+    result['state'] = state
+    return result
+
+  def job_summary(self):
+    states = collections.defaultdict(int)
+    for job in self.jobs.values():
+      states[job['state']] += 1
+    return dict(states)
+
+  def has_jar(self, jar_hash):
+    """Does the JobTracker already have this JAR cached?"""
+    result = util.checked_do(cfg.hadoop_jobtracker, '/job/has_jar',
+                             {'jar_hash': jar_hash})
+    return result['cached']
+
+  def clean_hdfs(self, paths, skip_trash=False):
+    """Recursively deletes HDFS paths or globs in the background.
+
+    Returns:
+      None if there's a problem, otherwise the operation to poll.
+    """
+    if self.state != CluserState.READY or not paths:
+      return None
+    op = self.new_op('clean')
+    self.operations[op]['paths'] = paths
+    try:
+      util.checked_do(cfg.hadoop_namenode, '/clean',
+                      {'paths': json.dumps(paths), 'operation': op,
+                       'skip_trash': 'true' if skip_trash else 'false'})
+    except Exception as e:
+      self.op_status(op, 'Error: {0}'.format(e))
+    return self.operations[op]
+
+  # Chunked uploads, relayed to the NameNode
+
+  def start_upload(self, upload_id, dst, size, chunk_bytes):
+    """Have the NameNode expect a file in chunks.
+
+    Returns:
+      None if there's a problem, otherwise the NameNode's reply, listing the
+      'chunks' it already has so an interrupted upload can resume.
+    """
+    if self.state != CluserState.READY:
+      return None
+    return util.checked_do(cfg.hadoop_namenode, '/upload/start',
+                           {'upload_id': upload_id, 'dst': dst, 'size': size,
+                            'chunk_bytes': chunk_bytes})
+
+  def upload_chunk(self, params, data):
+    """Pass one chunk on to the NameNode. Returns its reply, or None."""
+    address = cfg.hadoop_namenode
+    if cfg.ip_via_api:
+      address = util.name_to_ip(address)
+    return util.send_data(address, '/upload/chunk', params, data)
+
+  def finish_upload(self, upload_id):
+    """Have the NameNode write the assembled file into HDFS.
+
+    Returns:
+      None if there's a problem, otherwise the operation to poll.
+    """
+    if self.state != CluserState.READY:
+      return None
+    op = self.new_op('upload')
+    self.operations[op]['upload_id'] = upload_id
+    try:
+      util.checked_do(cfg.hadoop_namenode, '/upload/finish',
+                      {'upload_id': upload_id, 'operation': op})
+    except Exception as e:
+      # Most likely chunks are missing; the client can resume and retry
+      self.op_status(op, 'Error: {0}'.format(e))
+    return self.operations[op]
+
+  # Streaming downloads, through any instance running Hadoop
+
+  def hdfs_reader(self):
+    """Pick the next ready instance to read HDFS through, round-robin."""
+    ready = sorted(self.store.names(InstanceState.HADOOP_READY))
+    if not ready:
+      return None
+    return ready[self.reads.add(1) % len(ready)]
+
+  def list_hdfs(self, path):
+    """Returns the files matching an HDFS path or glob, or None."""
+    reader = self.hdfs_reader()
+    if self.state != CluserState.READY or reader is None:
+      return None
+    result = util.talk_to_agent(reader, '/hdfs/list', {'path': path},
+                                timeout=60)
+    if result is None or result['result'] != 'ok':
+      return None
+    return result['files']
+
+  def read_hdfs(self, path):
+    """Stream an HDFS file.
+
+    Returns:
+      None if there's a problem, otherwise a generator of blocks of the file,
+      read from an instance as they're needed.
+    """
+    reader = self.hdfs_reader()
+    if self.state != CluserState.READY or reader is None:
+      return None
+    resp = util.open_stream(reader, '/hdfs/read', {'path': path})
+    if resp is None:
+      return None
+
+    def blocks():
+      try:
+        while True:
+          block = resp.read(cfg.download_block_bytes)
+          if not block:
+            break
+          yield block
+      finally:
+        resp.close()
+    return blocks()
+
+  def queue_slaves(self, num_slaves):
+    """Have the planner insert brand new slaves. Returns their names."""
+    slaves = self.new_slave_names(num_slaves)
+    # Initialize some state for them
+    for name in slaves:
+      self.update_state(name, InstanceState.NON_EXISTENT)
+    self.planner.enqueue(slaves)
+    return slaves
 
   def add_slaves(self, num_slaves):
+    """Start num_slaves more slaves, taking warm ones from the pool first."""
     if self.state >= CluserState.LAUNCHING:
-      slaves = self.new_slave_names(num_slaves)
-      # Initialize some state for them
-      for name in slaves:
-        self.update_state(name, InstanceState.NON_EXISTENT)
-        self.spawn_scheduler.schedule(self.launch_slave1, (name,))
+      with self.cv:
+        warm = [self.warm_pool.pop() for _ in
+                range(min(num_slaves, len(self.warm_pool)))]
+        self.pool_hits += len(warm)
+        self.pool_misses += num_slaves - len(warm)
+      if warm:
+        logging.info('Took %s slaves from the warm pool', len(warm))
+      for name in warm:
+        # They're SNITCH_READY, so this starts them as soon as masters are up
+        self.other_scheduler.schedule(self.launch_slave2, (name,))
+      added = list(warm)
+      if num_slaves > len(warm):
+        added += self.queue_slaves(num_slaves - len(warm))
+      self.other_scheduler.schedule(self.refill_pool, ())
+      if cfg.auto_balance:
+        with self.cv:
+          self.unbalanced.update(added)
+        # This mostly waits, so don't tie up a scheduler worker
+        thread = threading.Thread(target=self.balance_after,
+                                  args=(self.scale_ups.add(1),))
+        thread.daemon = True
+        thread.start()
       return True
     else:
       return False
 
+  def balance_after(self, scale_up):
+    """Start the HDFS balancer once the slaves of the scale-ups have settled.
+
+    That's every slave added since a balance last ran. They've settled once
+    each is running Hadoop, broken or gone, and no other scale-up came along in
+    the next cfg.balance_settle_secs. A later scale-up balances for the earlier
+    ones too, even if none of its own slaves join.
+    """
+    with self.cv:
+      names = list(self.unbalanced)
+    self.store.wait_for(
+        lambda: all(self.store.get(name) in SETTLED_STATES for name in names),
+        timeout=cfg.balance_wait_max_secs)
+    time.sleep(cfg.balance_settle_secs)
+    if self.scale_ups.value != scale_up:
+      return
+    joined = [name for name in names
+              if self.store.get(name) == InstanceState.HADOOP_READY]
+    if not joined:
+      return
+    logging.info('%s new slaves settled, balancing HDFS', len(joined))
+    self.balance()
+
+  def balance(self):
+    """Run the HDFS balancer in the background, unless it's already running.
+
+    Returns:
+      None if the cluster isn't ready, otherwise the operation to poll.
+    """
+    if self.state != CluserState.READY:
+      return None
+    with self.cv:
+      if self.balancing and not op_finished(self.operations[self.balancing]):
+        return self.operations[self.balancing]
+      op = self.new_op('balance')
+      self.balancing = op
+      # This balance covers the slaves that settled; the rest wait for the
+      # next one
+      self.unbalanced = set(name for name in self.unbalanced
+                            if self.store.get(name) not in SETTLED_STATES)
+    slaves = len([name for name in self.store.names(InstanceState.HADOOP_READY)
+                  if name.startswith('hadoop-slave-')])
+    bandwidth = balance_bandwidth(slaves)
+    self.operations[op].update({'slaves': slaves,
+                                'bytes_per_sec': bandwidth})
+    try:
+      util.checked_do(cfg.hadoop_namenode, '/balance',
+                      {'operation': op, 'bandwidth': bandwidth,
+                       'threshold': cfg.balance_threshold})
+    except Exception as e:
+      self.op_status(op, 'Error: {0}'.format(e))
+    return self.operations[op]
+
+  def set_pool_size(self, size):
+    """Change the warm pool's target, deleting any warm slaves beyond it."""
+    with self.cv:
+      self.pool_size = size
+      surplus = [self.warm_pool.pop()
+                 for _ in range(max(0, len(self.warm_pool) - size))]
+      for name in surplus:
+        self.update_state(name, InstanceState.DOOMED)
+    for name in surplus:
+      self.other_scheduler.schedule(self.nix, (name,))
+    if self.state >= CluserState.LAUNCHING:
+      self.other_scheduler.schedule(self.refill_pool, ())
+    return True
+
+  def refill_pool(self):
+    """Insert slaves to bring the warm pool back up to its target size.
+
+    Pool slaves go through the normal launch, but stop at SNITCH_READY: Hadoop
+    is installed, but the DataNode and TaskTracker aren't started.
+    """
+    with self.cv:
+      missing = self.pool_size - len(self.warm_pool) - len(self.pool_filling)
+      if missing <= 0:
+        return
+      slaves = self.queue_slaves(missing)
+      self.pool_filling.update(slaves)
+    logging.info('Refilling the warm pool with %s slaves', missing)
+
+  def pool_status(self):
+    with self.cv:
+      requested = self.pool_hits + self.pool_misses
+      return {'target': self.pool_size,
+              'ready': len(self.warm_pool),
+              'filling': len(self.pool_filling),
+              'hits': self.pool_hits,
+              'misses': self.pool_misses,
+              'hit_rate': (float(self.pool_hits) / requested
+                           if requested else None)}
+
+  def slave_counts(self):
+    """Returns (slaves in HADOOP_READY, slaves still on their way there)."""
+    live = starting = 0
+    with self.cv:
+      for name, state in self.store.instances.items():
+        if (not name.startswith('hadoop-slave-') or name in self.warm_pool or
+            name in self.pool_filling):
+          continue
+        if state == InstanceState.HADOOP_READY:
+          live += 1
+        elif InstanceState.NON_EXISTENT <= state < InstanceState.HADOOP_READY:
+          starting += 1
+    return (live, starting)
+
+  def remove_slaves(self, num_slaves=None, names=None):
+    """Gracefully decommissions and deletes slaves in the background.
+
+    Args:
+      num_slaves: remove this many of the newest live slaves
+      names: or, remove exactly these slaves
+
+    Returns:
+      None if nothing can be removed, otherwise the operation to poll. The
+      cluster always keeps cfg.needed_slaves slaves.
+    """
+    # Two removals at once mustn't both count the same live slaves
+    with self.cv:
+      live = sorted(name for name in
+                    self.store.names(InstanceState.HADOOP_READY)
+                    if name.startswith('hadoop-slave-'))
+      if names is None:
+        num_slaves = min(num_slaves, len(live) - cfg.needed_slaves)
+        doomed = live[len(live) - num_slaves:] if num_slaves > 0 else []
+      else:
+        doomed = [name for name in names if name in live]
+        if len(live) - len(doomed) < cfg.needed_slaves:
+          doomed = []
+      # A slave that was just reset isn't live anymore
+      doomed = [name for name in doomed
+                if self.update_state(name, InstanceState.DOOMED,
+                                     expected=InstanceState.HADOOP_READY)]
+      if not doomed:
+        return None
+    self.live_slaves.add(-len(doomed))
+
+    op = self.new_op('remove')
+    size = cfg.decommission_batch_size
+    batches = [doomed[i:i + size] for i in range(0, len(doomed), size)]
+    self.operations[op].update({'slaves': doomed, 'decommissioned': 0,
+                                'deleted': 0, 'failed': [],
+                                'queued_batches': batches})
+    self.op_status(op, 'Decommissioning {0} slaves in {1} batches'.format(
+        len(doomed), len(batches)))
+    for _ in range(min(cfg.decommission_parallel_batches, len(batches))):
+      self.other_scheduler.schedule(self.decommission_batch, (op,))
+    return self.operations[op]
+
+  def decommission_batch(self, op):
+    """Drain HDFS blocks and then MapReduce tasks off of the next batch.
+
+    The DataNodes go first; the NameNode re-replicates their blocks while the
+    TaskTrackers keep running tasks. TaskTrackers are only excluded once no
+    job is running (or after cfg.decommission_job_wait_secs), because the
+    JobTracker re-runs any task that was on an excluded TaskTracker. When a
+    batch finishes, it schedules the next one, so that at most
+    cfg.decommission_parallel_batches run at once. If a batch fails, it and
+    the batches that haven't started go back to HADOOP_READY.
+    """
+    state = self.operations[op]
+    with self.cv:
+      if not state['queued_batches']:
+        return
+      names = state['queued_batches'].pop(0)
+    hosts = json.dumps(names)
+    try:
+      util.checked_do(cfg.hadoop_namenode, '/decommission', {'hosts': hosts})
+      deadline = time.time() + cfg.decommission_max_secs
+      while True:
+        result = util.checked_do(cfg.hadoop_namenode, '/decommission_status',
+                                 {'hosts': hosts})
+        # A host the NameNode doesn't list (or we couldn't resolve) may still
+        # hold the only copy of some blocks, so it isn't done either
+        waiting = sorted(name for name, status in result['hosts'].items()
+                         if status != 'Decommissioned')
+        if not waiting:
+          break
+        if time.time() > deadline:
+          raise Exception('{0} not decommissioned after {1}s'.format(
+              ', '.join(waiting), cfg.decommission_max_secs))
+        time.sleep(cfg.poll_delay_secs)
+
+      deadline = time.time() + cfg.decommission_job_wait_secs
+      while self.jobs_running() and time.time() < deadline:
+        time.sleep(cfg.poll_delay_secs)
+      util.checked_do(cfg.hadoop_jobtracker, '/decommission', {'hosts': hosts})
+    except Exception as e:
+      with self.cv:
+        names += sum(state['queued_batches'], [])
+        state['queued_batches'] = []
+      self.instance_fail(', '.join(names), 'decommission failed: {0}'.format(e))
+      # Put them back, so removing them can be tried again
+      restored = [name for name in names
+                  if self.update_state(name, InstanceState.HADOOP_READY,
+                                       expected=InstanceState.DOOMED)]
+      self.live_slaves.add(len(restored))
+      with self.cv:
+        state['failed'] += names
+      self.finish_removal(op)
+      return
+
+    with self.cv:
+      state['decommissioned'] += len(names)
+    self.op_status(op, 'Decommissioned {0}/{1} slaves'.format(
+        state['decommissioned'], len(state['slaves'])))
+    for name in names:
+      self.other_scheduler.schedule(self.nix_slave, (op, name))
+    self.other_scheduler.schedule(self.decommission_batch, (op,))
+
+  def nix_slave(self, op, name):
+    state = self.operations[op]
+    try:
+      self.nix(name)
+    except Exception as e:
+      self.instance_fail(name, 'delete failed: {0}'.format(e))
+      with self.cv:
+        state['failed'].append(name)
+    else:
+      with self.cv:
+        state['deleted'] += 1
+    self.finish_removal(op)
+
+  def finish_removal(self, op):
+    """Report a removal done once every slave was deleted or failed."""
+    state = self.operations[op]
+    with self.cv:
+      if state['deleted'] + len(state['failed']) != len(state['slaves']):
+        return
+    if state['failed']:
+      self.op_status(op, 'Error: could not remove {0}'.format(
+          ', '.join(sorted(state['failed']))))
+    else:
+      self.op_status(op, 'Done')
+
+  def jobs_running(self):
+    return any(job['status'] == 'RUNNING'
+               for job in self.latest_data.get('jobs', []))
+
   def nix(self, name):
-    util.api.delete_instance(name, blocking=True)
+    try:
+      util.api.delete_instance(name, blocking=True)
+    except Exception as e:
+      # Instances that were never inserted, or whose insert failed, can't be
+      # deleted, but they're as gone as a deleted one
+      if name in util.get_instance_names():
+        raise
+      logging.info('%s was already gone: %s', name, e)
+    with self.cv:
+      self.boot_ids.pop(name, None)
+      self.warm_pool.discard(name)
+      self.pool_filling.discard(name)
+    self.store.remove(name)
+    self.resources.forget(name)
+    self.tracer.forget(name)
+    if not self.store.instances and self.state == CluserState.DOOMED:
+      self.update_state('cluster', CluserState.DOWN)
+
+  # Tearing everything down
+
+  def teardown(self):
+    """Deletes every Hadoop instance in the background.
+
+    The cluster is DOOMED until the last instance is gone, then DOWN. The
+    coordinator itself is left for the caller to delete.
+
+    Returns:
+      The operation to poll.
+    """
+    # After a coordinator restart, we may not know of every instance
+    listed = [name for name in util.get_instance_names()
+              if name != cfg.coordinator]
+    unlaunched = self.planner.cancel()
+    with self.cv:
+      self.pool_size = 0
+      # Nothing will run the jobs still waiting
+      while self.job_queue:
+        job = self.jobs[self.job_queue.popleft()]
+        job.update({'state': 'FAILED', 'finished': time.time(),
+                    'reason': 'cluster torn down'})
+      self.cv.notifyAll()
+    # No new instances are added from here on
+    self.update_state('cluster', CluserState.DOOMED)
+    for name in unlaunched:
+      self.store.remove(name)
+    names = sorted(set(self.store.names()) | set(listed))
+    for name in names:
+      self.store.doom(name)
+    if not self.store.instances:
+      self.update_state('cluster', CluserState.DOWN)
+
+    op = self.new_op('teardown')
+    self.operations[op].update({'instances': names, 'deleted': 0,
+                                'failed': []})
+    if not names:
+      self.op_status(op, 'Done')
+      return self.operations[op]
+    self.op_status(op, 'Deleting {0} instances'.format(len(names)))
+    bucket = util.TokenBucket(cfg.teardown_deletes_per_sec, cfg.teardown_burst)
+    for name in names:
+      self.spawn_scheduler.schedule(self.teardown_instance, (op, name, bucket))
+    return self.operations[op]
+
+  def teardown_instance(self, op, name, bucket):
+    error = None
+    for _ in range(cfg.teardown_attempts):
+      bucket.take()
+      try:
+        self.nix(name)
+        error = None
+        break
+      except Exception as e:
+        error = str(e)
+        logging.warn('Deleting %s failed: %s', name, error)
+    if error:
+      self.instance_fail(name, 'delete failed: {0}'.format(error))
+    state = self.operations[op]
     with self.cv:
-      del self.instances[name]
-      if not self.instances:
-        assert self.state is CluserState.DOOMED
-        self.update_state('cluster', CluserState.DOWN)
+      if error:
+        state['failed'].append(name)
+      else:
+        state['deleted'] += 1
+      done = state['deleted'] + len(state['failed']) == len(state['instances'])
+    if not done:
+      self.op_status(op, 'Deleted {0}/{1} instances'.format(
+          state['deleted'], len(state['instances'])))
+    elif state['failed']:
+      self.op_status(op, 'Error: could not delete {0}'.format(
+          ', '.join(sorted(state['failed']))))
+    else:
+      self.op_status(op, 'Done')
 
   def status(self):
     # Don't need to lock; we're just reading
@@ -362,7 +1643,83 @@ class HadoopCluster(object):
     return {'instances': states.jsonify(),
             'summary': str(states),
             'state': self.state[1],
-            'errors': self.errors}
+            'errors': self.errors,
+            'launch': self.planner.status(),
+            'hadoop_conf': self.hadoop_conf,
+            'warm_pool': self.pool_status(),
+            'job_queue': self.job_summary(),
+            'balancer': self.balancing,
+            'resources': self.resources.summary(),
+            'autoscaler': self.autoscaler and self.autoscaler.status()}
+
+  def dashboard(self):
+    """A compact summary of the cluster for live displays."""
+    with self.cv:
+      counts = collections.defaultdict(int)
+      for state in self.store.instances.values():
+        counts[state[1]] += 1
+      transfers = {}
+      operations = {}
+      for name, op in self.operations.items():
+        if op_finished(op):
+          continue
+        progress = XFER_PROGRESS_RE.search(op['state'])
+        if progress:
+          transfers[name] = {'mb': int(progress.group(1)),
+                             'mb_per_sec': int(progress.group(2))}
+        else:
+          operations[name] = op['state']
+      jobs = {}
+      for job in self.latest_data.get('jobs', []):
+        if job['status'] in ('RUNNING', 'PREP'):
+          jobs[job['id']] = {'status': job['status'],
+                             'map': round(job['mapProgress'], 2),
+                             'reduce': round(job['reduceProgress'], 2)}
+      launch = self.planner.status()
+      rate = self.planner.insert_rate()
+      return {'state': self.state[1],
+              'instances': dict(counts),
+              'live_slaves': self.live_slaves.value,
+              'launch': {'pending': launch['pending'],
+                         'wave_size': launch['wave_size'],
+                         'per_min': rate and int(rate)},
+              'transfers': transfers,
+              'operations': operations,
+              'jobs': jobs,
+              'job_queue': self.job_summary(),
+              'flagged': self.resources.flagged(),
+              'errors': len(self.errors),
+              'last_error': self.errors[-1] if self.errors else None}
+
+  def changes(self, since, timeout):
+    """Block until dashboard() differs from version since, or timeout passes.
+
+    Returns:
+      {'version': the current version, 'full': True if since is too old to
+      diff against, 'changes': the whole dashboard if full, otherwise only what
+      changed, as diff() describes}
+    """
+    deadline = time.time() + min(timeout, cfg.job_wait_max_secs)
+    while True:
+      seen = self.store.version
+      with self.cv:
+        current = self.dashboard()
+        if not self.dashboards or self.dashboards[-1][1] != current:
+          self.dashboard_version += 1
+          self.dashboards.append((self.dashboard_version, current))
+        version = self.dashboard_version
+        old = dict(self.dashboards).get(since)
+      left = deadline - time.time()
+      if version != since or left <= 0:
+        break
+      # Wake on any change in the store, without taking the cluster lock for
+      # each one. Not everything else that shows up on the dashboard notifies,
+      # so look again every so often.
+      self.store.wait_for(lambda: self.store.version != seen,
+                          timeout=min(left, cfg.poll_delay_secs))
+    if old is None:
+      return {'version': version, 'full': True, 'changes': current}
+    return {'version': version, 'full': False, 'changes': diff(old, current)}
 
   # An instance had some problem that they want us to log.
   # They're not necessarily broken
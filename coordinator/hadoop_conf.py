@@ -0,0 +1,215 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generate Hadoop config tuned to the machine type of the cluster."""
+
+
+
+import logging
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+from xml.etree import ElementTree
+
+from cfg import cfg
+
+TEMPLATE_DIR = 'hadoop/conf'
+SITE_FILES = ['core-site.xml', 'hdfs-site.xml', 'mapred-site.xml']
+ROLES = ['namenode', 'jobtracker', 'slave']
+
+# Machine type -> (cores, memory in MB). The -d variants (with ephemeral disk)
+# share the profile of their base type.
+MACHINE_TYPES = {
+    'n1-standard-1': (1, 3840),
+    'n1-standard-2': (2, 7680),
+    'n1-standard-4': (4, 15360),
+    'n1-standard-8': (8, 30720),
+    'n1-highmem-2': (2, 13312),
+    'n1-highmem-4': (4, 26624),
+    'n1-highmem-8': (8, 53248),
+    'n1-highcpu-2': (2, 1843),
+    'n1-highcpu-4': (4, 3686),
+    'n1-highcpu-8': (8, 7373),
+}
+DEFAULT_MACHINE_TYPE = 'n1-standard-4'
+
+# Memory left for the OS, DataNode and TaskTracker on a slave, a third each
+SLAVE_RESERVED_MB = 1536
+# Bounds on the heap of a single map or reduce task
+MIN_TASK_HEAP_MB = 512
+MAX_TASK_HEAP_MB = 4096
+# Share of the machine the NameNode or JobTracker may use for its heap. The
+# rest is left for the snitch and the transfers or job drivers it runs.
+MASTER_HEAP_SHARE = 0.5
+
+
+def machine_shape(machine_type):
+  """Returns (cores, memory MB) of a machine type name or URL."""
+  name = os.path.basename(machine_type or '')
+  if name.endswith('-d'):
+    name = name[:-2]
+  if name not in MACHINE_TYPES:
+    logging.warn('Unknown machine type %s, assuming %s', machine_type,
+                 DEFAULT_MACHINE_TYPE)
+    name = DEFAULT_MACHINE_TYPE
+  return MACHINE_TYPES[name]
+
+
+def profile(machine_type, num_slaves):
+  """Pick Hadoop settings for a cluster of num_slaves of this machine type.
+
+  Returns:
+    A dictionary of Hadoop properties to values, and a dictionary of daemon
+    heap sizes (in MB) for each role.
+  """
+  cores, memory_mb = machine_shape(machine_type)
+
+  # One map slot per core and a reduce slot per two, as long as every task
+  # still gets a useful heap. highcpu shapes run out of memory first.
+  map_slots = cores
+  reduce_slots = max(1, cores / 2)
+  task_mb = max(memory_mb - SLAVE_RESERVED_MB, MIN_TASK_HEAP_MB)
+  while (map_slots + reduce_slots > 2 and
+         task_mb / (map_slots + reduce_slots) < MIN_TASK_HEAP_MB):
+    if map_slots > reduce_slots:
+      map_slots -= 1
+    else:
+      reduce_slots -= 1
+  # Every slave needs a reduce slot, or jobs with reducers never finish. When
+  # even two tasks don't fit, the slave runs one at a time instead: a job's
+  # reduces wait for all of its maps.
+  one_task = task_mb < 2 * MIN_TASK_HEAP_MB
+  if one_task:
+    heap_mb = task_mb
+  else:
+    heap_mb = task_mb / (map_slots + reduce_slots)
+  # Round down to a multiple of 128MB
+  heap_mb = max(MIN_TASK_HEAP_MB, min(MAX_TASK_HEAP_MB, heap_mb / 128 * 128))
+  # The sort buffer lives inside the task heap
+  sort_mb = min(heap_mb / 3, 1024)
+
+  # Masters field an RPC from every slave, so scale handlers with the log of
+  # the cluster size
+  handlers = int(max(10, min(200, 20 * math.log(max(num_slaves, 2)))))
+
+  props = {
+      'mapred.tasktracker.map.tasks.maximum': map_slots,
+      'mapred.tasktracker.reduce.tasks.maximum': reduce_slots,
+      'mapred.child.java.opts': '-Xmx{0}m'.format(heap_mb),
+      'io.sort.mb': sort_mb,
+      'fs.inmemory.size.mb': sort_mb,
+      'dfs.namenode.handler.count': handlers,
+      'mapred.job.tracker.handler.count': handlers,
+      'dfs.datanode.handler.count': max(3, cores * 2),
+      'tasktracker.http.threads': max(40, cores * 10),
+      'dfs.replication': max(1, min(cfg.hdfs_replication, num_slaves)),
+  }
+  if one_task:
+    props['mapred.reduce.slowstart.completed.maps'] = 1.0
+  master_heap = int(memory_mb * MASTER_HEAP_SHARE) / 128 * 128
+  heaps = {'namenode': master_heap, 'jobtracker': master_heap,
+           # The TaskTracker and DataNode each get their share of the reserve
+           'slave': SLAVE_RESERVED_MB / 3}
+  return (props, heaps)
+
+
+def site_file_for(prop, templates):
+  """Decide which *-site.xml a property belongs in."""
+  for fn, props in templates.items():
+    if prop in props:
+      return fn
+  if prop.startswith('dfs.'):
+    return 'hdfs-site.xml'
+  if prop.startswith('mapred.') or prop.startswith('tasktracker.'):
+    return 'mapred-site.xml'
+  return 'core-site.xml'
+
+
+def read_site_file(path):
+  """Returns an ordered list of (name, value) from a Hadoop *-site.xml."""
+  root = ElementTree.parse(path).getroot()
+  return [(prop.findtext('name'), prop.findtext('value'))
+          for prop in root.findall('property')]
+
+
+def write_site_file(path, props):
+  with open(path, 'w') as out:
+    out.write('<?xml version="1.0"?>\n')
+    out.write('<?xml-stylesheet type="text/xsl" href="configuration.xsl"?>\n')
+    out.write('\n<!-- Generated by the coordinator for {0} -->\n\n'.format(
+        cfg.machine_type))
+    out.write('<configuration>\n')
+    for name, value in props:
+      prop = ElementTree.Element('property')
+      ElementTree.SubElement(prop, 'name').text = name
+      ElementTree.SubElement(prop, 'value').text = str(value)
+      out.write('  {0}\n'.format(ElementTree.tostring(prop)))
+    out.write('</configuration>\n')
+
+
+def generate(conf_dir, role, props, heaps):
+  """Write a full hadoop/conf for one role into conf_dir."""
+  shutil.copytree(TEMPLATE_DIR, conf_dir)
+  templates = {}
+  for fn in SITE_FILES:
+    templates[fn] = read_site_file(os.path.join(TEMPLATE_DIR, fn))
+  names = dict((fn, [name for name, _ in props_list])
+               for fn, props_list in templates.items())
+
+  for prop, value in sorted(props.items()):
+    fn = site_file_for(prop, names)
+    entries = templates[fn]
+    for i, (name, _) in enumerate(entries):
+      if name == prop:
+        entries[i] = (name, value)
+        break
+    else:
+      entries.append((prop, value))
+  for fn in SITE_FILES:
+    write_site_file(os.path.join(conf_dir, fn), templates[fn])
+
+  with open(os.path.join(conf_dir, 'hadoop-env.sh'), 'a') as env:
+    env.write('\n# Set by the coordinator for the {0} role\n'.format(role))
+    env.write('export HADOOP_HEAPSIZE={0}\n'.format(heaps[role]))
+
+
+def push(num_slaves, overrides=None):
+  """Generate config for every role and push each to GS.
+
+  Args:
+    num_slaves: the size the cluster is launched with
+    overrides: a dictionary of Hadoop properties that win over the profile
+
+  Returns:
+    The settings used, so they can be reported.
+
+  Raises:
+    subprocess.CalledProcessError: if the config couldn't be packed or pushed
+  """
+  props, heaps = profile(cfg.machine_type, num_slaves)
+  props.update(overrides or {})
+  logging.info('Hadoop config for %s: %s', cfg.machine_type, props)
+  for role in ROLES:
+    tmp = tempfile.mkdtemp()
+    try:
+      generate(os.path.join(tmp, 'hadoop', 'conf'), role, props, heaps)
+      tarball = os.path.join(tmp, 'hadoop-conf.tgz')
+      subprocess.check_call(['tar', 'czf', tarball, '-C', tmp, 'hadoop'])
+      subprocess.check_call(['gsutil', 'cp', tarball,
+                             cfg.gs_hadoop_conf.format(role)])
+    finally:
+      shutil.rmtree(tmp)
+  return {'properties': props, 'daemon_heap_mb': heaps}
@@ -0,0 +1,136 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The load on each instance, from the heartbeats their snitches send."""
+
+
+
+import logging
+import threading
+import time
+
+from cfg import cfg
+
+# What a heartbeat carries, all percentages except the last three
+METRICS = ['cpu', 'iowait', 'steal', 'mem', 'disk', 'disk_free_gb',
+           'rx_mb_per_sec', 'tx_mb_per_sec']
+
+
+def median(values):
+  values = sorted(values)
+  middle = len(values) / 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+
+class ResourceMonitor(object):
+  """Keeps the latest heartbeat of each instance and flags the troubled ones.
+
+  An instance is flagged as:
+    disk_full: /mnt/hadoop is at least cfg.heartbeat_disk_full_pct full
+    hot: its CPU has been at least cfg.heartbeat_hot_margin_pct busier than
+      the median instance for cfg.heartbeat_flag_beats heartbeats in a row
+    slow: it's spent at least cfg.heartbeat_slow_wait_pct of its time waiting
+      on its disk or for the host's CPU (steal) for as many heartbeats
+    silent: it's missed cfg.heartbeat_silent_beats heartbeats
+  """
+
+  def __init__(self):
+    # Instance -> {'beat': latest heartbeat, 'time': when it came, 'hot' and
+    # 'slow': how many heartbeats in a row showed it, 'flags': as last logged}
+    self.nodes = {}
+    self.lock = threading.Lock()
+
+  def heartbeat(self, name, beat):
+    now = time.time()
+    with self.lock:
+      others = [node['beat']['cpu'] for other, node in self.nodes.items()
+                if other != name and not self.silent(node, now)]
+      node = self.nodes.setdefault(name, {'hot': 0, 'slow': 0, 'flags': []})
+      hot = bool(others) and (beat['cpu'] >= median(others) +
+                              cfg.heartbeat_hot_margin_pct)
+      node['hot'] = node['hot'] + 1 if hot else 0
+      slow = beat['iowait'] + beat['steal'] >= cfg.heartbeat_slow_wait_pct
+      node['slow'] = node['slow'] + 1 if slow else 0
+      node['beat'] = beat
+      node['time'] = now
+      flags = self.flags(node, now)
+      old = node['flags']
+      node['flags'] = flags
+    if flags and flags != old:
+      logging.warn('%s flagged %s: %s', name, ', '.join(flags), beat)
+
+  def forget(self, name):
+    with self.lock:
+      self.nodes.pop(name, None)
+
+  def silent(self, node, now):
+    return now - node['time'] > cfg.heartbeat_silent_beats * cfg.heartbeat_secs
+
+  def flags(self, node, now):
+    flags = []
+    if node['beat']['disk'] >= cfg.heartbeat_disk_full_pct:
+      flags.append('disk_full')
+    if node['hot'] >= cfg.heartbeat_flag_beats:
+      flags.append('hot')
+    if node['slow'] >= cfg.heartbeat_flag_beats:
+      flags.append('slow')
+    if self.silent(node, now):
+      flags.append('silent')
+    return flags
+
+  def flagged(self):
+    """Instance -> its flags, for every flagged instance."""
+    now = time.time()
+    with self.lock:
+      flagged = dict((name, self.flags(node, now))
+                     for name, node in self.nodes.items())
+    return dict((name, flags) for name, flags in flagged.items() if flags)
+
+  def instances(self):
+    """Instance -> its latest heartbeat, plus 'age_secs' and 'flags'."""
+    now = time.time()
+    result = {}
+    with self.lock:
+      for name, node in self.nodes.items():
+        result[name] = dict(node['beat'], flags=self.flags(node, now),
+                            age_secs=round(now - node['time'], 1))
+    return result
+
+  def summary(self):
+    """The cluster-wide view of the load and the flagged instances.
+
+    Each metric has its mean, its highest value and the instance with it.
+    Network throughput is also totalled. Silent instances are left out of the
+    numbers.
+    """
+    now = time.time()
+    with self.lock:
+      beats = dict((name, node['beat']) for name, node in self.nodes.items()
+                   if not self.silent(node, now))
+    result = {'reporting': len(beats), 'flagged': self.flagged()}
+    if not beats:
+      return result
+    for metric in METRICS:
+      busiest = max(beats, key=lambda name: beats[name][metric])
+      result[metric] = {
+          'mean': round(sum(beat[metric] for beat in beats.values()) /
+                        len(beats), 1),
+          'max': beats[busiest][metric],
+          'max_instance': busiest}
+    for metric in ('rx_mb_per_sec', 'tx_mb_per_sec'):
+      result[metric]['total'] = round(sum(beat[metric]
+                                          for beat in beats.values()), 1)
+    return result
@@ -0,0 +1,163 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact history of the metrics HadoopMonitor sends."""
+
+
+
+import collections
+import threading
+
+from cfg import cfg
+
+# Metrics taken straight from each update
+CLUSTER_METRICS = ['mapTasks', 'reduceTasks', 'mapreduceNodes', 'mapSlots',
+                   'reduceSlots']
+JOB_METRICS = ['mapProgress', 'reduceProgress', 'pendingMaps',
+               'pendingReduces']
+
+
+class Series(object):
+  """Ring buffers of one metric, at coarser resolutions for older data.
+
+  Every point lands in each tier. The finest tier keeps raw points; coarser
+  tiers keep one (time, avg, min, max) point per bucket of their resolution,
+  so memory stays fixed however long the cluster runs.
+  """
+
+  def __init__(self, tiers):
+    # tiers: a list of (resolution in seconds, number of points), finest first
+    self.tiers = []
+    for resolution, size in tiers:
+      self.tiers.append({'resolution': resolution,
+                         'points': collections.deque(maxlen=size),
+                         'bucket': None})
+
+  def add(self, when, value):
+    for tier in self.tiers:
+      start = when - when % tier['resolution']
+      bucket = tier['bucket']
+      if bucket is not None and bucket[0] != start:
+        self.close(tier)
+        bucket = None
+      if bucket is None:
+        tier['bucket'] = [start, 0.0, 0, value, value]
+        bucket = tier['bucket']
+      bucket[1] += value
+      bucket[2] += 1
+      bucket[3] = min(bucket[3], value)
+      bucket[4] = max(bucket[4], value)
+
+  def close(self, tier):
+    start, total, count, low, high = tier['bucket']
+    tier['points'].append((start, total / count, low, high))
+    tier['bucket'] = None
+
+  def points(self, tier):
+    """A tier's points, including the bucket that's still filling."""
+    result = list(tier['points'])
+    if tier['bucket'] is not None:
+      start, total, count, low, high = tier['bucket']
+      result.append((start, total / count, low, high))
+    return result
+
+  def query(self, start, end):
+    """Points in [start, end] from the finest tier that covers the range.
+
+    A tier covers the range if it reaches back to start, or if it hasn't had
+    to drop any points yet.
+
+    Returns:
+      (resolution in seconds, list of (time, avg, min, max))
+    """
+    chosen = self.tiers[-1]
+    for tier in self.tiers:
+      points = tier['points']
+      if ((points and points[0][0] <= start) or
+          len(points) < points.maxlen):
+        chosen = tier
+        break
+    return (chosen['resolution'],
+            [p for p in self.points(chosen) if start <= p[0] <= end])
+
+
+def aggregate(points):
+  if not points:
+    return {'min': None, 'max': None, 'avg': None, 'last': None}
+  return {'min': min(p[2] for p in points),
+          'max': max(p[3] for p in points),
+          'avg': sum(p[1] for p in points) / len(points),
+          'last': points[-1][1]}
+
+
+class History(object):
+  """Time series of cluster-wide and per-job metrics."""
+
+  def __init__(self):
+    self.series = {}
+    # Job IDs in the order we first saw them, to forget the oldest
+    self.job_order = collections.deque()
+    self.lock = threading.Lock()
+
+  def add(self, metric, when, value):
+    if metric not in self.series:
+      self.series[metric] = Series(cfg.history_tiers)
+    self.series[metric].add(when, float(value))
+
+  def record(self, when, data):
+    """Add the metrics from one HadoopMonitor update."""
+    with self.lock:
+      for metric in CLUSTER_METRICS:
+        if metric in data:
+          self.add(metric, when, data[metric])
+      if data.get('mapSlots'):
+        self.add('mapSlotUse', when,
+                 float(data.get('mapTasks', 0)) / data['mapSlots'])
+      if data.get('reduceSlots'):
+        self.add('reduceSlotUse', when,
+                 float(data.get('reduceTasks', 0)) / data['reduceSlots'])
+
+      for job in data.get('jobs', []):
+        # Finished jobs don't change; don't fill their history with copies
+        if job.get('status') not in ('RUNNING', 'PREP'):
+          continue
+        if 'job.{0}.mapProgress'.format(job['id']) not in self.series:
+          self.job_order.append(job['id'])
+          self.forget_old_jobs()
+        for metric in JOB_METRICS:
+          if metric in job:
+            self.add('job.{0}.{1}'.format(job['id'], metric), when,
+                     job[metric])
+
+  def forget_old_jobs(self):
+    while len(self.job_order) > cfg.history_max_jobs:
+      prefix = 'job.{0}.'.format(self.job_order.popleft())
+      for metric in [m for m in self.series if m.startswith(prefix)]:
+        del self.series[metric]
+
+  def metrics(self):
+    with self.lock:
+      return sorted(self.series)
+
+  def query(self, metrics, start, end):
+    """Returns each metric's points and aggregates over [start, end]."""
+    result = {}
+    with self.lock:
+      for metric in metrics:
+        if metric not in self.series:
+          continue
+        resolution, points = self.series[metric].query(start, end)
+        result[metric] = {'resolution_secs': resolution, 'points': points}
+        result[metric].update(aggregate(points))
+    return result
@@ -0,0 +1,137 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spans of a cluster launch, exported as a Chrome trace timeline."""
+
+
+
+import collections
+import contextlib
+import threading
+import time
+import uuid
+
+from cfg import cfg
+
+# Spans that aren't about one instance go on this track
+CLUSTER = 'cluster'
+
+
+class Tracer(object):
+  """Collects spans from the coordinator and from the instances themselves.
+
+  Every instance gets a trace ID when it's inserted, which reaches it through
+  its metadata. The coordinator records the states it sees each instance go
+  through and the calls it makes; the instance reports the steps of its own
+  startup to /trace/report, tagged with the trace ID. Reports carrying an old
+  trace ID (from before the instance was re-inserted) are dropped.
+  """
+
+  def __init__(self):
+    self.spans = collections.deque(maxlen=cfg.trace_max_spans)
+    # Instance -> the trace ID it was given
+    self.trace_ids = {}
+    # Track -> (state, since when) for the state a track is in now
+    self.states = {}
+    self.lock = threading.Lock()
+
+  def new_trace(self, instance):
+    """Returns a new trace ID for an instance being inserted."""
+    trace_id = uuid.uuid4().hex
+    with self.lock:
+      self.trace_ids[instance] = trace_id
+    return trace_id
+
+  def add(self, track, name, start, end, source='coordinator', args=None):
+    with self.lock:
+      self.spans.append({'track': track, 'name': name, 'start': start,
+                         'end': end, 'source': source, 'args': args or {}})
+
+  @contextlib.contextmanager
+  def span(self, track, name, **args):
+    """Records a span around the body of a with statement."""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.add(track, name, start, time.time(), args=args)
+
+  def state(self, track, state, final=False):
+    """Note that a track entered a state, ending the span of the last one.
+
+    final states, like being ready, get no span of their own.
+    """
+    now = time.time()
+    with self.lock:
+      last = self.states.pop(track, None)
+      if not final:
+        self.states[track] = (state, now)
+    if last:
+      self.add(track, last[0], last[1], now, source='state')
+
+  def forget(self, instance):
+    """Ends the state of a deleted instance and drops its trace ID."""
+    self.state(instance, None, final=True)
+    with self.lock:
+      self.trace_ids.pop(instance, None)
+
+  def report(self, trace_id, instance, spans):
+    """Add the spans an instance reported. Returns False if they're stale."""
+    with self.lock:
+      if self.trace_ids.get(instance) != trace_id:
+        return False
+    for span in spans:
+      self.add(instance, span['name'], span['start'], span['end'],
+               source='instance', args=span.get('args'))
+    return True
+
+  def chrome_trace(self):
+    """The spans in the Trace Event format chrome://tracing loads.
+
+    Each instance is a process there, with a thread for the states the
+    coordinator saw, one for the coordinator's calls, and one for the steps
+    the instance reported. States still in progress end now.
+    """
+    now = time.time()
+    with self.lock:
+      spans = list(self.spans)
+      spans += [{'track': track, 'name': state, 'start': since, 'end': now,
+                 'source': 'state', 'args': {'in_progress': True}}
+                for track, (state, since) in self.states.items()]
+      trace_ids = dict(self.trace_ids)
+    if not spans:
+      return {'traceEvents': [], 'otherData': {'start': now}}
+    origin = min(span['start'] for span in spans)
+    tracks = sorted(set(span['track'] for span in spans),
+                    key=lambda track: (track != CLUSTER, track))
+    pids = dict((track, i + 1) for i, track in enumerate(tracks))
+    tids = {'state': 1, 'coordinator': 2, 'instance': 3}
+
+    events = []
+    for track in tracks:
+      events.append({'name': 'process_name', 'ph': 'M', 'pid': pids[track],
+                     'args': {'name': track}})
+      for source, tid in tids.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pids[track],
+                       'tid': tid, 'args': {'name': source}})
+    for span in spans:
+      args = dict(span['args'])
+      if span['track'] in trace_ids:
+        args['trace_id'] = trace_ids[span['track']]
+      events.append({'name': span['name'], 'cat': span['source'], 'ph': 'X',
+                     'pid': pids[span['track']], 'tid': tids[span['source']],
+                     'ts': int((span['start'] - origin) * 1e6),
+                     'dur': int((span['end'] - span['start']) * 1e6),
+                     'args': args})
+    return {'traceEvents': events, 'otherData': {'start': origin}}
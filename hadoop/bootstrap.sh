@@ -19,7 +19,19 @@ exec 3>&1 4>&2 >log_snitch 2>&1
 
 echo Starting bootstrap script as ${USER}
 
+# Time each step for the coordinator's launch timeline. setup_hadoop.py reports
+# them.
+SPANS=~/trace_spans
+: > ${SPANS}
+span_start() {
+  SPAN_START=$(date +%s.%N)
+}
+span_end() {
+  echo "$1 ${SPAN_START} $(date +%s.%N)" >> ${SPANS}
+}
+
 # Always stick hadoop data here, whether or not we have extra disk
+span_start
 sudo mkdir -p /mnt/hadoop
 
 # Set up ephemeral disk, if any
@@ -41,18 +53,24 @@ for dev in /dev/pd_*; do
 done
 
 sudo chown -R hadoop:hadoop /mnt/hadoop
+span_end mount_disks
 
 # Grab our code
+span_start
 MD=http://metadata/0.1/meta-data/attributes
 BUCKET=$(curl ${MD}/gs_bucket)
 gsutil cp gs://${BUCKET}/snitch-tarball.tgz .
 tar xzf snitch-tarball.tgz
+span_end download_snitch
 
 # Set up the REST agent
-sudo easy_install -H None -f bottle_install -U bottle
-wget ${MD}/snitch_py
-mv snitch_py snitch.py
+# Skip reinstalling after a reset
+span_start
+python -c 'import bottle' || \
+  sudo easy_install -H None -f bottle_install -U bottle
+wget ${MD}/snitch_py -O snitch.py
 chmod +x snitch.py
+span_end install_snitch
 
 # Setup Hadoop and start snitch
 chmod +x setup_hadoop.py
@@ -19,11 +19,20 @@
 
 import json
 import logging
+import os
+import socket
+import subprocess
 import sys
+import threading
+import time
 
 import bottle
 from cfg import cfg
 import cherrypy.wsgiserver
+import util
+
+# Referenced by dfs.hosts.exclude and mapred.hosts.exclude in hadoop/conf
+EXCLUDES = '/home/hadoop/hadoop/conf/excludes'
 
 
 def authorize():
@@ -35,15 +44,207 @@ def authorize():
     bottle.abort(401, 'Your request does not include the right authorization.')
 
 
+def exclude_hosts(hosts):
+  """Add instances to the exclude list shared by the NameNode and JobTracker.
+
+  Hadoop matches excluded nodes by either hostname or IP, so list both.
+  """
+  with open(EXCLUDES, 'a') as excludes:
+    for host in hosts:
+      excludes.write(host + '\n')
+      try:
+        excludes.write(socket.gethostbyname(host) + '\n')
+      except socket.error:
+        logging.warn('Could not resolve %s to exclude it', host)
+
+
+def boot_id():
+  """Changes every time the instance boots, so the coordinator sees resets."""
+  with open('/proc/sys/kernel/random/boot_id') as f:
+    return f.read().strip()
+
+
+def start_daemons(daemons):
+  """Start Hadoop daemons and remember them, to restart them after a reset."""
+  for daemon in daemons:
+    logging.info('Starting %s...', daemon)
+    subprocess.call([cfg.hadoop_bin + 'hadoop-daemon.sh', 'start', daemon])
+  with open(cfg.daemons_file, 'w') as f:
+    f.write('\n'.join(daemons) + '\n')
+
+
+def list_hdfs(path):
+  """List the files matching an HDFS path or glob, one directory deep.
+
+  Like Hadoop, skips names starting with _ or . (such as _SUCCESS and _logs).
+
+  Returns:
+    A list of {'path', 'size'} sorted by path, or None if nothing matched.
+  """
+  ls = subprocess.Popen([cfg.hadoop_bin + 'hadoop', 'fs', '-ls', path],
+                        stdout=subprocess.PIPE)
+  listing = ls.communicate()[0]
+  if ls.returncode != 0:
+    return None
+  files = []
+  for line in listing.splitlines():
+    # perms replication owner group size date time path
+    fields = line.split(None, 7)
+    if len(fields) != 8 or fields[0].startswith('d'):
+      continue
+    name = fields[7].rsplit('/', 1)[-1]
+    if name.startswith('_') or name.startswith('.'):
+      continue
+    files.append({'path': fields[7], 'size': int(fields[4])})
+  return sorted(files, key=lambda f: f['path'])
+
+
+def read_hdfs(path):
+  """Yields an HDFS file's contents a block at a time."""
+  cat = subprocess.Popen([cfg.hadoop_bin + 'hadoop', 'fs', '-cat', path],
+                         stdout=subprocess.PIPE)
+  try:
+    while True:
+      block = cat.stdout.read(cfg.download_block_bytes)
+      if not block:
+        break
+      yield block
+  finally:
+    # Reached early if the reader hung up
+    if cat.poll() is None:
+      cat.kill()
+    cat.wait()
+
+
+# Resource heartbeats
+
+def cpu_times():
+  """Returns jiffies since boot: (busy, iowait, steal, total)."""
+  with open('/proc/stat') as f:
+    # cpu user nice system idle iowait irq softirq steal
+    fields = [int(x) for x in f.readline().split()[1:9]]
+  fields += [0] * (8 - len(fields))
+  idle, iowait, steal = fields[3], fields[4], fields[7]
+  total = sum(fields)
+  return (total - idle - iowait - steal, iowait, steal, total)
+
+
+def net_bytes():
+  """Returns bytes (received, sent) since boot by every NIC but loopback."""
+  rx = tx = 0
+  with open('/proc/net/dev') as f:
+    # Two lines of headers, then 'iface: 8 receive fields, 8 transmit fields'
+    for line in f.readlines()[2:]:
+      iface, counters = line.split(':', 1)
+      if iface.strip() == 'lo':
+        continue
+      counters = counters.split()
+      rx += int(counters[0])
+      tx += int(counters[8])
+  return (rx, tx)
+
+
+def mem_used_pct():
+  info = {}
+  with open('/proc/meminfo') as f:
+    for line in f:
+      key, value = line.split(':', 1)
+      info[key] = int(value.split()[0])
+  available = info.get('MemAvailable')
+  if available is None:
+    # Older kernels
+    available = info['MemFree'] + info['Buffers'] + info['Cached']
+  return 100.0 * (info['MemTotal'] - available) / info['MemTotal']
+
+
+def disk_usage():
+  """Returns (percent used, GB free) of the ephemeral disk, like df."""
+  stat = os.statvfs(cfg.edisk_location)
+  used = stat.f_blocks - stat.f_bfree
+  usable = used + stat.f_bavail
+  pct = 100.0 * used / usable if usable else 0.0
+  return (pct, float(stat.f_bavail) * stat.f_frsize / 1024 ** 3)
+
+
+def heartbeat(last, now):
+  """The heartbeat for the time between two samples.
+
+  Each sample is (time, cpu_times(), net_bytes()).
+  """
+  secs = max(now[0] - last[0], 0.001)
+  cpu = [b - a for a, b in zip(last[1], now[1])]
+  total = max(cpu[3], 1)
+  net = [(b - a) / 1024.0 ** 2 / secs for a, b in zip(last[2], now[2])]
+  disk, disk_free = disk_usage()
+  beat = {'cpu': 100.0 * cpu[0] / total, 'iowait': 100.0 * cpu[1] / total,
+          'steal': 100.0 * cpu[2] / total, 'mem': mem_used_pct(),
+          'disk': disk, 'disk_free_gb': disk_free,
+          'rx_mb_per_sec': net[0], 'tx_mb_per_sec': net[1]}
+  return dict((key, round(value, 1)) for key, value in beat.items())
+
+
+def send_heartbeats():
+  """Tell the coordinator how loaded we are every cfg.heartbeat_secs."""
+  name = socket.gethostname()
+  last = None
+  while True:
+    try:
+      sample = (time.time(), cpu_times(), net_bytes())
+      if last:
+        util.talk_to_agent(cfg.coordinator, '/instance/heartbeat',
+                           {'name': name,
+                            'beat': json.dumps(heartbeat(last, sample))})
+      last = sample
+    except Exception as e:
+      logging.warn('Heartbeat failed: %s', e)
+    time.sleep(cfg.heartbeat_secs)
+
+
 def start_snitch(app):
-  """Set up a status handler and launch the snitch's webserver."""
+  """Set up common handlers and launch the snitch's webserver."""
   cfg.update_from_metadata()
   state = sys.argv[1]
 
+  # Any instance with Hadoop can read HDFS, so downloads are spread out
+  @app.post('/hdfs/list')
+  def hdfs_list():
+    authorize()
+    files = list_hdfs(bottle.request.forms.get('path'))
+    if files is None:
+      return json.dumps({'result': 'failed'}) + '\n'
+    return json.dumps({'result': 'ok', 'files': files}) + '\n'
+
+  @app.post('/debug/threads')
+  def debug_threads():
+    authorize()
+    return json.dumps({'result': 'ok', 'threads': util.thread_stacks()}) + '\n'
+
+  @app.post('/debug/profile')
+  def debug_profile():
+    authorize()
+    seconds = min(float(bottle.request.forms.get('seconds') or 10),
+                  cfg.profile_max_secs)
+    profile = util.sample_stacks(seconds)
+    if profile is None:
+      return json.dumps({'result': 'failed',
+                         'reason': 'already profiling'}) + '\n'
+    profile['result'] = 'ok'
+    return json.dumps(profile) + '\n'
+
+  @app.post('/hdfs/read')
+  def hdfs_read():
+    authorize()
+    bottle.response.content_type = 'application/octet-stream'
+    return read_hdfs(bottle.request.forms.get('path'))
+
   # The coordinator will poll this
   @app.route('/status')
   def status():
-    return json.dumps({'state': state}) + '\n'
+    return json.dumps({'state': state, 'boot_id': boot_id()}) + '\n'
+
+  thread = threading.Thread(target=send_heartbeats)
+  thread.daemon = True
+  thread.start()
 
   # Bottle's wrapper around cherrypy doesn't let us setup SSL, so do this
   # ourselves
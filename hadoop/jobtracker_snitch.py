@@ -17,13 +17,16 @@
 
 
 
+import base64
 import json
 import logging
 import os.path
+import re
 import subprocess
 import tempfile
+import threading
+import time
 import urlparse
-import uuid
 
 import bottle
 from cfg import cfg
@@ -31,6 +34,16 @@ import util
 
 import common_snitch
 
+HADOOP_JOB_RE = re.compile(r'Running job: (job_\w+)')
+# How often a /job/log call checks for more output
+LOG_POLL_SECS = 0.5
+
+# IDs of the job drivers running now
+running_jobs = set()
+# Job ID -> (exit_code, hadoop_jobs, reason) of finished jobs /job/report
+# couldn't tell the coordinator about. /job/running hands them over instead.
+unreported_jobs = {}
+
 
 def get_file(src, local_dst):
   """Download src from the web or GS to local_dst."""
@@ -40,6 +53,165 @@ def get_file(src, local_dst):
     subprocess.call(['wget', src, '-O', local_dst])
 
 
+class JarCache(object):
+  """Job JARs on local disk, named by their SHA-1, evicted least recently used.
+
+  Iterative workflows submit the same JAR over and over; with the cache, it's
+  only downloaded the first time. lookup and add pin the JAR they return, so
+  it isn't evicted while a driver runs it; release unpins it.
+  """
+
+  def __init__(self, directory, budget):
+    self.directory = directory
+    self.budget = budget
+    self.lock = threading.Lock()
+    # Path -> how many drivers are using it
+    self.pins = {}
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+  def path(self, digest):
+    return os.path.join(self.directory, digest + '.jar')
+
+  def lookup(self, digest):
+    """Returns the local path of a cached JAR, pinned, or None."""
+    with self.lock:
+      path = self.path(digest)
+      if not os.path.exists(path):
+        return None
+      # Mark it as recently used
+      os.utime(path, None)
+      self.pins[path] = self.pins.get(path, 0) + 1
+      return path
+
+  def add(self, local_jar, digest):
+    """Moves a downloaded JAR into the cache. Returns its new path, pinned."""
+    with self.lock:
+      path = self.path(digest)
+      os.rename(local_jar, path)
+      self.pins[path] = self.pins.get(path, 0) + 1
+      self.evict()
+    return path
+
+  def release(self, path):
+    """Unpins a JAR from lookup or add once its driver exits."""
+    with self.lock:
+      self.pins[path] -= 1
+      if not self.pins[path]:
+        del self.pins[path]
+      self.evict()
+
+  def evict(self):
+    entries = []
+    for fn in os.listdir(self.directory):
+      path = os.path.join(self.directory, fn)
+      info = os.stat(path)
+      entries.append((info.st_mtime, info.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self.budget:
+        break
+      if path not in self.pins:
+        logging.info('Evicting %s from the JAR cache', path)
+        os.remove(path)
+        total -= size
+
+
+def report_job(job_id, exit_code, hadoop_jobs, reason=None):
+  """Tell the coordinator a job finished, retrying with backoff."""
+  data = {'job_id': job_id, 'exit_code': json.dumps(exit_code),
+          'hadoop_jobs': json.dumps(hadoop_jobs), 'reason': reason or ''}
+  for attempt in range(cfg.job_report_attempts):
+    if attempt:
+      time.sleep(cfg.poll_delay_secs * 2 ** attempt)
+    try:
+      util.checked_do(cfg.coordinator, '/job/report', data)
+      return
+    except Exception as e:
+      logging.warn('Reporting %s failed: %s', job_id, e)
+  unreported_jobs[job_id] = (exit_code, hadoop_jobs, reason)
+
+
+def run_job(jar_cache, job_id, jar, digest, job_args):
+  """Fetch the JAR, run the driver to completion, and report back."""
+  # Followers of the log wait for output from now on, not only once the JAR
+  # is downloaded
+  running_jobs.add(job_id)
+  try:
+    exit_code, hadoop_jobs, reason = drive_job(jar_cache, job_id, jar, digest,
+                                               job_args)
+  except Exception as e:
+    # The coordinator must hear about the job however it ends, or it holds a
+    # slot of cfg.max_concurrent_jobs forever
+    logging.exception('Job %s failed', job_id)
+    exit_code, hadoop_jobs, reason = None, [], 'driver failed: {0}'.format(e)
+  finally:
+    running_jobs.discard(job_id)
+  report_job(job_id, exit_code, hadoop_jobs, reason)
+
+
+def drive_job(jar_cache, job_id, jar, digest, job_args):
+  """Returns (exit_code, the Hadoop jobs it ran, why it failed or None)."""
+  local_jar = jar_cache.lookup(digest) if digest else None
+  if local_jar is None:
+    local_jobdir = tempfile.mkdtemp()
+    download = os.path.join(local_jobdir, os.path.basename(jar))
+    get_file(jar, download)
+    if not os.path.isfile(download):
+      os.rmdir(local_jobdir)
+      return (None, [], 'could not download {0}'.format(jar))
+    download_digest = util.file_digest(download)
+    if digest and download_digest != digest:
+      # Never let it into the cache, where it could evict good JARs
+      logging.warn('%s does not match its hash %s', jar, digest)
+      os.remove(download)
+      os.rmdir(local_jobdir)
+      return (None, [], 'JAR does not match its hash')
+    local_jar = jar_cache.add(download, download_digest)
+    os.rmdir(local_jobdir)
+  else:
+    logging.info('JAR cache hit for %s', digest)
+
+  log = cfg.job_log.format(job_id)
+  try:
+    with open(log, 'w') as out:
+      exit_code = subprocess.call(
+          [cfg.hadoop_bin + 'hadoop', 'jar', local_jar] + job_args,
+          stdout=out, stderr=out)
+  finally:
+    running_jobs.discard(job_id)
+    jar_cache.release(local_jar)
+  # The driver logs each Hadoop job it submits
+  with open(log) as out:
+    hadoop_jobs = HADOOP_JOB_RE.findall(out.read())
+  logging.info('Job %s exited with %s, ran %s', job_id, exit_code,
+               hadoop_jobs)
+  return (exit_code, hadoop_jobs, None)
+
+
+def read_log(job_id, offset, max_bytes, timeout):
+  """Read up to max_bytes of a job's log from offset.
+
+  While the driver runs and has nothing new to say, waits up to timeout seconds
+  for more output.
+
+  Returns:
+    (the bytes read, the size of the log so far)
+  """
+  path = cfg.job_log.format(job_id)
+  deadline = time.time() + timeout
+  while True:
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size > offset or job_id not in running_jobs or time.time() >= deadline:
+      break
+    time.sleep(LOG_POLL_SECS)
+  if size <= offset:
+    return ('', size)
+  with open(path) as log:
+    log.seek(offset)
+    return (log.read(min(max_bytes, size - offset)), size)
+
+
 def main():
   app = bottle.Bottle()
   tempfile.tempdir = cfg.edisk_location
@@ -47,25 +219,79 @@ def main():
   @app.post('/start')
   def start_jobtracker():
     common_snitch.authorize()
-    subprocess.call([cfg.hadoop_bin + 'hadoop-daemon.sh', 'start',
-                     'jobtracker'])
+    common_snitch.start_daemons(['jobtracker'])
     logging.info('Start done!')
     return cfg.ok_reply
 
+  jar_cache = JarCache(cfg.jar_cache_dir, cfg.jar_cache_bytes)
+
+  @app.post('/job/has_jar')
+  def has_jar():
+    common_snitch.authorize()
+    digest = bottle.request.forms.get('jar_hash')
+    cached = jar_cache.lookup(digest) is not None
+    return json.dumps({'result': 'ok', 'cached': cached}) + '\n'
+
   @app.post('/job/start')
   def start_job():
-    """Downloads a JAR locally and submits a MapReduce job."""
+    """Runs a MapReduce job driver in the background.
+
+    The JAR is found in the cache or downloaded, then the driver runs, and the
+    coordinator hears about it through /job/report when it exits.
+    """
     common_snitch.authorize()
-    jar = bottle.request.forms.get('jar')
+    job_id = bottle.request.forms.get('job_id')
+    jar = bottle.request.forms.get('jar', '')
+    digest = bottle.request.forms.get('jar_hash')
     job_args = map(str, json.loads(bottle.request.forms.get('args')))
-    local_jobdir = tempfile.mkdtemp()
-    local_jar = os.path.join(local_jobdir, os.path.basename(jar))
+    if not jar and not (digest and jar_cache.lookup(digest)):
+      return json.dumps({'result': 'failed',
+                         'reason': 'JAR not cached'}) + '\n'
+    thread = threading.Thread(target=run_job,
+                              args=(jar_cache, job_id, jar, digest, job_args))
+    thread.daemon = True
+    thread.start()
+    return cfg.ok_reply
+
+  @app.post('/job/running')
+  def jobs_running():
+    """Lists the running jobs, and hands over reports that didn't get through.
 
-    get_file(jar, local_jar)
+    The coordinator fails any job it thinks is running that isn't in either.
+    """
+    common_snitch.authorize()
+    finished = {}
+    for job_id in list(unreported_jobs):
+      exit_code, hadoop_jobs, reason = unreported_jobs.pop(job_id)
+      finished[job_id] = {'exit_code': exit_code, 'hadoop_jobs': hadoop_jobs,
+                          'reason': reason}
+    return json.dumps({'result': 'ok', 'running': sorted(running_jobs),
+                       'finished': finished}) + '\n'
+
+  @app.post('/job/log')
+  def job_log():
+    """Returns a chunk of a job driver's output, for tailing it."""
+    common_snitch.authorize()
+    job_id = bottle.request.forms.get('job_id')
+    offset = int(bottle.request.forms.get('offset') or 0)
+    max_bytes = min(int(bottle.request.forms.get('max_bytes') or
+                        cfg.job_log_chunk_bytes), cfg.job_log_chunk_bytes)
+    timeout = min(float(bottle.request.forms.get('timeout') or 0),
+                  cfg.job_log_wait_secs)
+    data, size = read_log(job_id, offset, max_bytes, timeout)
+    # A chunk can end inside a UTF-8 character, so leave decoding to the
+    # client, which sees the whole stream
+    return json.dumps({'result': 'ok', 'offset': offset + len(data),
+                       'size': size, 'data': base64.b64encode(data)}) + '\n'
 
-    job_name = '{0}_{1}'.format(local_jar, uuid.uuid1())
-    util.bg_exec([cfg.hadoop_bin + 'hadoop', 'jar', local_jar] + job_args,
-                 '/home/hadoop/log_job_{0}'.format(os.path.basename(job_name)))
+  @app.post('/decommission')
+  def decommission():
+    """Stop scheduling tasks on the given tasktrackers."""
+    common_snitch.authorize()
+    hosts = json.loads(bottle.request.forms.get('hosts'))
+    logging.info('Decommissioning %s', hosts)
+    common_snitch.exclude_hosts(hosts)
+    subprocess.call([cfg.hadoop_bin + 'hadoop', 'mradmin', '-refreshNodes'])
     return cfg.ok_reply
 
   common_snitch.start_snitch(app)
@@ -17,9 +17,16 @@
 
 
 
+import hashlib
+import json
 import logging
 import multiprocessing
+import multiprocessing.pool
+import posixpath
+import re
+import socket
 import subprocess
+import threading
 
 import bottle
 from cfg import cfg
@@ -28,10 +35,16 @@ import util
 import common_snitch
 
 
+# A line of the balancer's progress: a time stamp, then the iteration, bytes
+# already moved, left to move and being moved
+BALANCER_PROGRESS_RE = re.compile(r'\s(\d+)' + r'\s+([\d.]+ [KMGTPE]?B)' * 3 +
+                                  r'\s*$')
+
+
 def send_update(operation, msg):
   logging.info('State of %s: %s', operation, msg)
   data = {'operation': operation, 'state': msg}
-  util.talk_to_agent(cfg.coordinator, '/node/op_status', data)
+  util.talk_to_agent(cfg.coordinator, '/instance/op_status', data)
 
 
 def do_transfer(operation, src, dst):
@@ -40,6 +53,234 @@ def do_transfer(operation, src, dst):
                    dst, operation])
 
 
+def delete_path(path, skip_trash):
+  """Recursively deletes an HDFS path or glob. Returns an error or None."""
+  args = [cfg.hadoop_bin + 'hadoop', 'fs', '-rmr']
+  if skip_trash:
+    args.append('-skipTrash')
+  rmr = subprocess.Popen(args + [path], stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+  output = rmr.communicate()[0]
+  # Nothing to delete is as good as deleted
+  if rmr.returncode == 0 or 'No such file' in output:
+    return None
+  return output.strip() or 'exit code {0}'.format(rmr.returncode)
+
+
+def do_clean(operation, paths, skip_trash):
+  """Delete paths a few at a time, reporting progress after each."""
+  send_update(operation, 'Deleting {0} paths'.format(len(paths)))
+  failed = []
+  done = [0]
+  lock = threading.Lock()
+
+  def delete(path):
+    error = delete_path(path, skip_trash)
+    with lock:
+      done[0] += 1
+      if error:
+        logging.warn('Could not delete %s: %s', path, error)
+        failed.append(path)
+      send_update(operation, 'Deleted {0} of {1} paths'.format(done[0],
+                                                               len(paths)))
+
+  pool = multiprocessing.pool.ThreadPool(
+      max(1, min(cfg.clean_parallel, len(paths))))
+  pool.map(delete, paths)
+  pool.close()
+  if failed:
+    send_update(operation, 'Error: could not delete {0}'.format(
+        ', '.join(sorted(failed))))
+  else:
+    send_update(operation, 'Done')
+
+
+def do_balance(operation, bandwidth, threshold):
+  """Run the HDFS balancer, reporting each iteration."""
+  hadoop = cfg.hadoop_bin + 'hadoop'
+  subprocess.call([hadoop, 'dfsadmin', '-setBalancerBandwidth',
+                   str(bandwidth)])
+  send_update(operation, 'Balancing at {0:.1f} MB/s per DataNode'.format(
+      bandwidth / 1024.0 ** 2))
+  balancer = subprocess.Popen([hadoop, 'balancer', '-threshold',
+                               str(threshold)], stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+  outcome = None
+  for line in iter(balancer.stdout.readline, ''):
+    line = line.strip()
+    progress = BALANCER_PROGRESS_RE.search(line)
+    if progress:
+      send_update(operation, 'Iteration {0}: moved {1}, {2} left'.format(
+          progress.group(1), progress.group(2), progress.group(3)))
+    elif line.endswith('Exiting...'):
+      outcome = line
+  balancer.wait()
+  # It also gives up when no more blocks can be moved; that's as balanced as
+  # HDFS gets
+  if outcome and ('balanced' in outcome or outcome.startswith('No block')):
+    logging.info('Balancer: %s', outcome)
+    send_update(operation, 'Done')
+  else:
+    send_update(operation, 'Error: {0}'.format(
+        outcome or 'balancer exited with {0}'.format(balancer.returncode)))
+
+
+class Upload(object):
+  """A local file being streamed into `hadoop fs -put` a chunk at a time.
+
+  Chunks arrive in parallel and in any order, but the put takes them in order.
+  Chunks that come early wait in memory, at most cfg.upload_window_chunks of
+  them; nothing is written to local disk. The file is put under a temporary
+  name next to dst, and only moved to dst once it's complete.
+  """
+
+  def __init__(self, upload_id, dst, size, chunk_bytes):
+    self.description = {'dst': dst, 'size': size, 'chunk_bytes': chunk_bytes}
+    self.dst = dst
+    self.size = size
+    self.num_chunks = max(1, (size + chunk_bytes - 1) / chunk_bytes)
+    self.tmp = posixpath.join(posixpath.dirname(dst),
+                              '_upload_{0}'.format(upload_id))
+    # Left behind by an upload this process didn't get to finish
+    subprocess.call([cfg.hadoop_bin + 'hadoop', 'fs', '-rm', self.tmp])
+    self.put = subprocess.Popen([cfg.hadoop_bin + 'hadoop', 'fs', '-put', '-',
+                                 self.tmp], stdin=subprocess.PIPE)
+    # Chunks before next have been written to the put; pending holds the
+    # chunks that arrived early
+    self.next = 0
+    self.pending = {}
+    # Whether some request is writing chunks; only one does at a time
+    self.writing = False
+    self.error = None
+    self.lock = threading.Lock()
+
+  def received(self):
+    with self.lock:
+      return range(self.next) + sorted(self.pending)
+
+  def add(self, index, sha1, data):
+    """Take one chunk, once it's checked.
+
+    Returns:
+      (an error message or None, whether the chunk is only early and should
+      be sent again shortly)
+    """
+    if not 0 <= index < self.num_chunks:
+      return ('chunk {0} out of range'.format(index), False)
+    if hashlib.sha1(data).hexdigest() != sha1:
+      return ('chunk {0} is corrupt'.format(index), False)
+    with self.lock:
+      if self.error:
+        return (self.error, False)
+      if index < self.next or index in self.pending:
+        return (None, False)
+      if index >= self.next + cfg.upload_window_chunks:
+        return ('chunk {0} is too early'.format(index), True)
+      self.pending[index] = data
+      if self.writing:
+        # The request already writing will get to this chunk
+        return (None, False)
+      self.writing = True
+    while True:
+      with self.lock:
+        data = self.pending.pop(self.next, None)
+        if data is None:
+          self.writing = False
+          return (self.error, False)
+        self.next += 1
+      try:
+        self.put.stdin.write(data)
+      except IOError as e:
+        with self.lock:
+          self.error = 'hadoop fs -put failed: {0}'.format(e)
+          self.pending.clear()
+
+  def missing(self):
+    with self.lock:
+      return self.num_chunks - self.next - len(self.pending)
+
+  def finish(self, operation):
+    """Close the put and move the file into place."""
+    send_update(operation, 'Writing the last of {0} MB into {1}'.format(
+        self.size / 1024 ** 2, self.dst))
+    try:
+      self.put.stdin.close()
+    except IOError:
+      pass
+    if self.put.wait() != 0 or self.error:
+      send_update(operation, 'Error: {0}'.format(
+          self.error or 'hadoop fs -put exited with {0}'.format(
+              self.put.returncode)))
+      return
+    if subprocess.call([cfg.hadoop_bin + 'hadoop', 'fs', '-mv', self.tmp,
+                        self.dst]) != 0:
+      send_update(operation, 'Error: could not move {0} to {1}'.format(
+          self.tmp, self.dst))
+      return
+    send_update(operation, 'Done')
+
+  def abort(self):
+    if self.put.poll() is None:
+      self.put.kill()
+      self.put.wait()
+
+
+# Uploads in progress, by upload ID
+uploads = {}
+uploads_lock = threading.Lock()
+
+
+def start_upload(upload_id, dst, size, chunk_bytes):
+  """Open an upload, or resume one that's underway.
+
+  Resuming keeps the chunks received so far, unless the file or destination
+  changed or the upload failed. The chunks only live in this process, so a
+  restarted snitch starts over.
+
+  Returns:
+    The indices of the chunks already received.
+  """
+  if not re.match(r'^[0-9a-f]+$', upload_id or ''):
+    raise ValueError('bad upload ID {0}'.format(upload_id))
+  with uploads_lock:
+    upload = uploads.get(upload_id)
+    if upload is not None:
+      if (upload.description == {'dst': dst, 'size': size,
+                                 'chunk_bytes': chunk_bytes} and
+          not upload.error):
+        return upload.received()
+      upload.abort()
+    upload = Upload(upload_id, dst, size, chunk_bytes)
+    uploads[upload_id] = upload
+  return []
+
+
+def decommission_status(hosts):
+  """Ask the NameNode how far along each host's decommission is.
+
+  Returns:
+    A dictionary mapping each host to the NameNode's 'Decommission Status'
+    ('Normal', 'Decommission in progress' or 'Decommissioned'), or None if the
+    NameNode doesn't list it.
+  """
+  report = subprocess.Popen([cfg.hadoop_bin + 'hadoop', 'dfsadmin', '-report'],
+                            stdout=subprocess.PIPE).communicate()[0]
+  # Each datanode is described by a paragraph starting with 'Name: ip:port'
+  by_ip = {}
+  for paragraph in report.split('\n\n'):
+    name = re.search(r'^Name: ([^:\s]+)', paragraph, re.MULTILINE)
+    state = re.search(r'^Decommission Status : (.*)$', paragraph, re.MULTILINE)
+    if name and state:
+      by_ip[name.group(1)] = state.group(1).strip()
+  result = {}
+  for host in hosts:
+    try:
+      result[host] = by_ip.get(socket.gethostbyname(host))
+    except socket.error:
+      result[host] = None
+  return result
+
+
 def main():
   app = bottle.Bottle()
 
@@ -57,10 +298,92 @@ def main():
   @app.post('/clean')
   def clean():
     common_snitch.authorize()
-    path = bottle.request.forms.get('path')
-    subprocess.call([cfg.hadoop_bin + 'hadoop', 'fs', '-rmr', path])
+    operation = bottle.request.forms.get('operation')
+    paths = json.loads(bottle.request.forms.get('paths'))
+    skip_trash = bottle.request.forms.get('skip_trash') == 'true'
+    logging.info('Deleting %s', paths)
+    multiprocessing.Process(target=do_clean, args=(operation, paths,
+                                                   skip_trash)).start()
+    # We'll send progress as the deletes finish
+    return cfg.ok_reply
+
+  @app.post('/balance')
+  def balance():
+    common_snitch.authorize()
+    operation = bottle.request.forms.get('operation')
+    bandwidth = int(bottle.request.forms.get('bandwidth'))
+    threshold = bottle.request.forms.get('threshold')
+    logging.info('Balancing HDFS at %s bytes/sec per DataNode', bandwidth)
+    multiprocessing.Process(target=do_balance, args=(operation, bandwidth,
+                                                     threshold)).start()
+    # We'll send progress after each iteration
+    return cfg.ok_reply
+
+  @app.post('/upload/start')
+  def upload_start():
+    common_snitch.authorize()
+    chunks = start_upload(bottle.request.forms.get('upload_id'),
+                          bottle.request.forms.get('dst'),
+                          int(bottle.request.forms.get('size')),
+                          int(bottle.request.forms.get('chunk_bytes')))
+    return json.dumps({'result': 'ok', 'chunks': chunks}) + '\n'
+
+  @app.post('/upload/chunk')
+  def upload_chunk():
+    # The chunk is the raw body; its arguments are in the query string
+    common_snitch.authorize()
+    upload_id = bottle.request.query.get('upload_id')
+    upload = uploads.get(upload_id)
+    if upload is None:
+      error, early = 'unknown upload {0}'.format(upload_id), False
+    else:
+      error, early = upload.add(int(bottle.request.query.get('index')),
+                                bottle.request.query.get('sha1'),
+                                bottle.request.body.read())
+    if error:
+      if not early:
+        logging.warn('Upload chunk rejected: %s', error)
+      return json.dumps({'result': 'failed', 'reason': error,
+                         'early': early}) + '\n'
+    return cfg.ok_reply
+
+  @app.post('/upload/finish')
+  def upload_finish():
+    common_snitch.authorize()
+    operation = bottle.request.forms.get('operation')
+    upload_id = bottle.request.forms.get('upload_id')
+    upload = uploads.get(upload_id)
+    if upload is None:
+      return json.dumps({'result': 'failed',
+                         'reason': 'unknown upload'}) + '\n'
+    missing = upload.missing()
+    if missing:
+      reason = '{0} chunks missing'.format(missing)
+      return json.dumps({'result': 'failed', 'reason': reason}) + '\n'
+    with uploads_lock:
+      uploads.pop(upload_id, None)
+    thread = threading.Thread(target=upload.finish, args=(operation,))
+    thread.daemon = True
+    thread.start()
+    return cfg.ok_reply
+
+  @app.post('/decommission')
+  def decommission():
+    """Start draining blocks off of the given datanodes."""
+    common_snitch.authorize()
+    hosts = json.loads(bottle.request.forms.get('hosts'))
+    logging.info('Decommissioning %s', hosts)
+    common_snitch.exclude_hosts(hosts)
+    subprocess.call([cfg.hadoop_bin + 'hadoop', 'dfsadmin', '-refreshNodes'])
     return cfg.ok_reply
 
+  @app.post('/decommission_status')
+  def get_decommission_status():
+    common_snitch.authorize()
+    hosts = json.loads(bottle.request.forms.get('hosts'))
+    return json.dumps({'result': 'ok',
+                       'hosts': decommission_status(hosts)}) + '\n'
+
   common_snitch.start_snitch(app)
 
 if __name__ == '__main__':
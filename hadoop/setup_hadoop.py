@@ -21,11 +21,16 @@ import logging
 import os
 import socket
 import subprocess
+import time
 
 from cfg import cfg
 import util
 
 
+# bootstrap.sh writes 'name start end' here for each of its steps
+BOOTSTRAP_SPANS = '/home/hadoop/trace_spans'
+
+
 def report_fail(msg):
   hostname = socket.gethostname()
   data = {'name': hostname, 'msg': msg}
@@ -33,7 +38,21 @@ def report_fail(msg):
   util.talk_to_agent(cfg.coordinator, '/instance/report_fail', data)
 
 
-def setup():
+def bootstrap_spans():
+  """The steps bootstrap.sh timed, and the boot before them."""
+  spans = []
+  if os.path.exists(BOOTSTRAP_SPANS):
+    for line in open(BOOTSTRAP_SPANS):
+      name, start, end = line.split()
+      spans.append({'name': name, 'start': float(start), 'end': float(end)})
+  if spans:
+    uptime = float(open('/proc/uptime').read().split()[0])
+    spans.insert(0, {'name': 'boot', 'start': time.time() - uptime,
+                     'end': spans[0]['start']})
+  return spans
+
+
+def setup(spans):
   """Installs Hadoop and dependencies and imports configuration."""
   hostname = socket.gethostname()
   is_namenode = hostname == cfg.hadoop_namenode
@@ -43,42 +62,81 @@ def setup():
   subprocess.check_call(['mkdir', '-p', cfg.edisk_location + '/mapred'])
 
   # Install prereqs
-  util.retry_call(['sudo', 'apt-get', 'install', '-y', 'openjdk-6-jre-headless',
-                   'python-cherrypy3', 'python-openssl'], report_fail)
+  with util.timed(spans, 'install_packages'):
+    util.retry_call(['sudo', 'apt-get', 'install', '-y',
+                     'openjdk-6-jre-headless', 'python-cherrypy3',
+                     'python-openssl'], report_fail)
 
   # Grab and unpack hadoop
   # Mirroring Hadoop on GS avoids hitting Apache mirrors repeatedly
-  util.retry_call(['gsutil', 'cp', cfg.gs_hadoop_tarball,
-                   cfg.hadoop_fn + '.tar.gz'], report_fail)
-  subprocess.check_call(['tar', 'xzf', cfg.hadoop_fn + '.tar.gz'])
-  # Be convenient
-  subprocess.check_call(['mv', cfg.hadoop_fn, 'hadoop'])
-
-  # Pull in our own config, overwriting some default files
-  util.retry_call(['gsutil', 'cp', cfg.gs_hadoop_conf, 'hadoop_conf.tgz'],
-                  report_fail)
-  subprocess.check_call(['tar', 'xzf', 'hadoop_conf.tgz'])
+  with util.timed(spans, 'download_hadoop'):
+    util.retry_call(['gsutil', 'cp', cfg.gs_hadoop_tarball,
+                     cfg.hadoop_fn + '.tar.gz'], report_fail)
+  with util.timed(spans, 'unpack_hadoop'):
+    subprocess.check_call(['tar', 'xzf', cfg.hadoop_fn + '.tar.gz'])
+    # Be convenient
+    subprocess.check_call(['mv', cfg.hadoop_fn, 'hadoop'])
+
+  # Pull in the config the coordinator generated for our role, overwriting some
+  # default files
+  if is_namenode:
+    role = 'namenode'
+  elif hostname == cfg.hadoop_jobtracker:
+    role = 'jobtracker'
+  else:
+    role = 'slave'
+  with util.timed(spans, 'download_conf'):
+    util.retry_call(['gsutil', 'cp', cfg.gs_hadoop_conf.format(role),
+                     'hadoop_conf.tgz'], report_fail)
+    subprocess.check_call(['tar', 'xzf', 'hadoop_conf.tgz'])
 
   if is_namenode:
     logging.info('Setting up namenode...')
     # Grab a jar
-    util.retry_call(['gsutil', 'cp', cfg.gs_tools_jar, 'hadoop-tools.jar'])
+    with util.timed(spans, 'download_tools'):
+      util.retry_call(['gsutil', 'cp', cfg.gs_tools_jar, 'hadoop-tools.jar'])
     # Initialize the filesystem
-    subprocess.check_call([cfg.hadoop_bin + 'hadoop', 'namenode', '-format'])
+    with util.timed(spans, 'format_namenode'):
+      subprocess.check_call([cfg.hadoop_bin + 'hadoop', 'namenode',
+                             '-format'])
     # Launch
-    subprocess.check_call([cfg.hadoop_bin + 'hadoop-daemon.sh', 'start',
-                           'namenode'])
+    with util.timed(spans, 'start_namenode'):
+      subprocess.check_call([cfg.hadoop_bin + 'hadoop-daemon.sh', 'start',
+                             'namenode'])
+    # Recorded like the daemons the snitches start, for restart()
+    with open(cfg.daemons_file, 'w') as f:
+      f.write('namenode\n')
     logging.info('Namenode ready!')
 
 
+def restart():
+  """After a reset, start whatever daemons were running before."""
+  logging.info('Hadoop is already installed; restarting daemons')
+  daemons = []
+  if os.path.exists(cfg.daemons_file):
+    daemons = open(cfg.daemons_file).read().split()
+  for daemon in daemons:
+    logging.info('Restarting %s...', daemon)
+    subprocess.check_call([cfg.hadoop_bin + 'hadoop-daemon.sh', 'start',
+                           daemon])
+
+
 def main():
   cfg.update_from_metadata()
   state = 'READY'
+  spans = bootstrap_spans()
   try:
-    setup()
+    if (os.path.exists(cfg.install_marker) and
+        os.path.exists(cfg.hadoop_bin + 'hadoop')):
+      with util.timed(spans, 'restart_daemons'):
+        restart()
+    else:
+      setup(spans)
+      open(cfg.install_marker, 'w').close()
   except subprocess.CalledProcessError as e:
     logging.error('Setup failed: %s', str(e))
     state = 'FAILED'
+  util.report_spans(spans)
   os.execl('/home/hadoop/snitch.py', '/home/hadoop/snitch.py', state)
 
 if __name__ == '__main__':
@@ -18,7 +18,6 @@
 
 
 import logging
-import subprocess
 
 import bottle
 from cfg import cfg
@@ -34,11 +33,7 @@ def main():
     common_snitch.authorize()
     # Just start the two components that run on us. start-mapred.sh and
     # start-dfs.sh just ssh in and do this anyway
-    logging.info('Starting datanode...')
-    subprocess.call([cfg.hadoop_bin + 'hadoop-daemon.sh', 'start', 'datanode'])
-    logging.info('Starting tasktracker...')
-    subprocess.call([cfg.hadoop_bin + 'hadoop-daemon.sh', 'start',
-                     'tasktracker'])
+    common_snitch.start_daemons(['datanode', 'tasktracker'])
     logging.info('Both started!')
     return cfg.ok_reply
 
@@ -126,7 +126,12 @@ public class GsHdfs {
   public void sendUpdate(String msg) throws IOException {
     String data = "state=" + URLEncoder.encode(msg, "UTF-8") + "&operation=" +
         URLEncoder.encode(operation, "UTF-8");
-    client.send("https://coordinator:8888/instance/op_status", data);
+    // Progress is best-effort; don't let a coordinator hiccup fail the copy
+    try {
+      client.send("https://coordinator:8888/instance/op_status", data);
+    } catch (IOException e) {
+      System.err.println("Couldn't send progress: " + e);
+    }
   }
 
   public static void main(String[] args) throws Exception {
@@ -18,106 +18,424 @@ package com.google;
 // Poll the JobTracker and forward some data to the coordinator
 
 import com.google.gson.Gson;
+import com.google.gson.JsonSyntaxException;
+
+import org.apache.commons.codec.binary.Base64;
 
 import org.apache.hadoop.conf.Configuration;
 import org.apache.hadoop.mapred.ClusterStatus;
+import org.apache.hadoop.mapred.Counters;
 import org.apache.hadoop.mapred.JobClient;
 import org.apache.hadoop.mapred.JobStatus;
+import org.apache.hadoop.mapred.RunningJob;
+import org.apache.hadoop.mapred.TIPStatus;
+import org.apache.hadoop.mapred.TaskCompletionEvent;
+import org.apache.hadoop.mapred.TaskReport;
 
+import java.io.ByteArrayOutputStream;
 import java.io.IOException;
 import java.net.InetSocketAddress;
 import java.net.URLEncoder;
 import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.Collections;
 import java.util.HashMap;
+import java.util.HashSet;
 import java.util.List;
 import java.util.Map;
+import java.util.Random;
+import java.util.Set;
+import java.util.zip.GZIPOutputStream;
 
 /**
  *
  */
 public class HadoopMonitor {
   static final int SLEEP_TIME = 15 * 1000;  // ms
+  // Stop reporting finished jobs this long after they finish
+  static final long RETENTION_TIME = 60 * 60;  // s
+  // Counters worth forwarding: bytes through HDFS and local disk, spills, shuffle
+  // bytes, records, and data-local maps. User counters stay behind.
+  static final List<String> COUNTER_GROUPS = Arrays.asList(
+      "FileSystemCounters",
+      "org.apache.hadoop.mapred.Task$Counter",
+      "org.apache.hadoop.mapred.JobInProgress$Counter");
+  // A running task is a straggler once it takes longer than the 90th percentile
+  // of completed attempts and STRAGGLER_FACTOR times their median
+  static final double STRAGGLER_FACTOR = 2.0;
+  // Too few completed attempts make for a poor baseline
+  static final int MIN_COMPLETED_FOR_STRAGGLERS = 5;
+  static final int MAX_STRAGGLERS = 5;
+  // Percentiles come from a uniform sample of at most this many attempts
+  static final int MAX_SAMPLED_ATTEMPTS = 1000;
+  // The JobTracker hands out 10 completion events per call; read at most this
+  // many calls' worth per update
+  static final int MAX_EVENT_CALLS = 100;
   JobClient jobClient;
   Gson gson;
   HttpsClient client;
   Map<String, JobState> jobs;
+  // Finished jobs past RETENTION_TIME that the JobTracker still lists
+  Set<String> expired;
+  // Each update is numbered. The coordinator acknowledges the ones it merged,
+  // and each update carries every change since the last acknowledged one. 0
+  // means nothing was acknowledged, so the next update is a full one.
+  long seq, ackedSeq;
+  List<String> removed;
 
   public HadoopMonitor() throws IOException {
     jobClient = new JobClient(new InetSocketAddress("hadoop-jobtracker", 9001),
                            new Configuration());
     gson = new Gson();
     jobs = new HashMap<String, JobState>();
+    expired = new HashSet<String>();
+    removed = new ArrayList<String>();
     client = new HttpsClient();
+    seq = 0;
+    ackedSeq = 0;
   }
 
   class JobState {
     public String id, status, failureInfo;
     public float mapProgress, reduceProgress;
-    public long elapsedSeconds;
-    private transient long startTime, finishTime;
+    // Tasks that haven't been scheduled yet; the coordinator's autoscaler uses
+    // these to see how much work is waiting for slots
+    public int pendingMaps, pendingReduces;
+    // In seconds since the epoch; finishTime is 0 until the job finishes. The
+    // coordinator works out elapsed time from these, so a running job doesn't
+    // change with every poll.
+    public long startTime, finishTime;
+    // Selected counters by name, and timings of map and reduce attempts
+    public Map<String, Long> counters;
+    public TaskTimes mapTimes, reduceTimes;
+    // How many task completion events we've read, and whether that's all of them
+    private transient int eventsSeen;
+    private transient boolean eventsDone;
+    // The update that last carried a change to this job, and what it sent
+    private transient long changedSeq;
+    private transient String sent;
 
-    JobState(JobStatus job) {
+    JobState(JobStatus job) throws IOException {
       id = job.getJobID().toString();
       status = "PREP";
       startTime = System.currentTimeMillis() / 1000;
       finishTime = 0;
-      elapsedSeconds = 0;
+      counters = new HashMap<String, Long>();
+      mapTimes = new TaskTimes();
+      reduceTimes = new TaskTimes();
+      eventsSeen = 0;
+      eventsDone = false;
 
       update(job);
     }
 
-    void update(JobStatus job) {
+    void update(JobStatus job) throws IOException {
       status = JobStatus.getJobRunState(job.getRunState());
 
-      // Update elapsed time
-      if (finishTime == 0) {
-        long now = System.currentTimeMillis() / 1000;
-        elapsedSeconds = now - startTime;
-        if (status.equals("SUCCEEDED") || status.equals("FAILED")) {
-          finishTime = now;
-        }
+      if (finishTime == 0 && isFinished()) {
+        finishTime = System.currentTimeMillis() / 1000;
       }
 
       failureInfo = job.getFailureInfo();
 
       mapProgress = job.mapProgress();
       reduceProgress = job.reduceProgress();
+
+      // Task reports list every task of the job, so only ask for them while
+      // some of its maps or reduces are left to run
+      TaskReport[] mapReports = null, reduceReports = null;
+      pendingMaps = 0;
+      pendingReduces = 0;
+      if (job.getRunState() == JobStatus.RUNNING) {
+        if (mapProgress < 1.0f) {
+          mapReports = jobClient.getMapTaskReports(job.getJobID());
+          pendingMaps = countPending(mapReports);
+        }
+        if (reduceProgress < 1.0f) {
+          reduceReports = jobClient.getReduceTaskReports(job.getJobID());
+          pendingReduces = countPending(reduceReports);
+        }
+      }
+
+      if (!eventsDone) {
+        RunningJob running = jobClient.getJob(job.getJobID());
+        if (running != null) {
+          readCompletionEvents(running);
+          Counters all = running.getCounters();
+          if (all != null) {
+            counters = readCounters(all);
+          }
+        }
+        // A finished job won't change, so one last read covers it
+        eventsDone = isFinished();
+      }
+      long now = System.currentTimeMillis();
+      mapTimes.summarize(mapReports, now);
+      reduceTimes.summarize(reduceReports, now);
+    }
+
+    void readCompletionEvents(RunningJob running) throws IOException {
+      for (int calls = 0; calls < MAX_EVENT_CALLS; calls++) {
+        TaskCompletionEvent[] events = running.getTaskCompletionEvents(eventsSeen);
+        if (events.length == 0) {
+          break;
+        }
+        eventsSeen += events.length;
+        for (TaskCompletionEvent event : events) {
+          // Failed and killed (say, losing speculative) attempts aren't timed
+          if (event.getTaskStatus() == TaskCompletionEvent.Status.SUCCEEDED) {
+            TaskTimes times = event.isMapTask() ? mapTimes : reduceTimes;
+            times.addAttempt(event.getTaskRunTime());
+          }
+        }
+      }
+    }
+
+    Map<String, Long> readCounters(Counters all) {
+      Map<String, Long> result = new HashMap<String, Long>();
+      for (Counters.Group group : all) {
+        if (COUNTER_GROUPS.contains(group.getName())) {
+          for (Counters.Counter counter : group) {
+            result.put(counter.getName(), counter.getCounter());
+          }
+        }
+      }
+      return result;
+    }
+
+    boolean isFinished() {
+      return status.equals("SUCCEEDED") || status.equals("FAILED") || status.equals("KILLED");
+    }
+
+    // Note if this job changed since it was last sent in update number seq
+    void noteChanges(long seq) {
+      String now = gson.toJson(this);
+      if (!now.equals(sent)) {
+        sent = now;
+        changedSeq = seq;
+      }
+    }
+
+    int countPending(TaskReport[] reports) {
+      int pending = 0;
+      for (TaskReport report : reports) {
+        if (report.getCurrentStatus() == TIPStatus.PENDING) {
+          pending++;
+        }
+      }
+      return pending;
+    }
+  }
+
+  // Durations of a job's successful map or reduce attempts, and the running tasks
+  // taking much longer than those
+  class TaskTimes {
+    public int completed;
+    // In seconds
+    public long median, p90, max;
+    public List<Straggler> stragglers;
+    // A reservoir sample of the durations, so a job with many tasks costs no
+    // more than MAX_SAMPLED_ATTEMPTS to keep and sort
+    private transient List<Long> sample;  // ms
+    private transient long medianMs, p90Ms, maxMs;
+    private transient Random random;
+    // Whether attempts were added since the percentiles were worked out
+    private transient boolean added;
+
+    TaskTimes() {
+      sample = new ArrayList<Long>();
+      stragglers = new ArrayList<Straggler>();
+      random = new Random();
+    }
+
+    // Completion events are read from where the last poll stopped, so each
+    // attempt is only added once
+    void addAttempt(long ms) {
+      completed++;
+      maxMs = Math.max(maxMs, ms);
+      if (sample.size() < MAX_SAMPLED_ATTEMPTS) {
+        sample.add(ms);
+      } else {
+        int slot = random.nextInt(completed);
+        if (slot < MAX_SAMPLED_ATTEMPTS) {
+          sample.set(slot, ms);
+        }
+      }
+      added = true;
+    }
+
+    // running is null unless the job has tasks of this kind left
+    void summarize(TaskReport[] running, long now) {
+      stragglers = new ArrayList<Straggler>();
+      if (completed == 0) {
+        return;
+      }
+      if (added) {
+        List<Long> sorted = new ArrayList<Long>(sample);
+        Collections.sort(sorted);
+        medianMs = percentile(sorted, 50);
+        p90Ms = percentile(sorted, 90);
+        median = medianMs / 1000;
+        p90 = p90Ms / 1000;
+        max = maxMs / 1000;
+        added = false;
+      }
+
+      if (running == null || completed < MIN_COMPLETED_FOR_STRAGGLERS) {
+        return;
+      }
+      long threshold = Math.max(p90Ms, (long) (STRAGGLER_FACTOR * medianMs));
+      for (TaskReport report : running) {
+        long elapsed = now - report.getStartTime();
+        if (report.getCurrentStatus() == TIPStatus.RUNNING && elapsed > threshold) {
+          stragglers.add(new Straggler(report));
+        }
+      }
+      Collections.sort(stragglers);
+      if (stragglers.size() > MAX_STRAGGLERS) {
+        stragglers = new ArrayList<Straggler>(stragglers.subList(0, MAX_STRAGGLERS));
+      }
+    }
+  }
+
+  // Nearest-rank percentile of a sorted list
+  static long percentile(List<Long> sorted, int pct) {
+    int rank = (int) Math.ceil(pct / 100.0 * sorted.size());
+    return sorted.get(Math.max(0, rank - 1));
+  }
+
+  class Straggler implements Comparable<Straggler> {
+    public String taskId;
+    // In seconds since the epoch, like JobState's, for the same reason
+    public long startTime;
+    public float progress;
+
+    Straggler(TaskReport report) {
+      taskId = report.getTaskID().toString();
+      startTime = report.getStartTime() / 1000;
+      progress = report.getProgress();
+    }
+
+    // Slowest (the earliest started) first
+    public int compareTo(Straggler other) {
+      if (startTime == other.startTime) {
+        return 0;
+      }
+      return startTime < other.startTime ? -1 : 1;
     }
   }
 
   // Send this back
   class ProgressResult {
+    // base is the update these changes are relative to; 0 for a full update
+    public long seq, base;
+    // Only jobs that changed since base, and the IDs of jobs to forget
     public List<JobState> jobs;
-    public int mapreduceNodes, mapTasks, reduceTasks;
+    public List<String> removed;
+    public int mapreduceNodes, mapTasks, reduceTasks, mapSlots, reduceSlots;
 
     ProgressResult() throws IOException {
       ClusterStatus clusterStatus = jobClient.getClusterStatus();
       mapreduceNodes = clusterStatus.getTaskTrackers();
       mapTasks = clusterStatus.getMapTasks();
       reduceTasks = clusterStatus.getReduceTasks();
+      mapSlots = clusterStatus.getMaxMapTasks();
+      reduceSlots = clusterStatus.getMaxReduceTasks();
     }
 
     public String toString() {
       return gson.toJson(this);
     }
+
+    // Gzipped and base64-encoded, ready for a form field
+    public String compress() throws IOException {
+      ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+      GZIPOutputStream gzip = new GZIPOutputStream(bytes);
+      gzip.write(toString().getBytes("UTF-8"));
+      gzip.close();
+      return new String(Base64.encodeBase64(bytes.toByteArray()), "US-ASCII");
+    }
+  }
+
+  // What the coordinator replies
+  class Ack {
+    public long ack;
+    public boolean resync;
+  }
+
+  // Refresh our view of every job the JobTracker lists
+  void updateJobs() throws IOException {
+    long now = System.currentTimeMillis() / 1000;
+    Set<String> listed = new HashSet<String>();
+    for (JobStatus job : jobClient.getAllJobs()) {
+      String key = job.getJobID().toString();
+      listed.add(key);
+      if (expired.contains(key)) {
+        continue;
+      }
+      JobState state = jobs.get(key);
+      if (state == null) {
+        state = new JobState(job);
+        jobs.put(key, state);
+      } else {
+        state.update(job);
+      }
+      if (state.isFinished() && state.finishTime != 0 && now - state.finishTime > RETENTION_TIME) {
+        jobs.remove(key);
+        expired.add(key);
+        removed.add(key);
+      } else {
+        state.noteChanges(seq + 1);
+      }
+    }
+    // Once the JobTracker retires a job, there's no need to remember it
+    expired.retainAll(listed);
+  }
+
+  // Build the next update: everything since the last acknowledged one
+  ProgressResult nextUpdate() throws IOException {
+    ProgressResult prog = new ProgressResult();
+    prog.seq = ++seq;
+    prog.base = ackedSeq;
+    prog.jobs = new ArrayList<JobState>();
+    for (JobState job : jobs.values()) {
+      if (ackedSeq == 0 || job.changedSeq > ackedSeq) {
+        prog.jobs.add(job);
+      }
+    }
+    prog.removed = new ArrayList<String>(removed);
+    return prog;
+  }
+
+  void handleReply(ProgressResult prog, String reply) {
+    Ack ack;
+    try {
+      ack = gson.fromJson(reply, Ack.class);
+    } catch (JsonSyntaxException e) {
+      System.err.println("Bad reply from coordinator: " + reply);
+      return;
+    }
+    if (ack == null) {
+      return;
+    }
+    if (ack.resync) {
+      // The coordinator lost track (it probably restarted); send everything
+      ackedSeq = 0;
+    } else if (ack.ack == prog.seq) {
+      ackedSeq = prog.seq;
+      // The coordinator has forgotten these now
+      removed.removeAll(prog.removed);
+    }
   }
 
   public void run () {
     while (true) {
       // Keep trying if there's a problem
       try {
-        ProgressResult prog = new ProgressResult();
-        for (JobStatus job : jobClient.getAllJobs()) {
-          String key = job.getJobID().toString();
-          if (jobs.containsKey(key)) {
-            jobs.get(key).update(job);
-          } else {
-            jobs.put(key, new JobState(job));
-          }
-        }
-        prog.jobs = new ArrayList<JobState>(jobs.values());
-        String data = "data=" + URLEncoder.encode(prog.toString(), "UTF-8");
-        client.send("https://coordinator:8888/hadoop/status_update", data);
+        updateJobs();
+        ProgressResult prog = nextUpdate();
+        String data = "zdata=" + URLEncoder.encode(prog.compress(), "UTF-8");
+        handleReply(prog, client.send("https://coordinator:8888/hadoop/status_update", data));
       } catch (IOException e) {
         System.err.println("Couldn't get or send progress: " + e);
       }
@@ -17,7 +17,10 @@ package com.google;
 
 // Utility class to POST to HTTPS endpoints with self-signed certificates
 
+import java.io.ByteArrayOutputStream;
 import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
 
 /**
  *
@@ -25,9 +28,38 @@ import java.io.IOException;
 class HttpsClient {
   public HttpsClient() {}
 
-  public void send(String address, String data) throws IOException {
-    // HTTPS with self-signed certificates in Java takes too much effort to get right
-    String command[] = {"curl", address, "-k", "-d", data};
-    Runtime.getRuntime().exec(command);
+  // Returns the body of the reply
+  public String send(String address, String data) throws IOException {
+    // HTTPS with self-signed certificates in Java takes too much effort to get right.
+    // The data goes through stdin, since it can be larger than a command line allows.
+    String command[] = {"curl", address, "-k", "-s", "-S", "--data-binary", "@-"};
+    Process curl = Runtime.getRuntime().exec(command);
+    OutputStream in = curl.getOutputStream();
+    try {
+      in.write(data.getBytes("UTF-8"));
+    } finally {
+      in.close();
+    }
+
+    ByteArrayOutputStream reply = new ByteArrayOutputStream();
+    InputStream out = curl.getInputStream();
+    try {
+      byte[] buffer = new byte[4096];
+      int n;
+      while ((n = out.read(buffer)) != -1) {
+        reply.write(buffer, 0, n);
+      }
+    } finally {
+      out.close();
+    }
+
+    try {
+      if (curl.waitFor() != 0) {
+        throw new IOException("curl to " + address + " exited with " + curl.exitValue());
+      }
+    } catch (InterruptedException e) {
+      throw new IOException("Interrupted talking to " + address);
+    }
+    return reply.toString("UTF-8");
   }
 }
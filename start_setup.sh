@@ -21,8 +21,11 @@ METADATA_URL='http://metadata/0.1/meta-data/attributes'
 USERNAME='hadoop'
 BOOTSTRAP="/home/${USERNAME}/bootstrap.sh"
 
-adduser ${USERNAME} --disabled-password --shell /bin/bash
-echo "${USERNAME} ALL=NOPASSWD: ALL" >> /etc/sudoers
+# This script runs again whenever the instance is reset
+if ! id ${USERNAME} > /dev/null 2>&1; then
+  adduser ${USERNAME} --disabled-password --shell /bin/bash
+  echo "${USERNAME} ALL=NOPASSWD: ALL" >> /etc/sudoers
+fi
 wget ${METADATA_URL}/bootstrap_sh -O ${BOOTSTRAP}
 chown ${USERNAME} ${BOOTSTRAP}
 chmod +x ${BOOTSTRAP}
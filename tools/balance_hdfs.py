@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spread HDFS blocks evenly across the slaves."""
+
+
+
+import common
+
+
+def main():
+  common.setup()
+  print 'Balancing HDFS...'
+  result = common.send_coordinator('/hadoop/balance', {}, verify=True)
+  common.poll_operation(result['operation'])
+
+if __name__ == '__main__':
+  main()
@@ -17,6 +17,7 @@
 
 
 
+import json
 import sys
 
 from cfg import cfg
@@ -26,17 +27,22 @@ import common
 def main():
   common.setup()
 
-  if len(sys.argv) != 2:
-    print 'USAGE: {0} num_slaves'.format(common.script_name())
+  if len(sys.argv) < 2:
+    print 'USAGE: {0} num_slaves [hadoop.property=value ...]'.format(
+        common.script_name())
+    print ('Hadoop is configured for the machine type automatically; any '
+           'properties given override that.')
     sys.exit(1)
   num_slaves = int(sys.argv[1])
+  conf = dict(arg.split('=', 1) for arg in sys.argv[2:])
   if num_slaves < cfg.needed_slaves:
     print ('Hadoop needs at least {0} slaves for filesystem '
            'replication').format(cfg.needed_slaves)
     sys.exit(1)
 
   print 'Setting up Hadoop...'
-  common.send_coordinator('/hadoop/launch', {'num_slaves': num_slaves})
+  common.send_coordinator('/hadoop/launch', {'num_slaves': num_slaves,
+                                             'conf': json.dumps(conf)})
   common.wait_for_hadoop()
 
 if __name__ == '__main__':
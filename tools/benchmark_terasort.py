@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the cluster with TeraSort and record the results.
+
+Generates, sorts and validates the given amount of data with tasks sized to
+the cluster, then appends a record of the run to a JSON results file. Run it
+at several cluster sizes (see add_slaves.py and remove_slaves.py) to build a
+scaling curve, which is printed from all the records in the file.
+"""
+
+
+
+import json
+import os
+import sys
+import time
+
+import common
+import job_terasort
+import pipeline
+
+RESULTS_FN = 'terasort_results.json'
+# Benchmark data lives apart from job_terasort.py's
+ROOT = '/benchmark'
+
+
+def load_results(fn):
+  if not os.path.exists(fn):
+    return []
+  with open(fn) as f:
+    return json.load(f)
+
+
+def record(status, gigabytes, counts, report):
+  """Summarize one run from its pipeline report."""
+  data = status['hadoop_data']
+  nodes = data['mapreduceNodes']
+  megabytes = gigabytes * 1000.0
+  result = {
+      'timestamp': time.time(),
+      'gigabytes': gigabytes,
+      'nodes': nodes,
+      'map_slots': data['mapSlots'],
+      'reduce_slots': data['reduceSlots'],
+      'map_tasks': counts[0],
+      'reduce_tasks': counts[1],
+      'succeeded': report['succeeded'],
+      'phases': {},
+  }
+  runs = []
+  for name in job_terasort.PHASE_NAMES:
+    step = report['steps'][name]
+    phase = {'state': step['state']}
+    detail = step['detail']
+    if isinstance(detail, dict) and detail.get('run_secs'):
+      phase['job_id'] = detail['job_id']
+      phase['queued_secs'] = detail['queued_secs']
+      phase['secs'] = detail['run_secs']
+      phase['mb_per_sec'] = megabytes / detail['run_secs']
+      phase['mb_per_sec_per_node'] = phase['mb_per_sec'] / nodes
+      runs.append(step)
+    result['phases'][name] = phase
+  # From the start of the first phase to the end of the last, queueing included
+  if runs:
+    result['wall_secs'] = runs[-1]['finished'] - runs[0]['started']
+  else:
+    result['wall_secs'] = None
+  return result
+
+
+def print_curve(results):
+  """Sort throughput against cluster size, for each data size."""
+  print '{0:>8} {1:>6} {2:>10} {3:>10} {4:>14}'.format(
+      'GB', 'nodes', 'wall secs', 'sort secs', 'sort MB/s/node')
+  for result in sorted(results, key=lambda r: (r['gigabytes'], r['nodes'])):
+    sort = result['phases']['terasort']
+    if 'secs' not in sort:
+      continue
+    print '{0:>8g} {1:>6} {2:>10.0f} {3:>10.0f} {4:>14.1f}'.format(
+        result['gigabytes'], result['nodes'], result['wall_secs'],
+        sort['secs'], sort['mb_per_sec_per_node'])
+
+
+def main():
+  common.setup()
+
+  if len(sys.argv) not in (2, 3):
+    print 'USAGE: {0} gigabytes [results.json]'.format(common.script_name())
+    sys.exit(1)
+  gigabytes = float(sys.argv[1])
+  results_fn = RESULTS_FN
+  if len(sys.argv) == 3:
+    results_fn = sys.argv[2]
+
+  jar = job_terasort.examples_jar()
+  status = common.send_coordinator('/status/cluster', {})
+  if status is None:
+    print 'The coordinator is not running, or you sent the wrong secret.'
+    sys.exit(1)
+  counts = job_terasort.task_counts(status['hadoop_data'], gigabytes)
+  if status['state'] != 'READY' or counts is None:
+    print 'Hadoop is not ready yet. Try tools/status.py'
+    sys.exit(1)
+  print '{0} GB on {1} nodes: {2} map tasks, {3} reduce tasks'.format(
+      gigabytes, status['hadoop_data']['mapreduceNodes'], *counts)
+
+  phases = job_terasort.phase_args(gigabytes, counts[0], counts[1], root=ROOT)
+  # Start from an empty directory, and leave nothing behind
+  steps = [{'name': 'clean_before', 'type': 'clean', 'path': ROOT}]
+  steps += job_terasort.pipeline_steps(jar, phases)
+  steps[1]['after'] = ['clean_before']
+  steps.append({'name': 'clean_after', 'type': 'clean', 'path': ROOT,
+                'after': [job_terasort.PHASE_NAMES[-1]]})
+  report = pipeline.run(steps)
+
+  results = load_results(results_fn)
+  results.append(record(status, gigabytes, counts, report))
+  with open(results_fn, 'w') as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+  print 'Results appended to {0}'.format(results_fn)
+  print
+  print_curve(results)
+  if not report['succeeded']:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
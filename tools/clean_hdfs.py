@@ -24,13 +24,19 @@ import common
 
 def main():
   common.setup()
-  if len(sys.argv) != 3 or sys.argv[1] != '-f':
-    print 'USAGE: {0} -f hdfs_path'.format(common.script_name())
-    print 'WARNING: This deletes hdfs_path from your cluster.'
+  args = sys.argv[1:]
+  skip_trash = '-skipTrash' in args
+  if skip_trash:
+    args.remove('-skipTrash')
+  if len(args) < 2 or args[0] != '-f':
+    print 'USAGE: {0} -f [-skipTrash] hdfs_path...'.format(
+        common.script_name())
+    print 'WARNING: This deletes each hdfs_path from your cluster.'
+    print 'Paths may be globs; quote them so your shell leaves them alone.'
     sys.exit(1)
 
-  nix = sys.argv[2]
-  common.send_coordinator('/job/clean', {'path': nix}, verify=True)
+  if common.clean(args[1:], skip_trash) != 'Done':
+    sys.exit(1)
 
 if __name__ == '__main__':
   main()
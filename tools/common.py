@@ -16,12 +16,23 @@
 
 
 
+import base64
+import codecs
+import hashlib
+import heapq
+import httplib
 import json
+import math
 import os
 import pprint
+import Queue
+import shutil
+import socket
 import subprocess
 import sys
+import tempfile
 import textwrap
+import threading
 import time
 import urlparse
 import uuid
@@ -30,6 +41,16 @@ from cfg import cfg
 import util
 
 
+# Remembers the coordinator's IP between tool runs, so most tools never touch
+# the Compute API
+SESSION_FN = '.session'
+
+# Each thread keeps one httplib2.Http per whole number of seconds of timeout,
+# so repeated calls to the coordinator reuse its connection instead of doing a
+# new SSL handshake
+connections = threading.local()
+
+
 def setup():
   # CHANGE ME
   cfg.set_bucket('GS-bucket')
@@ -40,54 +61,419 @@ def setup():
   if not cfg.secret:
     print 'Run tools/gen_passwd.py first to generate a password.'
     sys.exit(1)
-  util.setup_api(service_account=False)
+  # Credentials are only loaded once something needs the API
+  util.setup_api(service_account=False, lazy=True)
+
+
+def load_session():
+  try:
+    with open(SESSION_FN) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
 
+def forget_session():
+  """Call when the coordinator is replaced or deleted."""
+  if os.path.exists(SESSION_FN):
+    os.remove(SESSION_FN)
+  util.ip_cache.pop(cfg.coordinator, None)
 
-def send_coordinator(cmd, data, verify=False):
+
+def coordinator_address():
+  """Find the coordinator's IP, from the session if possible.
+
+  Returns:
+    (the IP or None if there's no coordinator, whether it came from the session)
+  """
+  session = load_session()
+  if session.get('coordinator_ip'):
+    return (session['coordinator_ip'], True)
+  ip = util.name_to_ip(cfg.coordinator)
+  if ip:
+    with open(SESSION_FN, 'w') as f:
+      json.dump({'coordinator_ip': ip}, f)
+  return (ip, False)
+
+
+def coordinator_connection(timeout):
+  timeout = int(math.ceil(timeout))
+  if not hasattr(connections, 'by_timeout'):
+    connections.by_timeout = {}
+  if timeout not in connections.by_timeout:
+    connections.by_timeout[timeout] = util.new_connection(timeout)
+  return connections.by_timeout[timeout]
+
+
+def send_coordinator(cmd, data, verify=False, timeout=5):
   data['secret'] = cfg.secret
-  if verify:
-    return util.checked_do(cfg.coordinator, cmd, data=data)
-  else:
-    return util.talk_to_agent(util.name_to_ip(cfg.coordinator), cmd, data=data)
+  address, cached = coordinator_address()
+  result = util.talk_to_agent(address, cmd, data=data, timeout=timeout,
+                              http=coordinator_connection(timeout))
+  if result is None and cached:
+    # The coordinator may have been relaunched with a new IP. Only retry if
+    # it did, so a call that merely timed out isn't sent twice.
+    forget_session()
+    new_address, _ = coordinator_address()
+    if new_address != address:
+      result = util.talk_to_agent(new_address, cmd, data=data,
+                                  timeout=timeout,
+                                  http=coordinator_connection(timeout))
+  if verify and (result is None or result['result'] != 'ok'):
+    raise Exception('{0}{1} failed: {2}'.format(cfg.coordinator, cmd, result))
+  return result
+
+
+class Progress(object):
+  """Prints how much of a transfer is done and how fast it's going."""
+
+  def __init__(self, total, quiet=False):
+    self.total = total
+    self.done = 0
+    self.quiet = quiet
+    self.start = time.time()
+    self.lock = threading.Lock()
+
+  def add(self, num_bytes):
+    with self.lock:
+      self.done += num_bytes
+      if not self.quiet:
+        sys.stdout.write('\r{0} of {1}, {2}/s   '.format(
+            human_bytes(self.done), human_bytes(self.total),
+            human_bytes(self.rate())))
+        sys.stdout.flush()
+
+  def rate(self):
+    return self.done / max(time.time() - self.start, 0.001)
+
+  def finish(self):
+    if not self.quiet:
+      print
+
+
+def run_threads(target, count):
+  """Runs target on count threads and waits for all of them."""
+  threads = []
+  for _ in range(count):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+  # Join with a timeout so Ctrl-C still works
+  for thread in threads:
+    while thread.is_alive():
+      thread.join(1)
+
+
+def send_chunk(upload_id, index, data):
+  """Sends one chunk of an upload, retrying. Returns True if it arrived.
 
+  A chunk that comes too far ahead of the ones the NameNode is writing is sent
+  again after a pause, without using up an attempt.
+  """
+  params = {'upload_id': upload_id, 'index': index,
+            'sha1': hashlib.sha1(data).hexdigest()}
+  attempts = 0
+  deadline = time.time() + cfg.upload_stall_secs
+  while attempts < cfg.upload_attempts:
+    address, _ = coordinator_address()
+    result = util.send_data(address, '/upload/chunk', params, data,
+                            headers={'X-Secret': cfg.secret},
+                            http=coordinator_connection(60))
+    if result and result['result'] == 'ok':
+      return True
+    if result and result.get('early') and time.time() < deadline:
+      time.sleep(cfg.poll_delay_secs)
+    else:
+      attempts += 1
+  return False
+
+
+def upload_via_gs(path, hdfs_dst, quiet=False):
+  """Stages a local file in a temporary GS object, then copies it into HDFS.
 
-def put_file(uri):
-  """Uploads uri to GS if it's a local file. Returns (filename, is_gs)."""
-  if urlparse.urlparse(uri).scheme:
-    return (uri, False)
+  Returns:
+    Like upload_local.
+  """
+  gs_fn = 'gs://{0}/tmp_hadoop/{1}/{2}'.format(cfg.gs_bucket, uuid.uuid1(),
+                                               os.path.basename(path))
+  if subprocess.call(['gsutil', 'cp', path, gs_fn]) != 0:
+    return 'Error: could not copy {0} to {1}'.format(path, gs_fn)
+  try:
+    result = send_coordinator('/transfer', {'src': gs_fn, 'dst': hdfs_dst},
+                              verify=True)
+    return wait_for_operation(result['operation'], quiet=quiet)
+  finally:
+    subprocess.call(['gsutil', 'rm', gs_fn])
+
+
+def upload_local(path, hdfs_dst, quiet=False, via_gs=None):
+  """Sends a local file straight into HDFS, a few chunks at a time.
+
+  The chunks travel through the coordinator to the NameNode, which streams them
+  into HDFS in order. Running this again for the same file and destination
+  resumes an interrupted upload, sending only the chunks the NameNode lacks, as
+  long as its snitch hasn't restarted.
+
+  Args:
+    path: the local file
+    hdfs_dst: the HDFS path to write
+    quiet: if true, don't print progress
+    via_gs: if true, use upload_via_gs instead; cfg.upload_via_gs by default
+
+  Returns:
+    The final state of the upload, either 'Done' or a message starting with
+    'Error'.
+  """
+  if via_gs is None:
+    via_gs = cfg.upload_via_gs
+  if via_gs:
+    return upload_via_gs(path, hdfs_dst, quiet=quiet)
+  size = os.path.getsize(path)
+  chunk_bytes = cfg.upload_chunk_bytes
+  upload_id = hashlib.sha1(json.dumps([os.path.abspath(path), size,
+                                       os.path.getmtime(path),
+                                       hdfs_dst])).hexdigest()
+  result = send_coordinator('/upload/start',
+                            {'upload_id': upload_id, 'dst': hdfs_dst,
+                             'size': size, 'chunk_bytes': chunk_bytes},
+                            verify=True, timeout=30)
+  received = set(result['chunks'])
+  num_chunks = max(1, (size + chunk_bytes - 1) / chunk_bytes)
+  todo = Queue.Queue()
+  for index in range(num_chunks):
+    if index not in received:
+      todo.put(index)
+  if received and not quiet:
+    print 'Resuming: {0} of {1} chunks were already sent'.format(
+        len(received), num_chunks)
+
+  progress = Progress(size, quiet)
+  progress.add(min(size, len(received) * chunk_bytes))
+  failed = []
+
+  def send_chunks():
+    with open(path, 'rb') as f:
+      while not failed:
+        try:
+          index = todo.get_nowait()
+        except Queue.Empty:
+          return
+        f.seek(index * chunk_bytes)
+        data = f.read(chunk_bytes)
+        if not send_chunk(upload_id, index, data):
+          failed.append(index)
+          return
+        progress.add(len(data))
+
+  run_threads(send_chunks, cfg.upload_streams)
+  progress.finish()
+  if failed:
+    return 'Error: chunk {0} could not be sent. Run again to resume.'.format(
+        failed[0])
+
+  result = send_coordinator('/upload/finish', {'upload_id': upload_id},
+                            verify=True)
+  return wait_for_operation(result['operation'], quiet=quiet)
+
+
+def fetch_file(src, dst, progress):
+  """Streams one HDFS file into a local file, retrying.
+
+  Returns:
+    True if the whole file arrived.
+  """
+  for _ in range(cfg.download_file_attempts):
+    address, _ = coordinator_address()
+    resp = util.open_stream(address, '/download/read',
+                            {'path': src['path'], 'secret': cfg.secret})
+    if resp is None:
+      continue
+    got = 0
+    try:
+      with open(dst + '.tmp', 'wb') as out:
+        while True:
+          block = resp.read(cfg.download_block_bytes)
+          if not block:
+            break
+          out.write(block)
+          got += len(block)
+          progress.add(len(block))
+    except (httplib.HTTPException, socket.error):
+      pass
+    finally:
+      resp.close()
+    # A stream cut short just ends, so check the size
+    if got == src['size']:
+      os.rename(dst + '.tmp', dst)
+      return True
+    progress.add(-got)
+  if os.path.exists(dst + '.tmp'):
+    os.remove(dst + '.tmp')
+  return False
+
+
+def merge_sorted(paths, dst, work_dir):
+  """Merges files of sorted lines into dst, a few files at a time."""
+  while len(paths) > cfg.download_merge_fanin:
+    merged = []
+    for i in range(0, len(paths), cfg.download_merge_fanin):
+      fd, path = tempfile.mkstemp(dir=work_dir)
+      os.close(fd)
+      merge_sorted(paths[i:i + cfg.download_merge_fanin], path, work_dir)
+      merged.append(path)
+    paths = merged
+  inputs = [open(path, 'rb') for path in paths]
+  try:
+    with open(dst, 'wb') as out:
+      for line in heapq.merge(*inputs):
+        # The last line of a file may lack its newline
+        if not line.endswith('\n'):
+          line += '\n'
+        out.write(line)
+  finally:
+    for f in inputs:
+      f.close()
+  for path in paths:
+    os.remove(path)
+
+
+def download_local(src, dst, merge=None, quiet=False):
+  """Streams the files under an HDFS path or glob to the local disk.
+
+  A few files are fetched at once, through the coordinator and any instance
+  running Hadoop, and memory use stays bounded however big they are.
+
+  Args:
+    src: an HDFS path or glob. A directory's files are fetched, but not its
+         subdirectories.
+    dst: a local directory to put one file per HDFS file in, or with merge,
+         the local file to write
+    merge: None, 'concat' to join the files in order of their names, appending
+           each as soon as the ones before it have arrived, or 'sort' to merge
+           their lines, assuming each file is sorted (like MapReduce output)
+    quiet: don't print progress
+
+  Returns:
+    True if every file arrived.
+  """
+  files = send_coordinator('/download/list', {'path': src}, verify=True,
+                           timeout=60)['files']
+  if merge:
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(dst)))
+    targets = [os.path.join(work_dir, '{0:08d}'.format(i))
+               for i in range(len(files))]
   else:
-    # It's local, let's push first
-    gs_fn = 'gs://{0}/tmp_hadoop/{1}/{2}'.format(cfg.gs_bucket, uuid.uuid1(),
-                                                 os.path.basename(uri))
-    subprocess.call(['gsutil', 'cp', uri, gs_fn])
-    return (gs_fn, True)
+    if not os.path.isdir(dst):
+      os.makedirs(dst)
+    targets = [os.path.join(dst, os.path.basename(f['path'])) for f in files]
+  if not quiet:
+    print 'Downloading {0} files, {1}'.format(
+        len(files), human_bytes(sum(f['size'] for f in files)))
+
+  progress = Progress(sum(f['size'] for f in files), quiet)
+  todo = Queue.Queue()
+  for i in range(len(files)):
+    todo.put(i)
+  # Index of each file as it's done, or None if it failed
+  finished = Queue.Queue()
+
+  def fetch_files():
+    while True:
+      try:
+        i = todo.get_nowait()
+      except Queue.Empty:
+        return
+      ok = fetch_file(files[i], targets[i], progress)
+      finished.put(i if ok else None)
+
+  fetchers = threading.Thread(target=run_threads,
+                              args=(fetch_files, cfg.download_streams))
+  fetchers.daemon = True
+  fetchers.start()
+  # Collect the files as they finish, so concat can start early
+  done = set()
+  appended = 0
+  ok = True
+  out = open(dst, 'wb') if merge == 'concat' else None
+  for _ in range(len(files)):
+    while True:
+      # With a timeout so Ctrl-C still works
+      try:
+        i = finished.get(timeout=1)
+        break
+      except Queue.Empty:
+        pass
+    if i is None:
+      ok = False
+      continue
+    done.add(i)
+    while out and ok and appended in done:
+      with open(targets[appended], 'rb') as part:
+        shutil.copyfileobj(part, out)
+      os.remove(targets[appended])
+      appended += 1
+  fetchers.join()
+  if out:
+    out.close()
+  progress.finish()
+
+  if ok and merge == 'sort':
+    merge_sorted(targets, dst, work_dir)
+  if merge:
+    shutil.rmtree(work_dir, ignore_errors=True)
+  if not quiet:
+    elapsed = time.time() - progress.start
+    print '{0} in {1:.0f}s, {2}/s'.format(
+        human_bytes(progress.done), elapsed, human_bytes(progress.rate()))
+  return ok
+
+
+def wait_for_operation(op, quiet=False):
+  """Blocks until an operation is done, printing each state it goes through.
+
+  Returns:
+    The final state, either 'Done' or a message starting with 'Error'.
+  """
+  url = '/status/op/{0}/wait'.format(op)
+  state = None
+  while state != 'Done' and not (state or '').startswith('Error'):
+    # The coordinator replies as soon as the state changes
+    resp = send_coordinator(url, {'last_state': state or '',
+                                  'timeout': cfg.job_wait_max_secs},
+                            timeout=cfg.job_wait_max_secs + 10)
+    if resp is None:
+      time.sleep(cfg.poll_delay_secs)
+      continue
+    if resp['state'] != state and not quiet:
+      print resp['state']
+    state = resp['state']
+  return state
 
 
 def poll_operation(op):
-  """Blocks until a transfer operation is done."""
-  url = '/status/op/{0}'.format(op)
-  print 'Polling...'
-  while True:
-    resp = send_coordinator(url, {})
-    print resp['state']
-    if resp['state'] == 'Done':
-      break
-    time.sleep(cfg.poll_delay_secs)
+  """Blocks until an operation is done. Exits if it fails."""
+  print 'Waiting...'
+  if wait_for_operation(op) != 'Done':
+    sys.exit(1)
   print
 
 
-def upload(uri, hdfs_input=None):
-  """Blockingly sends a file to the coordinator to import into HDFS."""
+def upload(uri, hdfs_input=None, via_gs=None):
+  """Blockingly sends a file to the coordinator to import into HDFS.
+
+  A local file goes as upload_local sends it.
+  """
   if hdfs_input is None:
     hdfs_input = hdfs_for_upload(uri)
   print 'Uploading input...'
-  src, is_gs = put_file(uri)
-  result = send_coordinator('/transfer', {'src': src, 'dst': hdfs_input},
+  if not urlparse.urlparse(uri).scheme:
+    if upload_local(uri, hdfs_input, via_gs=via_gs) != 'Done':
+      sys.exit(1)
+    return hdfs_input
+  result = send_coordinator('/transfer', {'src': uri, 'dst': hdfs_input},
                             verify=True)
   poll_operation(result['operation'])
-  # Clean up GS
-  if is_gs:
-    subprocess.call(['gsutil', 'rm', src])
   return hdfs_input
 
 
@@ -100,26 +486,159 @@ def download(src, dst):
   return dst
 
 
+def clean(paths, skip_trash=False, quiet=False):
+  """Blockingly deletes HDFS paths or globs, several at a time.
+
+  Returns:
+    The final state of the deletion, either 'Done' or a message starting with
+    'Error'.
+  """
+  result = send_coordinator('/job/clean',
+                            {'paths': json.dumps(paths),
+                             'skip_trash': 'true' if skip_trash else 'false'},
+                            verify=True)
+  return wait_for_operation(result['operation'], quiet=quiet)
+
+
 def hdfs_for_upload(uri):
   return os.path.join('/job_input', str(uuid.uuid1()), os.path.basename(uri))
 
 
 def start_job(jar_uri, job_args):
+  """Submit a job. Local JARs are only uploaded if the JobTracker lacks them.
+
+  Returns:
+    The coordinator's ID for the job.
+  """
   print 'Starting job...'
-  jar, is_gs = put_file(jar_uri)
-  send_coordinator('/job/submit', {'jar': jar, 'job_args':
-                                   json.dumps(job_args)}, verify=True)
-  # Clean up GS
-  if is_gs:
-    subprocess.call(['gsutil', 'rm', jar])
-  print 'Submitted!'
-  return True
+  data = {'job_args': json.dumps(job_args)}
+  if not urlparse.urlparse(jar_uri).scheme:
+    data['jar_hash'] = util.file_digest(jar_uri)
+    cached = send_coordinator('/job/has_jar', {'jar_hash': data['jar_hash']},
+                              verify=True)['cached']
+    if cached:
+      print 'The JobTracker already has this JAR.'
+      data['jar'] = ''
+      # It could be evicted before we submit, so fall back to uploading
+      result = send_coordinator('/job/submit', data)
+      if result and result['result'] == 'ok':
+        print 'Submitted {0}!'.format(result['job_id'])
+        return result['job_id']
+
+  if 'jar_hash' in data:
+    # The JobTracker only downloads the JAR once the job leaves the queue, so
+    # the coordinator deletes it once the job finishes. Naming it by its hash
+    # means repeated uploads just overwrite it.
+    jar = '{0}{1}.jar'.format(cfg.gs_jar_cache, data['jar_hash'])
+    subprocess.call(['gsutil', 'cp', jar_uri, jar])
+  else:
+    jar = jar_uri
+  data['jar'] = jar
+  result = send_coordinator('/job/submit', data, verify=True)
+  print 'Submitted {0}!'.format(result['job_id'])
+  return result['job_id']
+
+
+def wait_for_job(job_id):
+  """Blocks until the job finishes. Returns the coordinator's record of it."""
+  while True:
+    job = send_coordinator('/job/wait/{0}'.format(job_id),
+                           {'timeout': cfg.job_wait_max_secs},
+                           verify=True, timeout=cfg.job_wait_max_secs + 10)
+    if job['finished'] is not None:
+      break
+    print '{0} is {1}'.format(job_id, job['state'])
+  if job['started'] is None:
+    print '{0} {1} before it started: {2}'.format(job_id, job['state'],
+                                                  job.get('reason'))
+  else:
+    print '{0} {1} with exit code {2} after {3:.0f}s'.format(
+        job_id, job['state'], job['exit_code'],
+        job['finished'] - job['started'])
+  return job
+
+
+def follow_job_log(job_id, offset=0):
+  """Prints a job driver's output as it's written, until the job finishes.
+
+  Returns:
+    The job's final state.
+  """
+  # Holds on to a character split between chunks until the rest arrives
+  decoder = codecs.getincrementaldecoder('utf-8')('replace')
+  while True:
+    chunk = send_coordinator('/job/log/{0}'.format(job_id),
+                             {'offset': offset,
+                              'timeout': cfg.job_log_wait_secs},
+                             verify=True, timeout=cfg.job_log_wait_secs + 20)
+    data = base64.b64decode(chunk['data'])
+    # Only stop once the whole log is read; the driver closes it before the
+    # job is marked finished
+    done = not data and chunk['state'] in ('SUCCEEDED', 'FAILED')
+    sys.stdout.write(decoder.decode(data, final=done).encode('utf-8'))
+    sys.stdout.flush()
+    offset = chunk['offset']
+    if done:
+      return chunk['state']
+
+
+# Counters shown for each job, and how to label them
+SHOWN_COUNTERS = [
+    ('HDFS_BYTES_READ', 'HDFS read'),
+    ('HDFS_BYTES_WRITTEN', 'HDFS written'),
+    ('FILE_BYTES_WRITTEN', 'local written'),
+    ('REDUCE_SHUFFLE_BYTES', 'shuffled'),
+]
+
+
+def human_bytes(num):
+  for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+    if num < 1024 or unit == 'TB':
+      return '{0:.1f}{1}'.format(num, unit)
+    num /= 1024.0
+
+
+def pprint_job(job):
+  """Pretty-prints one job from HadoopMonitor's data."""
+  print '{0} {1}: map {2:.0%}, reduce {3:.0%}, {4}s'.format(
+      job['id'], job['status'], job['mapProgress'], job['reduceProgress'],
+      job['elapsedSeconds'])
+  counters = job.get('counters') or {}
+  shown = ['{0} {1}'.format(label, human_bytes(counters[name]))
+           for name, label in SHOWN_COUNTERS if name in counters]
+  if 'SPILLED_RECORDS' in counters and counters.get('MAP_OUTPUT_RECORDS'):
+    # Above 1 means map output was spilled to disk more than once
+    shown.append('spills/output record {0:.2f}'.format(
+        float(counters['SPILLED_RECORDS']) / counters['MAP_OUTPUT_RECORDS']))
+  if shown:
+    print '  ' + ', '.join(shown)
+  for kind in ['map', 'reduce']:
+    times = job.get(kind + 'Times')
+    if not times or not times['completed']:
+      continue
+    print '  {0} attempts: {1} done, median {2}s, p90 {3}s, max {4}s'.format(
+        kind, times['completed'], times['median'], times['p90'], times['max'])
+    for task in times['stragglers']:
+      print '    straggler {0}: {1}s, {2:.0%} done'.format(
+          task['taskId'], task['elapsedSeconds'], task['progress'])
+
+
+def pprint_hadoop(data):
+  """Pretty-prints the data HadoopMonitor sends."""
+  if not data:
+    print 'No data from Hadoop yet'
+    return
+  print '{0} nodes, {1}/{2} map slots and {3}/{4} reduce slots busy'.format(
+      data['mapreduceNodes'], data['mapTasks'], data.get('mapSlots', '?'),
+      data['reduceTasks'], data.get('reduceSlots', '?'))
+  for job in data.get('jobs', []):
+    pprint_job(job)
 
 
 def pprint_status(data):
   """Pretty-prints the data from the /status/cluster call."""
   print '=== Hadoop data ({0} seconds old) ==='.format(data['hadoop_staleness'])
-  pprint.pprint(data['hadoop_data'])
+  pprint_hadoop(data['hadoop_data'])
   print
   print '=== Upload/download operations ==='
   pprint.pprint(data['operations'])
@@ -138,26 +657,109 @@ def pprint_status(data):
       print '=== {0} ==='.format(state)
       print columnize(sorted(data['instances'][state]))
       print
+  if data.get('launch'):
+    launch = data['launch']
+    print '=== Slave launch ==='
+    for wave in launch['waves']:
+      print 'Wave {0}: {1}/{2} inserted in {3:.0f}s'.format(
+          wave['wave'], wave['inserted'], wave['size'], wave['duration_secs'])
+    if launch['current_wave']:
+      wave = launch['current_wave']
+      print 'Wave {0}: {1}/{2} inserts returned so far'.format(
+          wave['wave'], wave['inserted'] + wave['failed'], wave['size'])
+    print '{0} slaves waiting, next wave of {1}'.format(launch['pending'],
+                                                        launch['wave_size'])
+    print
+  if data.get('warm_pool') and data['warm_pool']['target']:
+    pool = data['warm_pool']
+    print '=== Warm pool ==='
+    print '{0}/{1} warm, {2} on the way'.format(pool['ready'], pool['target'],
+                                                pool['filling'])
+    if pool['hit_rate'] is not None:
+      print '{0} of {1} requested slaves came from the pool ({2:.0%})'.format(
+          pool['hits'], pool['hits'] + pool['misses'], pool['hit_rate'])
+    print
   print 'Summary: {0}'.format(data['summary'])
   print 'Cluster state: {0}'.format(data['state'])
 
 
+def apply_changes(dashboard, update):
+  """Merge a /status/changes reply into dashboard, in place."""
+  if update['full']:
+    dashboard.clear()
+    dashboard.update(update['changes'])
+    return
+  for key, value in update['changes'].items():
+    if isinstance(value, dict) and isinstance(dashboard.get(key), dict):
+      for sub, sub_value in value.items():
+        if sub_value is None:
+          dashboard[key].pop(sub, None)
+        else:
+          dashboard[key][sub] = sub_value
+    else:
+      dashboard[key] = value
+
+
+def dashboard_updates():
+  """Yields the coordinator's dashboard every time it changes.
+
+  Only the changes are sent. Yields None when the coordinator can't be reached.
+  """
+  dashboard = {}
+  version = 0
+  while True:
+    update = send_coordinator('/status/changes',
+                              {'since': version,
+                               'timeout': cfg.job_wait_max_secs},
+                              timeout=cfg.job_wait_max_secs + 10)
+    if update is None:
+      yield None
+      time.sleep(cfg.poll_delay_secs)
+      continue
+    if update['version'] == version:
+      # Timed out with nothing new
+      continue
+    apply_changes(dashboard, update)
+    version = update['version']
+    yield dashboard
+
+
+def summary_line(dashboard):
+  """Describes the cluster in a line, from the dashboard."""
+  counts = dashboard['instances']
+  states = ', '.join('{0} {1}'.format(counts[s[1]], s[1])
+                     for s in util.InstanceState.desc_order
+                     if counts.get(s[1]))
+  line = '{0}: {1}'.format(dashboard['state'], states or 'no instances')
+  launch = dashboard['launch']
+  if launch.get('pending'):
+    line += '; {0} slaves waiting to launch'.format(launch['pending'])
+  if launch.get('per_min'):
+    line += ', {0}/min'.format(launch['per_min'])
+  return line
+
+
 def wait_for_hadoop():
-  """Blocks until the coordinator says Hadoop is ready."""
+  """Blocks until the coordinator says Hadoop is ready.
+
+  Prints a line each time the cluster changes, plus any new instance errors.
+  """
   print 'Waiting for Hadoop to be ready for jobs...'
-  while True:
-    state = send_coordinator('/status/cluster', {})
-    print '-' * 80
-    try:
-      pprint_status(state)
-      if state['state'] == 'READY':
-        break
-      if state['state'] == 'BROKEN':
-        print 'Oops?'
-        sys.exit(1)
-    except TypeError:
+  errors = 0
+  for dashboard in dashboard_updates():
+    if dashboard is None:
       print 'The coordinator is not running, or you sent the wrong secret.'
-    time.sleep(cfg.poll_delay_secs)
+      continue
+    print '[{0}] {1}'.format(time.strftime('%X'), summary_line(dashboard))
+    if dashboard['errors'] > errors:
+      errors = dashboard['errors']
+      print '  {0} errors, latest: {1}'.format(errors,
+                                               dashboard['last_error'])
+    if dashboard['state'] == 'READY':
+      break
+    if dashboard['state'] == 'BROKEN':
+      print 'Oops?'
+      sys.exit(1)
   print
 
 
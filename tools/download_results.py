@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Export data from HDFS into GS."""
+"""Export data from HDFS into GS, or stream it straight to local disk."""
 
 
 
@@ -22,10 +22,23 @@ import sys
 from cfg import cfg
 import common
 
+MERGE_FLAGS = {'-local': None, '-concat': 'concat', '-sort': 'sort'}
+
 
 def main():
   common.setup()
-  usage = 'USAGE: {0} hdfs_src gs_dst'.format(common.script_name())
+  usage = '\n'.join([
+      'USAGE: {0} hdfs_src gs_dst',
+      '       {0} -local hdfs_src local_dir',
+      '       {0} -concat|-sort hdfs_src local_file']).format(
+          common.script_name())
+  if len(sys.argv) == 4 and sys.argv[1] in MERGE_FLAGS:
+    # -concat joins the files in order; -sort merges their sorted lines
+    if not common.download_local(sys.argv[2], sys.argv[3],
+                                 merge=MERGE_FLAGS[sys.argv[1]]):
+      print 'Some files could not be downloaded.'
+      sys.exit(1)
+    return
   if len(sys.argv) != 3:
     print usage
     sys.exit(1)
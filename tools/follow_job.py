@@ -0,0 +1,41 @@
+#!/usr/bin/python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Print a submitted job's driver output as it runs, like tail -f."""
+
+
+
+import sys
+
+import common
+
+
+def main():
+  common.setup()
+
+  if len(sys.argv) not in (2, 3):
+    print 'USAGE: {0} job_id [offset]'.format(common.script_name())
+    sys.exit(1)
+  offset = 0
+  if len(sys.argv) == 3:
+    offset = int(sys.argv[2])
+
+  state = common.follow_job_log(sys.argv[1], offset)
+  print '{0} {1}'.format(sys.argv[1], state)
+  if state != 'SUCCEEDED':
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
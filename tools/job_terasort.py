@@ -15,30 +15,40 @@
 
 """Run a TeraSort MapReduce job.
 
-Phase 1 generates 1TB of data within your cluster.
+Phase 1 generates data within your cluster (1TB unless you say otherwise).
 Phase 2 sorts the data.
 Phase 3 verifies the sort was correct.
+'all' runs the three phases back to back, timing each.
+
+Map and reduce task counts are sized from the slots Hadoop reports.
 """
 
 
 
+import math
 import os.path
 import sys
 
 from cfg import cfg
 import common
+import pipeline
 
+INPUT = '/job_input/terasort'
+OUTPUT = '/job_output/terasort'
+VALIDATE = '/job_output/teravalidate'
+PHASE_NAMES = ['teragen', 'terasort', 'teravalidate']
 
-def main():
-  common.setup()
-  usage = ('USAGE: {0} [1,2,3]\nPhase 1 generates data, phase 2 sorts it, and '
-           'phase 3 validates it.'.format(common.script_name()))
+# Most data one teragen map writes, so big runs take several waves of maps
+MAX_GB_PER_MAP = 1.0
+# Hadoop's advice: 0.95 of the reduce slots, so every reduce runs in one wave
+# and a failed one can rerun right away
+REDUCE_SLOT_SHARE = 0.95
+# When Hadoop isn't reporting yet
+DEFAULT_TASKS = 100
 
-  if len(sys.argv) != 2:
-    print usage
-    sys.exit(1)
 
-  # Detect if the user has the jar
+def examples_jar():
+  """Returns the local examples JAR, or exits telling the user how to get it."""
   jar = 'hadoop-examples-{0}.jar'.format(cfg.hadoop_version)
   if not os.path.exists(jar):
     print ('You need {0}, which contains the Terasort MapReduce job, in your '
@@ -52,32 +62,91 @@ def main():
     print 'tar xzf {0}'.format(tarball)
     print 'cp {0}/{1} .'.format(cfg.hadoop_fn, jar)
     sys.exit(1)
+  return jar
 
-  # TODO Figure out number of tasks programatically. The defaults are sometimes
-  # 1.
-  num_tasks = 100
-  phase = sys.argv[1]
 
-  job_args = []
-  if phase == '1':
-    gigabytes = 1000
-    # Convert GB->bytes, then divide by 100
-    hundred_bytes = gigabytes * (10 ** 7)
-
-    job_args = ['teragen', '-Dmapred.map.tasks={0}'.format(num_tasks),
-                hundred_bytes, '/job_input/terasort']
-  elif phase == '2':
-    # The terasort driver automatically uses as many map tasks as possible.
-    job_args = ['terasort', '-Dmapred.reduce.tasks={0}'.format(num_tasks),
-                '/job_input/terasort', '/job_output/terasort']
-  elif phase == '3':
-    job_args = ['teravalidate', '/job_output/terasort',
-                '/job_output/teravalidate']
-  else:
+def task_counts(hadoop_data, gigabytes):
+  """Size teragen's maps and terasort's reduces to the cluster.
+
+  Args:
+    hadoop_data: the 'hadoop_data' of a /status/cluster reply
+    gigabytes: how much data is generated and sorted
+
+  Returns:
+    (map tasks, reduce tasks), or None if Hadoop isn't reporting slots yet.
+  """
+  map_slots = hadoop_data.get('mapSlots')
+  reduce_slots = hadoop_data.get('reduceSlots')
+  if not map_slots or not reduce_slots:
+    return None
+  # Whole waves of maps, each writing at most MAX_GB_PER_MAP
+  waves = max(1, int(math.ceil(gigabytes / (map_slots * MAX_GB_PER_MAP))))
+  reduces = max(1, int(reduce_slots * REDUCE_SLOT_SHARE))
+  return (map_slots * waves, reduces)
+
+
+def phase_args(gigabytes, map_tasks, reduce_tasks, root=''):
+  """The arguments of each phase. root prefixes every HDFS path."""
+  # Convert GB->bytes, then divide by 100
+  hundred_bytes = int(gigabytes * (10 ** 7))
+  return {
+      '1': ['teragen', '-Dmapred.map.tasks={0}'.format(map_tasks),
+            hundred_bytes, root + INPUT],
+      # The terasort driver automatically uses as many map tasks as possible.
+      '2': ['terasort', '-Dmapred.reduce.tasks={0}'.format(reduce_tasks),
+            root + INPUT, root + OUTPUT],
+      '3': ['teravalidate', root + OUTPUT, root + VALIDATE],
+  }
+
+
+def pipeline_steps(jar, phases):
+  """Pipeline steps running the phases in order."""
+  steps = []
+  for i, name in enumerate(PHASE_NAMES):
+    step = {'name': name, 'type': 'job', 'jar': jar, 'args': phases[str(i + 1)]}
+    if i:
+      step['after'] = [PHASE_NAMES[i - 1]]
+    steps.append(step)
+  return steps
+
+
+def main():
+  common.setup()
+  usage = ('USAGE: {0} [1,2,3,all] [gigabytes]\nPhase 1 generates data, phase '
+           '2 sorts it, and phase 3 validates it. all runs the phases in order '
+           'and writes their timings to terasort_report.json.'.format(
+               common.script_name()))
+
+  if len(sys.argv) not in (2, 3) or sys.argv[1] not in ('1', '2', '3', 'all'):
     print usage
     sys.exit(1)
+  phase = sys.argv[1]
+  gigabytes = 1000
+  if len(sys.argv) == 3:
+    gigabytes = float(sys.argv[2])
+
+  jar = examples_jar()
 
-  common.start_job(jar, job_args)
+  status = common.send_coordinator('/status/cluster', {})
+  if status is None:
+    print 'The coordinator is not running, or you sent the wrong secret.'
+    sys.exit(1)
+  counts = task_counts(status['hadoop_data'], gigabytes)
+  if counts is None:
+    print "Hadoop isn't reporting its slots yet, so using {0} tasks.".format(
+        DEFAULT_TASKS)
+    counts = (DEFAULT_TASKS, DEFAULT_TASKS)
+  print '{0} map tasks, {1} reduce tasks'.format(*counts)
+  phases = phase_args(gigabytes, *counts)
+
+  if phase == 'all':
+    report = pipeline.run(pipeline_steps(jar, phases), 'terasort_report.json')
+    for name in PHASE_NAMES:
+      step = report['steps'][name]
+      print '{0}: {1} {2}'.format(name, step['state'],
+                                  step['duration_secs'] or '')
+  else:
+    common.start_job(jar, phases[phase])
 
 if __name__ == '__main__':
   main()
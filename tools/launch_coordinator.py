@@ -41,12 +41,14 @@ def main():
 
   print 'Packaging up the stuff the coordinator will need...'
   # tar will insert directories, so flatten the view a bit
-  subprocess.call(['cp', 'coordinator/coordinator.py', '.'])
-  subprocess.call(['cp', 'coordinator/hadoop_cluster.py', '.'])
+  modules = ['coordinator.py', 'hadoop_cluster.py', 'hadoop_conf.py',
+             'resources.py', 'timeseries.py', 'tracing.py']
+  for module in modules:
+    subprocess.call(['cp', 'coordinator/' + module, '.'])
   subprocess.call(['tar', 'czf', 'coordinator.tgz', 'hadoop', 'gcelib',
-                   'hadoop-tools.jar', 'cfg.py', 'util.py', 'coordinator.py',
-                   'hadoop_cluster.py', 'start_setup.sh'])
-  subprocess.call(['rm', 'coordinator.py', 'hadoop_cluster.py'])
+                   'hadoop-tools.jar', 'cfg.py', 'util.py', 'start_setup.sh'] +
+                  modules)
+  subprocess.call(['rm'] + modules)
   # Push to a fixed place for now
   subprocess.call(['gsutil', 'cp', 'coordinator.tgz',
                    cfg.gs_coordinators_tarball])
@@ -54,7 +56,9 @@ def main():
   print
 
   print 'Launching coordinator...'
-  util.api.insert_instance(
+  # The new coordinator gets a new IP
+  common.forget_session()
+  util.ensure_api().insert_instance(
       name=cfg.coordinator, zone=zone,
       machineType=machtype, image=image,
       serviceAccounts=gce_shortcuts.service_accounts([cfg.compute_scope,
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Save a timeline of the cluster's launch, and summarize its slowest steps.
+
+The timeline is in the Trace Event format; load it in chrome://tracing. Each
+instance shows the states the coordinator saw it in, the calls the coordinator
+made for it, and the startup steps the instance timed itself.
+"""
+
+
+
+import collections
+import json
+import sys
+
+import common
+
+TRACE_FN = 'launch_trace.json'
+
+
+def summarize(trace):
+  """Print how long each kind of step took across instances."""
+  durations = collections.defaultdict(list)
+  for event in trace['traceEvents']:
+    if event['ph'] == 'X':
+      durations[(event['cat'], event['name'])].append(event['dur'] / 1e6)
+  print '{0:<12} {1:<20} {2:>6} {3:>10} {4:>10}'.format(
+      'source', 'step', 'count', 'median s', 'max s')
+  for (source, name), secs in sorted(durations.items(),
+                                     key=lambda item: -max(item[1])):
+    secs.sort()
+    print '{0:<12} {1:<20} {2:>6} {3:>10.1f} {4:>10.1f}'.format(
+        source, name, len(secs), secs[len(secs) / 2], secs[-1])
+
+
+def main():
+  common.setup()
+
+  if len(sys.argv) > 2:
+    print 'USAGE: {0} [trace.json]'.format(common.script_name())
+    sys.exit(1)
+  trace_fn = TRACE_FN
+  if len(sys.argv) == 2:
+    trace_fn = sys.argv[1]
+
+  trace = common.send_coordinator('/status/trace', {}, timeout=60)
+  if trace is None:
+    print 'The coordinator is not running, or you sent the wrong secret.'
+    sys.exit(1)
+  with open(trace_fn, 'w') as f:
+    json.dump(trace, f)
+  summarize(trace)
+  print
+  print 'Timeline written to {0}; load it in chrome://tracing'.format(trace_fn)
+
+if __name__ == '__main__':
+  main()
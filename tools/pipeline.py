@@ -0,0 +1,215 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run a DAG of transfers, jobs and cleanups, each as soon as it can start.
+
+A pipeline is a list of steps, each a dictionary with a unique 'name', a
+'type', the names of the steps it runs 'after', and arguments for its type:
+
+  upload:   'src' (a local file, or a HTTP or GS URL), 'dst' (an HDFS path),
+            and optionally 'via_gs' (true to stage a local file in GS)
+  job:      'jar' (a local file, or a HTTP or GS URL), 'args' (a list)
+  download: 'src' (an HDFS path), 'dst' (a GS URL, or a local path to stream
+            the files to, with an optional 'merge' of 'concat' or 'sort')
+  clean:    'path' (an HDFS path or glob to delete) or 'paths' (a list), and
+            optionally 'skip_trash' (true to bypass the HDFS trash)
+
+Steps whose dependencies are done run concurrently. If a step fails, the steps
+depending on it are skipped.
+"""
+
+
+
+import json
+import threading
+import time
+import urlparse
+
+import common
+
+
+class PipelineError(Exception):
+  pass
+
+
+class Step(object):
+  """One node in the DAG and its timings."""
+
+  def __init__(self, spec):
+    self.spec = spec
+    self.name = spec['name']
+    self.after = spec.get('after', [])
+    self.state = 'WAITING'
+    self.detail = None
+    self.started = None
+    self.finished = None
+    self.done = threading.Event()
+
+  def report(self):
+    result = {'type': self.spec['type'], 'after': self.after,
+              'state': self.state, 'detail': self.detail,
+              'started': self.started, 'finished': self.finished,
+              'duration_secs': None}
+    if self.started and self.finished:
+      result['duration_secs'] = self.finished - self.started
+    return result
+
+
+def run_upload(spec):
+  if not urlparse.urlparse(spec['src']).scheme:
+    state = common.upload_local(spec['src'], spec['dst'], quiet=True,
+                                via_gs=spec.get('via_gs'))
+    return (state == 'Done', state)
+  result = common.send_coordinator('/transfer', {'src': spec['src'],
+                                                 'dst': spec['dst']},
+                                   verify=True)
+  state = common.wait_for_operation(result['operation'], quiet=True)
+  return (state == 'Done', state)
+
+
+def run_job(spec):
+  job_id = common.start_job(spec['jar'], spec.get('args', []))
+  job = common.wait_for_job(job_id)
+  detail = {'job_id': job_id, 'exit_code': job['exit_code'],
+            'hadoop_jobs': job['hadoop_jobs'],
+            # Time in the coordinator's queue, then time the driver ran
+            'queued_secs': None, 'run_secs': None}
+  if job['started'] is not None:
+    detail['queued_secs'] = job['started'] - job['submitted']
+    detail['run_secs'] = job['finished'] - job['started']
+  return (job['state'] == 'SUCCEEDED', detail)
+
+
+def run_download(spec):
+  if not urlparse.urlparse(spec['dst']).scheme:
+    ok = common.download_local(spec['src'], spec['dst'],
+                               merge=spec.get('merge'), quiet=True)
+    return (ok, None)
+  result = common.send_coordinator('/transfer', {'src': spec['src'],
+                                                 'dst': spec['dst']},
+                                   verify=True)
+  state = common.wait_for_operation(result['operation'], quiet=True)
+  return (state == 'Done', state)
+
+
+def run_clean(spec):
+  paths = spec.get('paths') or [spec['path']]
+  state = common.clean(paths, spec.get('skip_trash', False), quiet=True)
+  return (state == 'Done', state)
+
+
+RUNNERS = {
+    'upload': run_upload,
+    'job': run_job,
+    'download': run_download,
+    'clean': run_clean,
+}
+
+
+class Pipeline(object):
+  """Runs the steps of a pipeline, each on its own thread."""
+
+  def __init__(self, specs):
+    self.steps = {}
+    for spec in specs:
+      if spec['name'] in self.steps:
+        raise PipelineError('duplicate step {0}'.format(spec['name']))
+      if spec.get('type') not in RUNNERS:
+        raise PipelineError('step {0} has unknown type {1}'.format(
+            spec['name'], spec.get('type')))
+      self.steps[spec['name']] = Step(spec)
+    for step in self.steps.values():
+      for dep in step.after:
+        if dep not in self.steps:
+          raise PipelineError('{0} runs after unknown step {1}'.format(
+              step.name, dep))
+    self.check_acyclic()
+    self.lock = threading.Lock()
+
+  def check_acyclic(self):
+    visiting = set()
+    visited = set()
+
+    def visit(name):
+      if name in visited:
+        return
+      if name in visiting:
+        raise PipelineError('cycle through step {0}'.format(name))
+      visiting.add(name)
+      for dep in self.steps[name].after:
+        visit(dep)
+      visiting.remove(name)
+      visited.add(name)
+
+    for name in self.steps:
+      visit(name)
+
+  def log(self, msg):
+    with self.lock:
+      print '[{0}] {1}'.format(time.strftime('%X'), msg)
+
+  def run_step(self, step):
+    for dep in step.after:
+      self.steps[dep].done.wait()
+    failed = [dep for dep in step.after
+              if self.steps[dep].state != 'SUCCEEDED']
+    if failed:
+      step.state = 'SKIPPED'
+      step.detail = 'failed dependencies: {0}'.format(', '.join(failed))
+      self.log('{0} skipped'.format(step.name))
+      step.done.set()
+      return
+
+    step.state = 'RUNNING'
+    step.started = time.time()
+    self.log('{0} started'.format(step.name))
+    try:
+      ok, step.detail = RUNNERS[step.spec['type']](step.spec)
+    except Exception as e:
+      ok, step.detail = False, str(e)
+    step.finished = time.time()
+    step.state = 'SUCCEEDED' if ok else 'FAILED'
+    self.log('{0} {1} after {2:.0f}s'.format(step.name, step.state,
+                                             step.finished - step.started))
+    step.done.set()
+
+  def run(self):
+    """Runs every step. Returns a report with per-step timings."""
+    started = time.time()
+    threads = []
+    for step in self.steps.values():
+      thread = threading.Thread(target=self.run_step, args=(step,))
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+    # Join with a timeout so Ctrl-C still works
+    for thread in threads:
+      while thread.is_alive():
+        thread.join(1)
+    finished = time.time()
+    return {'started': started, 'finished': finished,
+            'duration_secs': finished - started,
+            'succeeded': all(step.state == 'SUCCEEDED'
+                             for step in self.steps.values()),
+            'steps': dict((name, step.report())
+                          for name, step in self.steps.items())}
+
+
+def run(specs, report_fn=None):
+  """Run a pipeline, optionally writing its JSON report. Returns the report."""
+  report = Pipeline(specs).run()
+  if report_fn:
+    with open(report_fn, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  return report
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Find where the coordinator or a snitch spends its time.
+
+Dump every thread's stack, or sample them all for a while and print the
+busiest stacks. Samples can also be saved in the collapsed format that flame
+graph tools read.
+"""
+
+
+
+import sys
+
+import common
+
+# Innermost frames shown for each of the busiest stacks
+FRAMES_SHOWN = 6
+
+
+def print_threads(threads):
+  for thread in threads:
+    line = thread['name']
+    if thread.get('task'):
+      line += ': running {0} for {1:.0f}s'.format(thread['task'],
+                                                  thread['busy_secs'])
+    print line
+    for frame in thread['stack']:
+      print '  ' + frame.replace('\n', '\n  ')
+    print
+
+
+def print_profile(profile):
+  samples = profile['samples']
+  print '{0} samples over {1}s'.format(samples, profile['seconds'])
+  print
+  print 'Busiest functions (share of samples a thread was in them):'
+  for entry in profile['functions']:
+    print '  {0:6.1%}  {1}'.format(float(entry['count']) / samples,
+                                   entry['function'])
+  print
+  print 'Busiest stacks:'
+  for entry in profile['stacks']:
+    print '  {0:6.1%}'.format(float(entry['count']) / samples)
+    for frame in entry['stack'][-FRAMES_SHOWN:]:
+      print '          ' + frame
+  print
+
+
+def main():
+  common.setup()
+
+  usage = '\n'.join([
+      'USAGE: {0} threads [instance]',
+      '       {0} seconds [instance] [collapsed_file]',
+      'Without an instance, the coordinator is examined.']).format(
+          common.script_name())
+  if len(sys.argv) not in (2, 3, 4):
+    print usage
+    sys.exit(1)
+  data = {}
+  if len(sys.argv) >= 3:
+    data['instance'] = sys.argv[2]
+
+  if sys.argv[1] == 'threads':
+    if len(sys.argv) == 4:
+      print usage
+      sys.exit(1)
+    result = common.send_coordinator('/debug/threads', data, verify=True,
+                                     timeout=30)
+    print_threads(result['threads'])
+    return
+
+  data['seconds'] = float(sys.argv[1])
+  print 'Sampling for {0}s...'.format(data['seconds'])
+  result = common.send_coordinator('/debug/profile', data, verify=True,
+                                   timeout=data['seconds'] + 60)
+  print_profile(result)
+  if len(sys.argv) == 4:
+    with open(sys.argv[3], 'w') as f:
+      f.write('\n'.join(result['collapsed']) + '\n')
+    print 'Collapsed stacks written to {0}'.format(sys.argv[3])
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Decommission and delete slaves from a running Hadoop cluster."""
+
+
+
+import json
+import sys
+
+import common
+
+
+def main():
+  common.setup()
+
+  if len(sys.argv) < 2:
+    print 'USAGE: {0} num_slaves | slave_name...'.format(common.script_name())
+    sys.exit(1)
+
+  if sys.argv[1].isdigit():
+    num_slaves = int(sys.argv[1])
+    print 'Removing {0} slaves...'.format(num_slaves)
+    data = {'num_slaves': num_slaves}
+  else:
+    print 'Removing {0}...'.format(', '.join(sys.argv[1:]))
+    data = {'names': json.dumps(sys.argv[1:])}
+  result = common.send_coordinator('/hadoop/remove_slaves', data, verify=True)
+  common.poll_operation(result['operation'])
+
+if __name__ == '__main__':
+  main()
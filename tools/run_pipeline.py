@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run a pipeline of transfers and jobs described by a JSON file.
+
+The file holds a list of steps; see tools/pipeline.py for their format. For
+example:
+
+[
+  {"name": "input", "type": "upload", "src": "gs://bucket/words.txt",
+   "dst": "/job_input/words.txt"},
+  {"name": "count", "type": "job", "after": ["input"], "jar": "wc.jar",
+   "args": ["/job_input/words.txt", "/job_output/count"]},
+  {"name": "export", "type": "download", "after": ["count"],
+   "src": "/job_output/count", "dst": "gs://bucket/count"},
+  {"name": "clean", "type": "clean", "after": ["export"],
+   "path": "/job_input/words.txt"}
+]
+"""
+
+
+
+import json
+import sys
+
+import common
+import pipeline
+
+
+def main():
+  common.setup()
+  if len(sys.argv) not in (2, 3):
+    print 'USAGE: {0} pipeline.json [report.json]'.format(common.script_name())
+    sys.exit(1)
+
+  specs = json.load(open(sys.argv[1]))
+  report_fn = sys.argv[2] if len(sys.argv) == 3 else None
+  try:
+    report = pipeline.run(specs, report_fn)
+  except pipeline.PipelineError as e:
+    print 'Bad pipeline: {0}'.format(e)
+    sys.exit(1)
+
+  print
+  for name, step in sorted(report['steps'].items(),
+                           key=lambda item: item[1]['started']):
+    duration = step['duration_secs']
+    print '{0:20} {1:10} {2}'.format(
+        name, step['state'], '' if duration is None else
+        '{0:.0f}s'.format(duration))
+  print 'Total: {0:.0f}s'.format(report['duration_secs'])
+  if report_fn:
+    print 'Timings written to {0}'.format(report_fn)
+  if not report['succeeded']:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -13,16 +13,98 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Pretty-print cluster status."""
+"""Pretty-print cluster status.
 
+With --live, shows a dashboard that updates as the cluster changes, until you
+press Ctrl-C.
+"""
 
 
+
+import curses
+import sys
+import time
+
 import common
 
+BAR_WIDTH = 20
+
+
+def bar(fraction):
+  done = int(round(fraction * BAR_WIDTH))
+  return '[{0}{1}] {2:3.0%}'.format('#' * done, '-' * (BAR_WIDTH - done),
+                                    fraction)
+
+
+def render(dashboard):
+  """The dashboard's lines of text."""
+  if dashboard is None:
+    return ['The coordinator is not running, or you sent the wrong secret.']
+  lines = ['Cluster {0} at {1}'.format(dashboard['state'],
+                                       time.strftime('%X')),
+           common.summary_line(dashboard),
+           '{0} live slaves, next launch wave of {1}'.format(
+               dashboard['live_slaves'], dashboard['launch']['wave_size']),
+           'Job queue: {0}'.format(', '.join(
+               '{0} {1}'.format(count, state) for state, count in
+               sorted(dashboard['job_queue'].items())) or 'empty')]
+  if dashboard['errors']:
+    lines.append('{0} errors, latest: {1}'.format(dashboard['errors'],
+                                                  dashboard['last_error']))
+  if dashboard['flagged']:
+    lines += ['', 'Flagged instances:']
+    for name, flags in sorted(dashboard['flagged'].items()):
+      lines.append('  {0}: {1}'.format(name, ', '.join(flags)))
+  if dashboard['transfers']:
+    lines += ['', 'Transfers:']
+    for name, xfer in sorted(dashboard['transfers'].items()):
+      lines.append('  {0}: {1} MB at {2} MB/s'.format(name, xfer['mb'],
+                                                      xfer['mb_per_sec']))
+  if dashboard['operations']:
+    lines += ['', 'Operations:']
+    for name, state in sorted(dashboard['operations'].items()):
+      lines.append('  {0}: {1}'.format(name, state))
+  if dashboard['jobs']:
+    lines += ['', 'Hadoop jobs:']
+    for job_id, job in sorted(dashboard['jobs'].items()):
+      lines.append('  {0} {1:7} map {2} reduce {3}'.format(
+          job_id, job['status'], bar(job['map']), bar(job['reduce'])))
+  return lines
+
+
+def live(screen):
+  curses.curs_set(0)
+  shown = []
+  size = None
+  for dashboard in common.dashboard_updates():
+    lines = render(dashboard)
+    height, width = screen.getmaxyx()
+    if (height, width) != size:
+      # Resized, so everything moves
+      size = (height, width)
+      shown = []
+      screen.clear()
+    # Only redraw the lines that changed
+    for i in range(min(max(len(lines), len(shown)), height)):
+      line = lines[i] if i < len(lines) else ''
+      if i < len(shown) and shown[i] == line:
+        continue
+      screen.move(i, 0)
+      screen.clrtoeol()
+      screen.addstr(i, 0, line[:width - 1])
+    shown = lines
+    screen.refresh()
+
 
 def main():
+  common.setup()
+  if sys.argv[1:] == ['--live']:
+    try:
+      curses.wrapper(live)
+    except KeyboardInterrupt:
+      pass
+    return
   try:
-    common.setup()
     data = common.send_coordinator('/status/cluster', {})
     common.pprint_status(data)
   except TypeError:
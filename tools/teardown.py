@@ -13,7 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""A script to teardown the cluster."""
+"""A script to teardown the cluster.
+
+The coordinator deletes the Hadoop instances itself, in parallel, and this
+script follows along before deleting the coordinator. If the coordinator can't
+be reached, the instances are deleted from here.
+"""
 
 
 
@@ -26,19 +31,15 @@ import common
 import util
 
 
-def main():
-  common.setup()
-  run = raw_input('Really delete all your instances? [y/n] ')
-  if run != 'y':
-    print 'Never mind.'
-    sys.exit()
+def nix(instance):
+  logging.info('Shutting down %s', instance)
+  util.ensure_api().delete_instance(instance=instance, blocking=True)
 
-  def nix(instance):
-    logging.info('Shutting down %s', instance)
-    util.api.delete_instance(instance=instance, blocking=True)
 
+def delete_directly(names):
+  """Delete instances from here, blocking until they're gone."""
   sched = util.Scheduler(cfg.num_workers * 2)
-  for name in util.get_instance_names():
+  for name in names:
     sched.schedule(nix, (name,))
 
   # Block
@@ -49,6 +50,29 @@ def main():
     left = len(util.get_instance_names())
   print
 
+
+def main():
+  common.setup()
+  run = raw_input('Really delete all your instances? [y/n] ')
+  if run != 'y':
+    print 'Never mind.'
+    sys.exit()
+
+  result = common.send_coordinator('/hadoop/teardown', {})
+  if result and result['result'] == 'ok':
+    print 'The coordinator is deleting {0} instances...'.format(
+        len(result['instances']))
+    common.wait_for_operation(result['operation'])
+    nix(cfg.coordinator)
+  else:
+    print 'The coordinator is not responding, deleting instances from here.'
+
+  # Catches anything the coordinator missed, or everything if it's gone
+  left = util.get_instance_names()
+  if left:
+    delete_directly(left)
+
+  common.forget_session()
   print 'All gone!'
 
 if __name__ == '__main__':
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Send a local file into HDFS, directly or staged in Google Storage."""
+
+
+
+import sys
+
+import common
+
+
+def main():
+  common.setup()
+
+  args = sys.argv[1:]
+  via_gs = args[:1] == ['--gs']
+  if via_gs:
+    args = args[1:]
+  if len(args) != 2:
+    print 'USAGE: {0} [--gs] local_file hdfs_path'.format(common.script_name())
+    print '  --gs stages the file in Google Storage first'
+    sys.exit(1)
+
+  state = common.upload_local(args[0], args[1], via_gs=via_gs)
+  if state != 'Done':
+    print state
+    sys.exit(1)
+  print 'Uploaded to {0}'.format(args[1])
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,39 @@
+#!/usr/bin/python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keep a pool of warm slaves, so add_slaves can start them instantly."""
+
+
+
+import sys
+
+import common
+
+
+def main():
+  common.setup()
+
+  if len(sys.argv) != 2:
+    print 'USAGE: {0} pool_size'.format(common.script_name())
+    print 'A pool_size of 0 stops keeping warm slaves around.'
+    sys.exit(1)
+
+  size = int(sys.argv[1])
+
+  print 'Keeping {0} warm slaves...'.format(size)
+  common.send_coordinator('/hadoop/warm_pool', {'size': size}, verify=True)
+
+if __name__ == '__main__':
+  main()
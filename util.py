@@ -17,21 +17,26 @@
 
 
 import collections
+import contextlib
+import hashlib
+import httplib
 import json
 import logging
 import multiprocessing
+import os
 import Queue
 import socket
+import ssl
 import subprocess
+import sys
 import threading
 import time
+import traceback
 import urllib
 
 import httplib2
 
 from cfg import cfg
-import gcelib.gce_util
-import gcelib.gce_v1beta13
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -43,29 +48,47 @@ logging.basicConfig(
 # Access to the Compute API
 
 api = None
+# How ensure_api() authorizes, as chosen by setup_api()
+api_service_account = True
+api_lock = threading.Lock()
 
 
-def setup_api(service_account=True):
+def setup_api(service_account=True, lazy=False):
   """Sets up a usable Compute API object.
 
   Args:
     service_account: If true, authorize using service accounts. This only works
       on the coordinator instance. Otherwise, authorize using a local config
       file or using the webserver oauth flow.
+    lazy: If true, wait until ensure_api() first needs the API. Importing
+      gcelib and loading credentials is slow, and many tools never need them.
   """
 
+  global api_service_account
+  api_service_account = service_account
+  if not lazy:
+    ensure_api()
+
+
+def ensure_api():
+  """Returns the Compute API object, setting it up on first use."""
   global api
-  if service_account:
-    creds = gcelib.gce_util.ServiceAccountCredentials()
-  else:
-    creds = gcelib.gce_util.get_credentials()
-  api = gcelib.gce_v1beta13.GoogleComputeEngine(
-      creds, default_project=cfg.project_id,
-      logging_level=logging.ERROR)
+  with api_lock:
+    if api is None:
+      import gcelib.gce_util
+      import gcelib.gce_v1beta13
+      if api_service_account:
+        creds = gcelib.gce_util.ServiceAccountCredentials()
+      else:
+        creds = gcelib.gce_util.get_credentials()
+      api = gcelib.gce_v1beta13.GoogleComputeEngine(
+          creds, default_project=cfg.project_id,
+          logging_level=logging.ERROR)
+    return api
 
 
 def get_instance_names():
-  return [instance.name for instance in api.all_instances()
+  return [instance.name for instance in ensure_api().all_instances()
           if (instance.name == cfg.coordinator or
               instance.name == cfg.hadoop_jobtracker or
               instance.name == cfg.hadoop_namenode or
@@ -106,7 +129,7 @@ def get_status(name):
   # Do getinstance first. Trying to poke the agent on a STAGING box just times
   # out, so such stages are never observed otherwise
   try:
-    data = api.get_instance(name)
+    data = ensure_api().get_instance(name)
     if data.status == 'RUNNING':
       # Now try talking to their agent
       address = name_to_ip(name, data=data) if cfg.ip_via_api else name
@@ -132,6 +155,15 @@ def get_status(name):
     return (InstanceState.NON_EXISTENT, None)
 
 
+def get_boot_id(name):
+  """Returns the boot ID an instance's snitch reports, or None."""
+  address = name_to_ip(name) if cfg.ip_via_api else name
+  response = talk_to_agent(address, '/status')
+  if response is None:
+    return None
+  return response.get('boot_id')
+
+
 # Communication
 
 ip_cache = {}
@@ -152,7 +184,7 @@ def name_to_ip(name, data=None):
   else:
     if data is None:
       try:
-        data = api.get_instance(name)
+        data = ensure_api().get_instance(name)
       except ValueError:
         # This instance does not exist
         return None
@@ -161,7 +193,7 @@ def name_to_ip(name, data=None):
     return ip
 
 
-def talk_to_agent(address, method, data=None):
+def talk_to_agent(address, method, data=None, timeout=5, http=None):
   """Make a REST call. These are described in docs/API.
 
   Args:
@@ -169,6 +201,11 @@ def talk_to_agent(address, method, data=None):
              instance)
     method: the HTTP call to make, should include the leading /
     data: a Python dictionary; caller must JSONify things themselves.
+    timeout: seconds to wait for the reply. Calls that block on the other end
+             need more than the default.
+    http: an httplib2.Http to reuse, keeping its connection open. By default,
+          each call opens its own and closes it, so it doesn't pin one of the
+          other end's server threads.
 
   Returns:
     The reply, which will be a de-JSONified dictionary.
@@ -178,21 +215,114 @@ def talk_to_agent(address, method, data=None):
     # The coordinator's certificate is self-signed, so we cannot verify we are
     # talking to the "correct" coordinator. Eavesdropping is not a problem, but
     # man-in-the-middle attacks could be.
-    http = httplib2.Http(disable_ssl_certificate_validation=True, timeout=5)
+    headers = {} if http else {'Connection': 'close'}
+    http = http or new_connection(timeout)
     if data is None:
       # GET
-      return json.loads(http.request(url, 'GET')[1])
+      return json.loads(http.request(url, 'GET', headers=headers)[1])
     else:
       # POST
-      return json.loads(http.request(url, 'POST', urllib.urlencode(data))[1])
+      return json.loads(http.request(url, 'POST', urllib.urlencode(data),
+                                     headers=headers)[1])
+  except (httplib2.HttpLib2Error, socket.error, ValueError):
+    return None
+
+
+def send_data(address, method, params, body, headers=None, timeout=60,
+              http=None):
+  """POST raw bytes, with the arguments in the query string.
+
+  Form-encoding would inflate binary data; this sends it as is.
+
+  Args:
+    address: like talk_to_agent
+    method: like talk_to_agent
+    params: a Python dictionary for the query string
+    body: a string of bytes
+    headers: extra HTTP headers
+    timeout: seconds to wait for the reply
+    http: like talk_to_agent
+
+  Returns:
+    The reply, which will be a de-JSONified dictionary, or None.
+  """
+  try:
+    url = 'https://{0}:{1}{2}?{3}'.format(address, cfg.port, method,
+                                         urllib.urlencode(params))
+    all_headers = {'Content-Type': 'application/octet-stream'}
+    if not http:
+      all_headers['Connection'] = 'close'
+    all_headers.update(headers or {})
+    http = http or new_connection(timeout)
+    return json.loads(http.request(url, 'POST', body, headers=all_headers)[1])
   except (httplib2.HttpLib2Error, socket.error, ValueError):
     return None
 
 
-def checked_do(who, command, data=None):
+def open_stream(address, method, data, timeout=60):
+  """Make a REST call whose reply is read a little at a time.
+
+  talk_to_agent holds the whole reply in memory; this is for replies too big
+  for that.
+
+  Args:
+    address: like talk_to_agent
+    method: like talk_to_agent
+    data: a Python dictionary to POST
+    timeout: seconds to wait for each read
+
+  Returns:
+    A file-like httplib.HTTPResponse the caller must close, or None.
+  """
+  args = {'timeout': timeout}
+  if hasattr(ssl, '_create_unverified_context'):
+    # Newer Pythons verify certificates by default. Like talk_to_agent, accept
+    # the self-signed ones.
+    args['context'] = ssl._create_unverified_context()
+  try:
+    conn = httplib.HTTPSConnection(address, cfg.port, **args)
+    conn.request('POST', method, urllib.urlencode(data),
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    resp = conn.getresponse()
+    if resp.status != 200:
+      conn.close()
+      return None
+    return resp
+  except (httplib.HTTPException, socket.error):
+    return None
+
+
+@contextlib.contextmanager
+def timed(spans, name):
+  """Appends a span for the body of a with statement to a list of spans."""
+  start = time.time()
+  try:
+    yield
+  finally:
+    spans.append({'name': name, 'start': start, 'end': time.time()})
+
+
+def report_spans(spans):
+  """Send the coordinator spans of this instance's startup, for its timeline.
+
+  Only works on instances given a trace ID in their metadata.
+  """
+  if not cfg.trace_id:
+    return
+  data = {'trace_id': cfg.trace_id, 'instance': socket.gethostname(),
+          'spans': json.dumps(spans)}
+  talk_to_agent(cfg.coordinator, '/trace/report', data)
+
+
+def new_connection(timeout):
+  return httplib2.Http(disable_ssl_certificate_validation=True,
+                       timeout=timeout)
+
+
+def checked_do(who, command, data=None, timeout=5):
   """Issue a rest call and verify the response indicates no errors."""
   address = name_to_ip(who) if cfg.ip_via_api else who
-  result = talk_to_agent(address, command, data=data)
+  result = talk_to_agent(address, command, data=data, timeout=timeout)
   if result is None or result['result'] != 'ok':
     raise Exception('{0}{1} failed: {2}'.format(who, command, result))
   return result
@@ -250,6 +380,18 @@ def retry_call(run, fail_cb=None):
   # All attempts failed
   raise subprocess.CalledProcessError(last_retcode, run[0])
 
+
+def file_digest(path):
+  """Returns the SHA-1 of a file's contents, without reading it all at once."""
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    while True:
+      block = f.read(1024 * 1024)
+      if not block:
+        break
+      digest.update(block)
+  return digest.hexdigest()
+
 # Data structure
 
 
@@ -289,26 +431,152 @@ class Task(object):
 
 
 class Worker(threading.Thread):
-  def __init__(self, scheduler):
-    threading.Thread.__init__(self)
+  def __init__(self, scheduler, name=None):
+    threading.Thread.__init__(self, name=name)
     self.scheduler = scheduler
     self.daemon = True  # Exit when only workers are left
+    # What the worker is running and since when, for thread_stacks()
+    self.task = None
+    self.task_started = None
 
   def run(self):
     while True:
       task = self.scheduler.queue.get()
-      task.run(*(task.args))
+      self.task, self.task_started = task, time.time()
+      try:
+        task.run(*(task.args))
+      finally:
+        self.task, self.task_started = None, None
 
 
 class Scheduler(object):
-  def __init__(self, num_workers):
+  def __init__(self, num_workers, name='worker'):
     self.queue = Queue.Queue()
 
     # Launch a thread pool
-    for _ in range(0, num_workers):
-      Worker(self).start()
+    for i in range(0, num_workers):
+      Worker(self, name='{0}-{1}'.format(name, i)).start()
 
   def schedule(self, run, args):
     # Args is a tuple
     task = Task(run, args)
     self.queue.put(task)
+
+
+class TokenBucket(object):
+  """Rate-limits calls shared between threads.
+
+  Allows rate calls per second on average, and bursts of up to burst calls.
+  """
+
+  def __init__(self, rate, burst):
+    self.rate = float(rate)
+    self.burst = burst
+    self.tokens = float(burst)
+    self.last = time.time()
+    self.lock = threading.Lock()
+
+  def take(self):
+    """Blocks until a call is allowed."""
+    while True:
+      with self.lock:
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+# Debugging
+
+# Only one sampling profile runs at a time in a process
+profile_lock = threading.Lock()
+
+
+def describe_frame(frame):
+  code = frame.f_code
+  return '{0} ({1}:{2})'.format(code.co_name,
+                                os.path.basename(code.co_filename),
+                                frame.f_lineno)
+
+
+def thread_stacks():
+  """Describe every thread in this process and where it is.
+
+  Returns:
+    A list of {'name', 'daemon', 'stack': frames from outermost to innermost}.
+    Scheduler workers also have the 'task' they're running and 'busy_secs'.
+  """
+  threads = dict((thread.ident, thread) for thread in threading.enumerate())
+  result = []
+  for ident, frame in sys._current_frames().items():
+    thread = threads.get(ident)
+    info = {'name': thread.name if thread else str(ident),
+            'daemon': thread.daemon if thread else None,
+            'stack': [line.rstrip() for line in traceback.format_stack(frame)]}
+    if isinstance(thread, Worker):
+      task = thread.task
+      started = thread.task_started
+      info['task'] = task.run.__name__ if task else None
+      info['busy_secs'] = time.time() - started if started else None
+    result.append(info)
+  return sorted(result, key=lambda info: info['name'])
+
+
+def sample_stacks(seconds, interval=None):
+  """A sampling profiler: record where every other thread is, repeatedly.
+
+  Args:
+    seconds: how long to sample for, capped at cfg.profile_max_secs
+    interval: seconds between samples, cfg.profile_interval_secs by default
+
+  Returns:
+    None if another profile is running, otherwise {'samples', 'seconds',
+    'stacks': the cfg.profile_top_stacks most seen stacks as {'stack': frames
+    from outermost to innermost, 'count'}, 'functions': the innermost frames
+    seen most, as {'function', 'count'}, 'collapsed': every stack seen, in the
+    'frame;frame count' format flame graph tools read}.
+  """
+  if not profile_lock.acquire(False):
+    return None
+  try:
+    seconds = min(seconds, cfg.profile_max_secs)
+    interval = interval or cfg.profile_interval_secs
+    me = threading.current_thread().ident
+    stacks = collections.defaultdict(int)
+    leaves = collections.defaultdict(int)
+    samples = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+      for ident, frame in sys._current_frames().items():
+        if ident == me:
+          continue
+        stack = []
+        while frame is not None:
+          stack.append(describe_frame(frame))
+          frame = frame.f_back
+        stack.reverse()
+        stacks[tuple(stack)] += 1
+        leaves[stack[-1]] += 1
+      samples += 1
+      time.sleep(interval)
+  finally:
+    profile_lock.release()
+
+  by_count = sorted(stacks.items(), key=lambda item: -item[1])
+  return {
+      'samples': samples,
+      'seconds': seconds,
+      'stacks': [{'stack': list(stack), 'count': count}
+                 for stack, count in by_count[:cfg.profile_top_stacks]],
+      'functions': [{'function': leaf, 'count': count}
+                    for leaf, count in sorted(leaves.items(),
+                                              key=lambda item: -item[1])
+                    [:cfg.profile_top_stacks]],
+      'collapsed': ['{0} {1}'.format(';'.join(stack), count)
+                    for stack, count in by_count],
+  }